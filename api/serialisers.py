@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 
 
@@ -69,3 +70,11 @@ class CompanyHierarchySearchInputSerialiser(serializers.Serializer):
             )
 
         return data
+
+
+class CompanyBulkSearchInputSerialiser(serializers.Serializer):
+    duns_numbers = serializers.ListField(
+        child=serializers.RegexField(regex=r"^\d{9}$"),
+        min_length=1,
+        max_length=settings.DNB_API_BULK_MAX_DUNS_NUMBERS,
+    )
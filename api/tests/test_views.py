@@ -13,6 +13,12 @@ from company.constants import MonitoringStatusChoices
 from company.models import ChangeRequest, Company
 from company.serialisers import CompanySerialiser
 from company.tests.factories import ChangeRequestFactory, CompanyFactory
+from dnb_direct_plus.client import (
+    DNBApiCircuitOpenError,
+    DNBApiRateLimitError,
+    DNBApiTimeoutError,
+    get_remaining_time,
+)
 from dnb_direct_plus.mapping import extract_company_data
 
 pytestmark = pytest.mark.django_db
@@ -130,6 +136,49 @@ class TestCompanySearchView:
         assert company.duns_number == result_data['results'][0]['duns_number']
         assert company.monitoring_status == MonitoringStatusChoices.pending.name
 
+    @pytest.mark.parametrize('headers,use_cache', [
+        ({}, True),
+        ({'HTTP_CACHE_CONTROL': 'no-cache'}, False),
+    ])
+    def test_cache_control_bypasses_cache(self, auth_client, mocker, headers, use_cache):
+        mock_search = mocker.patch('api.views.company_list_search', return_value={})
+
+        response = auth_client.post(
+            reverse('api:company-search'),
+            {'search_term': 'micro'},
+            **headers,
+        )
+
+        assert response.status_code == 200
+        assert mock_search.call_args[1]['use_cache'] == use_cache
+
+    @pytest.mark.parametrize('query_string,wait_for_update', [
+        ('', False),
+        ('?consistency=strong', True),
+    ])
+    def test_consistency_waits_for_update(self, auth_client, mocker, query_string, wait_for_update):
+        mock_search = mocker.patch('api.views.company_list_search', return_value={})
+
+        response = auth_client.post(
+            reverse('api:company-search') + query_string,
+            {'search_term': 'micro'},
+        )
+
+        assert response.status_code == 200
+        assert mock_search.call_args[1]['wait_for_update'] == wait_for_update
+
+    def test_rate_limited_request_returns_429(self, auth_client, mocker):
+        mock_api_request = mocker.patch('dnb_direct_plus.api.api_request')
+        mock_api_request.side_effect = DNBApiRateLimitError('Rate limit for /v1/search/companyList exceeded')
+
+        response = auth_client.post(
+            reverse('api:company-search'),
+            {'search_term': 'micro'},
+        )
+
+        assert response.status_code == 429
+        assert response.json() == {'detail': 'Rate limit for /v1/search/companyList exceeded'}
+
 
 class TestCompanySearchV2View:
     def test_requires_authentication(self, client):
@@ -332,7 +381,79 @@ class TestCompanyUpdateView:
 
 
 class TestCompanyHierarchySearchView:
-    
+
+    @pytest.fixture
+    def slow_family_tree(self, mocker, settings):
+        """A family tree of three one member pages, each of which takes 15 seconds to retrieve"""
+        settings.DNB_API_MAX_CONCURRENCY = 1
+        mock_time = mocker.patch('dnb_direct_plus.client.time')
+        mock_time.monotonic.return_value = 0
+
+        def _page_url(page_number):
+            return f'https://plus.dnb.com/v1/familyTree/111111111?page%5Bnumber%5D={page_number}&page%5Bsize%5D=1'
+
+        def _page(page_number):
+            return {
+                'inquiryDetail': {'duns': '111111111', 'page[size]': 1},
+                'globalUltimateDuns': '111111111',
+                'globalUltimateFamilyTreeMembersCount': 3,
+                'branchesExcludedMembersCount': 0,
+                'familyTreeMembers': [{'duns': f'{page_number}' * 9}],
+                'links': {'next': _page_url(page_number + 1)} if page_number < 3 else {},
+            }
+
+        pages = {
+            'v1/familyTree/111111111': _page(1),
+            _page_url(2): _page(2),
+            _page_url(3): _page(3),
+        }
+
+        def _api_request(method, url):
+            if get_remaining_time() == 0:
+                raise DNBApiTimeoutError('Deadline for /v1/familyTree exceeded')
+
+            mock_time.monotonic.return_value += 15
+
+            response = mocker.Mock()
+            response.json.return_value = pages[url]
+            return response
+
+        return mocker.patch('dnb_direct_plus.api.api_request', side_effect=_api_request)
+
+    @pytest.mark.parametrize('hierarchy_deadline, expected_status_code', [(90, 200), (25, 504)])
+    def test_multi_page_tree_uses_hierarchy_deadline(
+        self, auth_client, settings, slow_family_tree, hierarchy_deadline, expected_status_code,
+    ):
+        settings.DNB_API_REQUEST_DEADLINE_SECONDS = 25
+        settings.DNB_API_HIERARCHY_REQUEST_DEADLINE_SECONDS = hierarchy_deadline
+
+        response = auth_client.post(
+            reverse('api:company-hierarchy-search'),
+            {'duns_number': '111111111'},
+        )
+
+        assert response.status_code == expected_status_code
+        if expected_status_code == 200:
+            assert [member['duns'] for member in response.json()['family_tree_members']] == [
+                '111111111', '222222222', '333333333',
+            ]
+
+    def test_streamed_pages_are_retrieved_within_the_deadline(self, auth_client, settings, slow_family_tree):
+        settings.DNB_API_HIERARCHY_REQUEST_DEADLINE_SECONDS = 25
+
+        response = auth_client.post(
+            reverse('api:company-hierarchy-search') + '?stream=ndjson',
+            {'duns_number': '111111111'},
+        )
+
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        assert lines[1:] == [
+            {'duns': '111111111'},
+            {'duns': '222222222'},
+            {'error': {'detail': 'Deadline for /v1/familyTree exceeded'}},
+        ]
+
     def test_hierachy_requires_authentication(self, client):
         response = client.get(reverse('api:company-hierarchy-search'))
         assert response.status_code == 401
@@ -362,6 +483,29 @@ class TestCompanyHierarchySearchView:
         assert response.status_code == 200
         assert response.json() == {"family_tree_members": []}
 
+    def test_404_streams_empty_summary(self, auth_client, mocker):
+        mock_response = mocker.Mock()
+        mock_response.status_code = 404
+        mock_response.json.return_value = {
+            "error": {
+                "errorCode": "Code",
+                "errorMessage": "Message",
+            }
+        }
+        mock_api_request = mocker.patch('dnb_direct_plus.api.api_request')
+        mock_api_request.side_effect = HTTPError(response=mock_response)
+
+        response = auth_client.post(
+            reverse('api:company-hierarchy-search') + '?stream=ndjson',
+            {'duns_number': '000000000'},
+        )
+
+        assert response.status_code == 200
+
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        assert lines == [{}]
+
     def test_api_call_with_data(self, auth_client, mocker, company_hierarchy_api_response_json):
         company_hierarchy_data = json.loads(company_hierarchy_api_response_json)
 
@@ -384,6 +528,66 @@ class TestCompanyHierarchySearchView:
         assert response_data['family_tree_members'][1]['duns'] == '222222222'
         assert response_data['family_tree_members'][2]['duns'] == '333333333'
 
+    def test_api_call_streamed_as_ndjson(self, auth_client, mocker, company_hierarchy_api_response_json):
+        company_hierarchy_data = json.loads(company_hierarchy_api_response_json)
+
+        mock_api_request = mocker.patch('dnb_direct_plus.api.api_request')
+        mock_api_request.return_value.json.return_value = company_hierarchy_data
+
+        response = auth_client.post(
+            reverse('api:company-hierarchy-search') + '?stream=ndjson',
+            {'duns_number': '111111111'},
+        )
+
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'application/x-ndjson'
+
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        assert lines[0] == {
+            'global_ultimate_duns': '111111111',
+            'global_ultimate_family_tree_members_count': 3,
+            'branches_excluded_members_count': 2,
+        }
+        assert [member['duns'] for member in lines[1:]] == ['111111111', '222222222', '333333333']
+
+    def test_stream_reports_errors_in_last_line(self, auth_client, mocker):
+        def _members():
+            yield {'duns': '111111111'}
+            raise DNBApiCircuitOpenError('/v1/familyTree is unavailable')
+
+        mocker.patch(
+            'api.views.company_hierarchy_list_stream',
+            return_value=({'global_ultimate_duns': '111111111'}, _members()),
+        )
+
+        response = auth_client.post(
+            reverse('api:company-hierarchy-search') + '?stream=ndjson',
+            {'duns_number': '111111111'},
+        )
+
+        assert response.status_code == 200
+
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        assert lines == [
+            {'global_ultimate_duns': '111111111'},
+            {'duns': '111111111'},
+            {'error': {'detail': '/v1/familyTree is unavailable'}},
+        ]
+
+    def test_open_circuit_returns_503(self, auth_client, mocker):
+        mock_api_request = mocker.patch('dnb_direct_plus.api.api_request')
+        mock_api_request.side_effect = DNBApiCircuitOpenError('/v1/familyTree is unavailable')
+
+        response = auth_client.post(
+            reverse('api:company-hierarchy-search'),
+            {'duns_number': '111111111'},
+        )
+
+        assert response.status_code == 503
+        assert response.json() == {'detail': '/v1/familyTree is unavailable'}
+
     def test_api_with_bad_query(self, auth_client):
         response = auth_client.post(
             reverse('api:company-hierarchy-search'),
@@ -412,6 +616,60 @@ class TestCompanyHierarchySearchView:
         }
         assert response.json() == expected_response
 
+class TestCompanyBulkSearchView:
+    def test_requires_authentication(self, client):
+        response = client.post(reverse('api:company-bulk-search-v2'))
+
+        assert response.status_code == 401
+
+    @pytest.mark.parametrize(
+        'duns_numbers',
+        [[], ['12345678'], ['1234567890'], ['x123456789'], ['123456789'] * 63],
+    )
+    def test_invalid_duns_numbers(self, auth_client, duns_numbers):
+        response = auth_client.post(
+            reverse('api:company-bulk-search-v2'),
+            {'duns_numbers': duns_numbers},
+            format='json',
+        )
+
+        assert response.status_code == 400
+        assert 'duns_numbers' in response.json()
+
+    def test_max_duns_numbers(self, auth_client, mocker):
+        """By default, as many duns numbers as the rate limit serves in half the request deadline are accepted"""
+        duns_numbers = [f'{i:09}' for i in range(62)]
+        mock_search = mocker.patch('api.views.company_bulk_search', return_value={'results': []})
+
+        response = auth_client.post(
+            reverse('api:company-bulk-search-v2'),
+            {'duns_numbers': duns_numbers},
+            format='json',
+        )
+
+        assert response.status_code == 200
+        mock_search.assert_called_once_with(duns_numbers, update_local=True, wait_for_update=False)
+
+    def test_results(self, auth_client, mocker):
+        results = {
+            'results': [
+                {'duns_number': '123456789', 'company': {'duns_number': '123456789'}},
+                {'duns_number': '987654321', 'error': {'status_code': 404, 'detail': 'Not found'}},
+            ],
+        }
+        mock_search = mocker.patch('api.views.company_bulk_search', return_value=results)
+
+        response = auth_client.post(
+            reverse('api:company-bulk-search-v2'),
+            {'duns_numbers': ['123456789', '987654321']},
+            format='json',
+        )
+
+        assert response.status_code == 200
+        assert response.json() == results
+        mock_search.assert_called_once_with(['123456789', '987654321'], update_local=True, wait_for_update=False)
+
+
 class TestChangeRequestApiView:
     """
     Test the change-request API endpoint.
@@ -4,6 +4,7 @@ from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 from api.views import (
     ChangeRequestAPIView,
     CompanyUpdatesAPIView,
+    DNBCompanyBulkSearchAPIView,
     DNBCompanyHierarchySearchAPIView,
     DNBCompanyHierarchySearchCountAPIView,
     DNBCompanySearchAPIView,
@@ -20,6 +21,11 @@ urlpatterns = [
         DNBCompanySearchV2APIView.as_view(),
         name="company-search-v2",
     ),
+    path(
+        "v2/companies/bulk/",
+        DNBCompanyBulkSearchAPIView.as_view(),
+        name="company-bulk-search-v2",
+    ),
     path(
         "companies/hierarchy/search/",
         DNBCompanyHierarchySearchAPIView.as_view(),
@@ -1,5 +1,10 @@
+import contextvars
 import datetime
+import json
+import logging
 
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from requests.exceptions import HTTPError
 from rest_framework.exceptions import ParseError
 from rest_framework.generics import CreateAPIView, ListAPIView, ListCreateAPIView
@@ -14,18 +19,34 @@ from company.serialisers import (
     InvestigationRequestSerializer,
 )
 from dnb_direct_plus.api import (
+    company_bulk_search,
     company_hierarchy_count,
     company_hierarchy_list_search,
+    company_hierarchy_list_stream,
     company_list_search,
     company_list_search_v2,
 )
+from dnb_direct_plus.client import deadline, DNBApiError, DNBApiUnavailableError
 
 from .serialisers import (
+    CompanyBulkSearchInputSerialiser,
     CompanyHierarchySearchInputSerialiser,
     CompanySearchInputSerialiser,
     CompanySearchV2InputSerialiser,
 )
 
+logger = logging.getLogger(__name__)
+
+
+def _use_cache(request):
+    """Cached and locally stored DNB data is bypassed when the client sends `Cache-Control: no-cache`."""
+    return "no-cache" not in request.headers.get("Cache-Control", "")
+
+
+def _wait_for_update(request):
+    """The local company is updated before responding when the client asks for `?consistency=strong`."""
+    return request.query_params.get("consistency") == "strong"
+
 
 class DNBCompanySearchAPIView(APIView):
     """
@@ -37,10 +58,18 @@ class DNBCompanySearchAPIView(APIView):
         serialiser.is_valid(raise_exception=True)
 
         try:
-            data = company_list_search(serialiser.data, update_local=True)
+            with deadline(settings.DNB_API_REQUEST_DEADLINE_SECONDS):
+                data = company_list_search(
+                    serialiser.data,
+                    update_local=True,
+                    use_cache=_use_cache(request),
+                    wait_for_update=_wait_for_update(request),
+                )
         except HTTPError as ex:
             error_detail = ex.response.json()["error"]
             return Response(error_detail, status=ex.response.status_code)
+        except DNBApiUnavailableError as ex:
+            return Response({"detail": str(ex)}, status=ex.status_code)
 
         return Response(data)
 
@@ -55,10 +84,38 @@ class DNBCompanySearchV2APIView(APIView):
         serialiser.is_valid(raise_exception=True)
 
         try:
-            data = company_list_search_v2(serialiser.data, update_local=True)
+            with deadline(settings.DNB_API_REQUEST_DEADLINE_SECONDS):
+                data = company_list_search_v2(
+                    serialiser.data,
+                    update_local=True,
+                    use_cache=_use_cache(request),
+                    wait_for_update=_wait_for_update(request),
+                )
         except HTTPError as ex:
             error_detail = ex.response.json()["error"]
             return Response(error_detail, status=ex.response.status_code)
+        except DNBApiUnavailableError as ex:
+            return Response({"detail": str(ex)}, status=ex.status_code)
+
+        return Response(data)
+
+
+class DNBCompanyBulkSearchAPIView(APIView):
+    """
+    An API view that looks up a list of duns numbers, using local data where it is fresh and Dun & Bradstreet's
+    data/duns endpoint otherwise.  Each duns number has its own result or error in the response.
+    """
+
+    def post(self, request):
+        serialiser = CompanyBulkSearchInputSerialiser(data=request.data)
+        serialiser.is_valid(raise_exception=True)
+
+        with deadline(settings.DNB_API_REQUEST_DEADLINE_SECONDS):
+            data = company_bulk_search(
+                serialiser.validated_data["duns_numbers"],
+                update_local=True,
+                wait_for_update=_wait_for_update(request),
+            )
 
         return Response(data)
 
@@ -66,19 +123,69 @@ class DNBCompanySearchV2APIView(APIView):
 class DNBCompanyHierarchySearchAPIView(APIView):
     """
     An API view that proxies requests to Dun & Bradstreet's hierarchy search.
+
+    With `?stream=ndjson` the response is streamed as newline delimited JSON: the first line holds the
+    hierarchy summary and each following line a family tree member, sent as each page arrives from D&B.
+    The summary line is always sent, as `{}` if D&B has no hierarchy for the duns number.
     """
     def post(self, request):
         serialiser = CompanyHierarchySearchInputSerialiser(data=request.data)
         serialiser.is_valid(raise_exception=True)
 
+        stream = request.query_params.get("stream") == "ndjson"
+
         try:
-            data = company_hierarchy_list_search(serialiser.data)
+            with deadline(settings.DNB_API_HIERARCHY_REQUEST_DEADLINE_SECONDS):
+                if stream:
+                    summary, members = company_hierarchy_list_stream(
+                        serialiser.data, use_local=_use_cache(request),
+                    )
+                    # later pages are requested as the response is streamed, after the deadline block has exited,
+                    # so they are requested in a copy of the context that holds the deadline
+                    context = contextvars.copy_context()
+                else:
+                    data = company_hierarchy_list_search(
+                        serialiser.data, use_local=_use_cache(request),
+                    )
         except HTTPError as ex:
             error_detail = ex.response.json()["error"]
             return Response(error_detail, status=ex.response.status_code)
+        except DNBApiUnavailableError as ex:
+            return Response({"detail": str(ex)}, status=ex.status_code)
+
+        if stream:
+            return StreamingHttpResponse(
+                _iter_in_context(context, _iter_ndjson_lines(summary, members)),
+                content_type="application/x-ndjson",
+            )
+
         return Response(data)
 
 
+def _iter_in_context(context, iterator):
+    """Yield the items of `iterator`, running each step in `context`"""
+
+    while True:
+        try:
+            yield context.run(next, iterator)
+        except StopIteration:
+            return
+
+
+def _iter_ndjson_lines(summary, members):
+    """Yield the hierarchy as newline delimited JSON.  Once streaming has started the status code can't
+    be changed, so an error retrieving a later page is reported in a final `error` line."""
+
+    yield json.dumps(summary) + "\n"
+
+    try:
+        for member in members:
+            yield json.dumps(member) + "\n"
+    except (HTTPError, DNBApiError) as ex:
+        logger.exception("Failed to retrieve company hierarchy")
+        yield json.dumps({"error": {"detail": str(ex)}}) + "\n"
+
+
 class CompanyUpdatesAPIView(ListAPIView):
     serializer_class = CompanySerialiser
 
@@ -145,8 +252,11 @@ class DNBCompanyHierarchySearchCountAPIView(APIView):
         serialiser.is_valid(raise_exception=True)
 
         try:
-            data = company_hierarchy_count(serialiser.data)
+            with deadline(settings.DNB_API_HIERARCHY_REQUEST_DEADLINE_SECONDS):
+                data = company_hierarchy_count(serialiser.data, use_local=_use_cache(request))
         except HTTPError as ex:
             error_detail = ex.response.json()["error"]
             return Response(error_detail, status=ex.response.status_code)
+        except DNBApiUnavailableError as ex:
+            return Response({"detail": str(ex)}, status=ex.status_code)
         return Response(data)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class CompanyConfig(AppConfig):
     name = 'company'
+
+    def ready(self):
+        # connect the signals that clear the loaded countries
+        import company.countries  # noqa: F401
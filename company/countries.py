@@ -0,0 +1,74 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from company.models import Country
+
+
+# countries keyed by upper case ISO alpha-2 code and by id; loaded on first use and cleared when a country changes.
+# Only the process that changes a country sees the signal, so a lookup that misses also reloads them once.
+_countries_by_iso_alpha2 = None
+_countries_by_id = None
+
+
+def _load_countries():
+    global _countries_by_iso_alpha2, _countries_by_id
+
+    if _countries_by_iso_alpha2 is None:
+        countries = list(Country.objects.all())
+        _countries_by_id = {country.pk: country for country in countries}
+        _countries_by_iso_alpha2 = {country.iso_alpha2.upper(): country for country in countries}
+
+    return _countries_by_iso_alpha2, _countries_by_id
+
+
+def _lookup_country(index, key):
+    """Look up a country in one of the loaded indexes, `0` by ISO alpha-2 code or `1` by id, reloading the
+    countries once if it is missing in case it was added by another process"""
+
+    country = _load_countries()[index].get(key)
+
+    if country is None:
+        clear_countries()
+        country = _load_countries()[index].get(key)
+
+    if country is None:
+        raise Country.DoesNotExist(f'Country matching query does not exist: {key}')
+
+    return country
+
+
+def get_country(iso_alpha2):
+    """Look up a country by its ISO alpha-2 code, ignoring case, without a database query once the countries
+    are loaded; raises Country.DoesNotExist if there is no such country"""
+
+    return _lookup_country(0, iso_alpha2.upper())
+
+
+def get_country_by_id(country_id):
+    """Look up a country by its id without a database query once the countries are loaded; raises
+    Country.DoesNotExist if there is no such country"""
+
+    return _lookup_country(1, country_id)
+
+
+def get_iso_alpha2_codes():
+    """The ISO alpha-2 codes of all countries"""
+
+    _, countries_by_id = _load_countries()
+
+    return {country.iso_alpha2 for country in countries_by_id.values()}
+
+
+def clear_countries():
+    """Clear the loaded countries so they are loaded again on next use"""
+
+    global _countries_by_iso_alpha2, _countries_by_id
+
+    _countries_by_iso_alpha2 = None
+    _countries_by_id = None
+
+
+@receiver(post_save, sender=Country)
+@receiver(post_delete, sender=Country)
+def _clear_countries_on_change(**kwargs):
+    clear_countries()
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('company', '0021_company_parent_duns_number'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='source_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
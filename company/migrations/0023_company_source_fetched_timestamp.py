@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('company', '0022_company_source_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='source_fetched_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
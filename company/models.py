@@ -122,6 +122,10 @@ class Company(models.Model):
 
     source = JSONField(null=True, blank=True)
 
+    # a hash of the company data mapped from source, see `get_company_data_hash`; used to skip updates
+    # that would not change the company
+    source_hash = models.CharField(max_length=64, blank=True)
+
     worldbase_source = JSONField(null=True, blank=True)
 
     worldbase_source_updated_timestamp = models.DateTimeField(
@@ -145,6 +149,14 @@ class Company(models.Model):
         null=True,
     )
 
+    # this field records when the source was last fetched from DNB, by an api call or in a monitoring update,
+    # rather than the timestamp of the data itself. It is used to decide whether the source is fresh enough
+    # to answer requests without calling DNB.
+    source_fetched_timestamp = models.DateTimeField(
+        null=True,
+        blank=True,
+    )
+
     # this field tracks when a change is made to the models data fields
     last_updated = models.DateTimeField(
         null=True,
@@ -354,6 +366,59 @@ class Company(models.Model):
     def __str__(self):
         return f'{self.duns_number} / {self.primary_name}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_values = {
+            attname: value for attname, value in zip(field_names, values) if value is not models.DEFERRED
+        }
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._store_saved_values(kwargs.get('update_fields'))
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        self._store_saved_values(fields)
+
+    def _store_saved_values(self, field_names=None):
+        """Record the current values of `field_names`, or all loaded fields, as those in the database"""
+
+        deferred_fields = self.get_deferred_fields()
+        fields = (
+            self._meta.concrete_fields if field_names is None
+            else [self._meta.get_field(field_name) for field_name in field_names]
+        )
+        self._saved_values = {
+            **getattr(self, '_saved_values', {}),
+            **{
+                field.attname: getattr(self, field.attname)
+                for field in fields if field.attname not in deferred_fields
+            },
+        }
+
+    @property
+    def changed_fields(self):
+        """The names of the fields that have changed since the company was loaded or last saved, for use as
+        `save(update_fields=...)`; all fields for an unsaved company.
+
+        NOTE: values are compared with those loaded, so JSON fields must be assigned rather than changed in place
+        for the change to be seen."""
+
+        saved_values = getattr(self, '_saved_values', {})
+        deferred_fields = self.get_deferred_fields()
+        not_saved = object()
+
+        fields = [
+            field for field in self._meta.concrete_fields
+            if not field.primary_key and field.attname not in deferred_fields
+        ]
+        return [
+            field.name for field in fields
+            if getattr(self, field.attname) != saved_values.get(field.attname, not_saved)
+        ]
+
     @property
     def is_monitored(self):
         return self.monitoring_status == MonitoringStatusChoices.enabled.name
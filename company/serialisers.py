@@ -3,10 +3,10 @@ from django.utils.functional import cached_property
 from rest_framework import serializers
 
 from company.constants import ADDRESS_FIELDS
+from company.countries import get_country_by_id, get_iso_alpha2_codes
 from company.models import (
     ChangeRequest,
     Company,
-    Country,
     IndustryCode,
     InvestigationRequest,
     PrimaryIndustryCode,
@@ -38,18 +38,22 @@ class PrimaryIndustryCodeSerialiser(serializers.ModelSerializer):
         exclude = ['id', 'company']
 
 
+class CountrySlugField(serializers.Field):
+    """A read only country, given by the id of a country foreign key and serialised as its ISO alpha-2 code; the
+    country is looked up in the loaded countries rather than with a query"""
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return get_country_by_id(value).iso_alpha2
+
+
 class BaseCompanySerializer(serializers.ModelSerializer):
-    address_country = serializers.SlugRelatedField(
-        many=False,
-        read_only=True,
-        slug_field='iso_alpha2'
-    )
-
-    registered_address_country = serializers.SlugRelatedField(
-        many=False,
-        read_only=True,
-        slug_field='iso_alpha2'
-    )
+    address_country = CountrySlugField(source='address_country_id')
+
+    registered_address_country = CountrySlugField(source='registered_address_country_id')
 
     registration_numbers = RegistrationNumberSerialiser(many=True)
     industry_codes = IndustryCodeSerialiser(many=True)
@@ -155,7 +159,7 @@ class ChangeRequestChangesSerialiser(CompanySerialiser):
 
     @cached_property
     def _country_slugs(self):
-        return Country.objects.all().values_list('iso_alpha2', flat=True)
+        return get_iso_alpha2_codes()
 
     def _validate_country_slug(self, value):
         if value not in self._country_slugs:
@@ -232,7 +236,7 @@ class CompanyDetailsSerialiser(BaseCompanySerializer):
 
     @cached_property
     def _country_slugs(self):
-        return Country.objects.all().values_list('iso_alpha2', flat=True)
+        return get_iso_alpha2_codes()
 
     def _validate_country_slug(self, value):
         if value not in self._country_slugs:
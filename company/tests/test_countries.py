@@ -0,0 +1,49 @@
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from company.countries import get_country, get_country_by_id, get_iso_alpha2_codes
+from company.models import Country
+
+pytestmark = pytest.mark.django_db
+
+
+class TestCountries:
+    def test_countries_are_loaded_once(self):
+        get_country('GB')
+
+        with CaptureQueriesContext(connection) as queries:
+            country = get_country('gb')
+            assert get_country_by_id(country.pk) is country
+            assert 'GB' in get_iso_alpha2_codes()
+
+        assert country == Country.objects.get(iso_alpha2='GB')
+        assert not queries
+
+    @pytest.mark.parametrize('lookup,value', [(get_country, 'XX'), (get_country_by_id, 0)])
+    def test_missing_country(self, lookup, value):
+        with pytest.raises(Country.DoesNotExist):
+            lookup(value)
+
+    def test_countries_are_reloaded_when_a_country_changes(self):
+        assert 'XX' not in get_iso_alpha2_codes()
+
+        country = Country.objects.create(name='Test', iso_alpha2='XX', iso_alpha3='XXX', iso_numeric=999)
+
+        assert get_country('XX') == country
+
+        country.delete()
+
+        with pytest.raises(Country.DoesNotExist):
+            get_country('XX')
+
+    @pytest.mark.parametrize('lookup,key', [(get_country, 'iso_alpha2'), (get_country_by_id, 'pk')])
+    def test_countries_are_reloaded_when_a_country_is_missing(self, lookup, key):
+        assert 'XX' not in get_iso_alpha2_codes()
+
+        # bulk_create sends no signals, as for a country added by another process
+        country, = Country.objects.bulk_create(
+            [Country(name='Test', iso_alpha2='XX', iso_alpha3='XXX', iso_numeric=999)],
+        )
+
+        assert lookup(getattr(country, key)) == country
@@ -1,7 +1,9 @@
 import pytest
-from company.tests.factories import CompanyFactory
 from django.core.exceptions import ValidationError
 
+from company.models import Company, Country
+from company.tests.factories import CompanyFactory
+
 # mark the whole module for db use
 pytestmark = pytest.mark.django_db
 
@@ -40,4 +42,26 @@ class TestCompany:
         company.full_clean()
         assert company.parent_duns_number == '123456789'
 
+    def test_changed_fields(self):
+        company = CompanyFactory.build()
+
+        assert 'primary_name' in company.changed_fields
+
+        company.save()
+
+        assert company.changed_fields == []
+
+        company = Company.objects.get(pk=company.pk)
+        company.primary_name = 'New name'
+        company.address_country = Country.objects.exclude(pk=company.address_country_id).first()
+        company.source = {'new': 'source'}
+
+        assert company.changed_fields == ['source', 'primary_name', 'address_country']
+
+        company.save(update_fields=['primary_name'])
+
+        assert company.changed_fields == ['source', 'address_country']
+
+        company.refresh_from_db()
 
+        assert company.changed_fields == []
@@ -171,10 +171,72 @@ ALLOWED_IP_RANGES = env.list('ALLOWED_IP_RANGES', default=[])
 DNB_API_USERNAME = env('DNB_API_USERNAME')
 DNB_API_PASSWORD = env('DNB_API_PASSWORD')
 DNB_API_RENEW_ACCESS_TOKEN_SECONDS_REMAINING = 300
+DNB_API_POOL_CONNECTIONS = env.int('DNB_API_POOL_CONNECTIONS', 1)
+DNB_API_POOL_MAXSIZE = env.int('DNB_API_POOL_MAXSIZE', 10)
+DNB_API_POOL_BLOCK = env.bool('DNB_API_POOL_BLOCK', False)
+# requests per second, shared across all processes; per endpoint overrides are given as e.g.
+# DNB_API_RATE_LIMITS=/v1/match/cleanseMatch=10,/v1/familyTree=2
+DNB_API_DEFAULT_RATE_LIMIT = env.float('DNB_API_DEFAULT_RATE_LIMIT', 5)
+DNB_API_RATE_LIMITS = env.dict('DNB_API_RATE_LIMITS', cast={'value': float}, default={})
+DNB_API_RATE_LIMIT_MAX_WAIT_SECONDS = env.float('DNB_API_RATE_LIMIT_MAX_WAIT_SECONDS', 5)
+DNB_API_CIRCUIT_FAILURE_THRESHOLD = env.int('DNB_API_CIRCUIT_FAILURE_THRESHOLD', 5)
+DNB_API_CIRCUIT_FAILURE_WINDOW_SECONDS = env.int('DNB_API_CIRCUIT_FAILURE_WINDOW_SECONDS', 60)
+DNB_API_CIRCUIT_RESET_SECONDS = env.int('DNB_API_CIRCUIT_RESET_SECONDS', 30)
+# (connect, read) timeouts in seconds; per endpoint overrides are given as JSON e.g.
+# DNB_API_TIMEOUTS={"/v1/familyTree": [3.05, 60]}
+DNB_API_CONNECT_TIMEOUT_SECONDS = env.float('DNB_API_CONNECT_TIMEOUT_SECONDS', 3.05)
+DNB_API_READ_TIMEOUT_SECONDS = env.float('DNB_API_READ_TIMEOUT_SECONDS', 30)
+DNB_API_TIMEOUTS = env.json('DNB_API_TIMEOUTS', {})
+# the longest time a single DNB api call may spend retrying
+DNB_API_MAX_RETRY_SECONDS = env.float('DNB_API_MAX_RETRY_SECONDS', 60)
+# the total time the proxy api views allow for DNB api calls
+DNB_API_REQUEST_DEADLINE_SECONDS = env.float('DNB_API_REQUEST_DEADLINE_SECONDS', 25)
+# the total time the hierarchy views allow, as a large family tree is retrieved a page at a time under the
+# familyTree rate limit; it must be shorter than the gunicorn worker timeout in the Procfile
+DNB_API_HIERARCHY_REQUEST_DEADLINE_SECONDS = env.float('DNB_API_HIERARCHY_REQUEST_DEADLINE_SECONDS', 90)
+# GET requests to these endpoints are hedged: if no response arrives within the given percentile of
+# recent response times a second request is sent and the first response wins, e.g.
+# DNB_API_HEDGED_ENDPOINTS=/v1/match/cleanseMatch,/v1/data/duns,/v1/familyTree
+DNB_API_HEDGED_ENDPOINTS = env.list('DNB_API_HEDGED_ENDPOINTS', default=[])
+DNB_API_HEDGE_PERCENTILE = env.float('DNB_API_HEDGE_PERCENTILE', 95)
+DNB_API_HEDGE_MIN_SAMPLES = env.int('DNB_API_HEDGE_MIN_SAMPLES', 20)
+DNB_API_HEDGE_DEFAULT_DELAY_SECONDS = env.float('DNB_API_HEDGE_DEFAULT_DELAY_SECONDS', 2)
+DNB_API_HEDGE_MIN_DELAY_SECONDS = env.float('DNB_API_HEDGE_MIN_DELAY_SECONDS', 0.2)
+DNB_API_HEDGE_MAX_WORKERS = env.int('DNB_API_HEDGE_MAX_WORKERS', 10)
+# the number of DNB api calls a single request or task may have in flight at once
+DNB_API_MAX_CONCURRENCY = env.int('DNB_API_MAX_CONCURRENCY', 5)
+# company search responses are cached in redis for this long; 0 disables the cache.  Responses
+# larger than DNB_API_SEARCH_CACHE_MAX_BYTES are not cached.
+DNB_API_SEARCH_CACHE_TTL_SECONDS = env.int('DNB_API_SEARCH_CACHE_TTL_SECONDS', 5 * 60)
+DNB_API_SEARCH_CACHE_MAX_BYTES = env.int('DNB_API_SEARCH_CACHE_MAX_BYTES', 512 * 1024)
+# family trees are stored locally and served without calling DNB for DNB_FAMILY_TREE_MAX_AGE_SECONDS.
+# Older trees are still served, and refreshed in the background, until they are DNB_FAMILY_TREE_MAX_STALE_SECONDS old.
+DNB_FAMILY_TREE_MAX_AGE_SECONDS = env.int('DNB_FAMILY_TREE_MAX_AGE_SECONDS', 24 * 60 * 60)
+DNB_FAMILY_TREE_MAX_STALE_SECONDS = env.int('DNB_FAMILY_TREE_MAX_STALE_SECONDS', 7 * 24 * 60 * 60)
+# the number of stale family trees refreshed each time the refresh task is scheduled
+DNB_FAMILY_TREE_REFRESH_BATCH_SIZE = env.int('DNB_FAMILY_TREE_REFRESH_BATCH_SIZE', 100)
+# detail searches for a monitored company whose D&B data was updated within this many seconds are answered
+# from the local copy instead of calling DNB; 0 always calls DNB
+DNB_LOCAL_COMPANY_MAX_AGE_SECONDS = env.int('DNB_LOCAL_COMPANY_MAX_AGE_SECONDS', 7 * 24 * 60 * 60)
+# the most duns numbers that can be looked up in one bulk request; by default as many as the rate limit serves in
+# half the request deadline, leaving the rest for other requests sharing the limit
+DNB_API_BULK_MAX_DUNS_NUMBERS = env.int(
+    'DNB_API_BULK_MAX_DUNS_NUMBERS',
+    int(DNB_API_DEFAULT_RATE_LIMIT * DNB_API_REQUEST_DEADLINE_SECONDS / 2),
+)
 DNB_MONITORING_REGISTRATION_REFERENCE = env('DNB_MONITORING_REGISTRATION_REFERENCE')
 DNB_MONITORING_S3_BUCKET = env('DNB_S3_MONITORING_BUCKET')
 DNB_ARCHIVE_PROCESSED_FILES = env.bool('DNB_ARCHIVE_PROCESSED_FILES')
 DNB_ARCHIVE_PATH = env('DNB_ARCHIVE_PATH', default='archive/')
+# the number of lines of a monitoring notification file that are loaded and written together
+DNB_MONITORING_BATCH_SIZE = env.int('DNB_MONITORING_BATCH_SIZE', 500)
+# the number of tasks that each monitoring notification file is split between by duns number; 1 processes a file
+# in a single task
+DNB_MONITORING_SHARDS = env.int('DNB_MONITORING_SHARDS', 1)
+# the celery queue that monitoring files are processed on; a dedicated worker can be run with -Q
+DNB_MONITORING_QUEUE = env('DNB_MONITORING_QUEUE', default='celery')
+# how long a monitoring file is locked for while it is processed, in case the worker dies without releasing it
+DNB_MONITORING_FILE_LOCK_SECONDS = env.int('DNB_MONITORING_FILE_LOCK_SECONDS', 6 * 60 * 60)
 DEFAULT_AWS_ACCESS_KEY_ID = env('DEFAULT_AWS_ACCESS_KEY_ID')
 DEFAULT_AWS_SECRET_ACCESS_KEY = env('DEFAULT_AWS_SECRET_ACCESS_KEY')
 
@@ -320,6 +382,15 @@ if env.bool("ENABLE_DNB_MONITORING_DATA", False):
         ),
     }
 
+if env.bool("ENABLE_DNB_FAMILY_TREE_REFRESH", False):
+    # Refreshes the oldest locally stored family trees from the external D&B API.
+    CELERY_BEAT_SCHEDULE["refresh_stale_family_trees"] = {
+        "task": "dnb_direct_plus.tasks.refresh_stale_family_trees",
+        "schedule": crontab(
+            minute=30,
+        ),
+    }
+
 
 # Elastic APM settings
 
@@ -10,6 +10,14 @@ def django_db_setup(django_db_setup, django_db_blocker):
         call_command('loaddata', 'company/fixtures/countries.yaml')
 
 
+@pytest.fixture(autouse=True)
+def clear_countries():
+    """Countries created by a test are rolled back without a signal, so don't let them outlive the test"""
+    yield
+    from company.countries import clear_countries
+    clear_countries()
+
+
 @pytest.fixture(scope='module')
 def cmpelk_api_response_json():
     with open(os.path.join(os.path.dirname(__file__),
@@ -1,8 +1,25 @@
 from django.contrib import admin
 
-from .models import MonitoringFileRecord
+from .models import FailedNotificationLine, FamilyTree, MonitoringFileProgress, MonitoringFileRecord
 
 
 @admin.register(MonitoringFileRecord)
 class MonitoringFileRecordAdmin(admin.ModelAdmin):
-    list_display = ('timestamp', 'file_name', 'total', 'failed')
+    list_display = ('timestamp', 'file_name', 'total', 'failed', 'unchanged')
+
+
+@admin.register(MonitoringFileProgress)
+class MonitoringFileProgressAdmin(admin.ModelAdmin):
+    list_display = ('updated', 'file_name', 'shard', 'shards', 'last_line_number', 'total', 'success', 'unchanged')
+
+
+@admin.register(FailedNotificationLine)
+class FailedNotificationLineAdmin(admin.ModelAdmin):
+    list_display = ('timestamp', 'file_name', 'line_number', 'reason')
+    search_fields = ('file_name',)
+
+
+@admin.register(FamilyTree)
+class FamilyTreeAdmin(admin.ModelAdmin):
+    list_display = ('global_ultimate_duns', 'global_ultimate_family_tree_members_count', 'last_refreshed')
+    search_fields = ('global_ultimate_duns',)
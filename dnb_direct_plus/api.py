@@ -1,26 +1,63 @@
 import logging
+import math
+from datetime import timedelta
+from urllib.parse import parse_qsl, urlencode, urlparse
 
-logger = logging.getLogger(__name__)
-
+from django.conf import settings
+from django.utils import timezone
 from requests.exceptions import HTTPError
 
-from dnb_direct_plus.client import api_request
+from company.constants import MonitoringStatusChoices
+from company.models import Company
+from dnb_direct_plus.client import (
+    api_request,
+    cache_response,
+    DNBApiError,
+    DNBApiUnavailableError,
+    get_cached_response,
+    map_concurrently,
+    redis_client,
+)
 from dnb_direct_plus.constants import (
     DEPRECATED_SEARCH_QUERY_PARAMS_V2,
     SEARCH_QUERY_TO_DNB_FIELD_MAPPING,
     SEARCH_QUERY_TO_DNB_FIELD_MAPPING_V2,
 )
 from dnb_direct_plus.mapping import extract_company_data
-from dnb_direct_plus.tasks import update_company_and_enable_monitoring
+from dnb_direct_plus.models import FamilyTree
+from dnb_direct_plus.tasks import refresh_family_tree, schedule_company_update
+
+logger = logging.getLogger(__name__)
 
 DNB_COMPANY_SEARCH_ENDPOINT = "/v1/search/companyList"
 DNB_COMPANY_SEARCH_ENDPOINT_V2 = "/v1/match/cleanseMatch"
 DNB_COMPANY_HIERARCHY_ENDPOINT = "v1/familyTree"
 
+FAMILY_TREE_REFRESH_KEY = "_family_tree_refresh:{}"
+FAMILY_TREE_REFRESH_LOCK_SECONDS = 5 * 60
+
 company_endpoint_from_duns = lambda dunsNumber: f"/v1/data/duns/{dunsNumber}"
 
 
-def company_list_search(query, update_local=False):
+def _cached_api_request(method, url, use_cache, **kwargs):
+    """
+    Make a DNB api request and return the JSON response, reading through the response cache.
+
+    With `use_cache=False` the cache is not read but is still refreshed with the new response.
+    Errors are never cached.
+    """
+    if use_cache:
+        response_data = get_cached_response(method, url, **kwargs)
+        if response_data is not None:
+            return response_data
+
+    response_data = api_request(method, url, **kwargs).json()
+    cache_response(response_data, method, url, **kwargs)
+
+    return response_data
+
+
+def company_list_search(query, update_local=False, use_cache=True, wait_for_update=False):
     """
     Perform a DNB Direct+ company search list api call
 
@@ -30,18 +67,23 @@ def company_list_search(query, update_local=False):
 
     Documentation for the DNB api call is available here:
     https://directplus.documentation.dnb.com/openAPI.html?apiID=searchCompanyList
+
+    responses are cached, see `_cached_api_request`; pass `use_cache=False` to always query DNB.
+
+    with `update_local=True` a single duns number match is saved to the local company in the background, see
+    `schedule_company_update`; pass `wait_for_update=True` to save it before returning.
     """
     mapped_query = {SEARCH_QUERY_TO_DNB_FIELD_MAPPING[k]: v for k, v in query.items()}
 
     try:
-        response = api_request("POST", DNB_COMPANY_SEARCH_ENDPOINT, json=mapped_query)
+        response_data = _cached_api_request(
+            "POST", DNB_COMPANY_SEARCH_ENDPOINT, use_cache, json=mapped_query
+        )
     except HTTPError as ex:
         if ex.response.status_code == 404:
             response_data = {}
         else:
             raise
-    else:
-        response_data = response.json()
 
     results = [
         extract_company_data(item) for item in response_data.get("searchCandidates", [])
@@ -49,7 +91,7 @@ def company_list_search(query, update_local=False):
 
     # update the local company record and enable monitoring
     if update_local and "duns_number" in query and len(results) == 1:
-        update_company_and_enable_monitoring(response_data["searchCandidates"][0])
+        schedule_company_update(response_data["searchCandidates"][0], wait=wait_for_update)
 
     return {
         "total_matches": response_data.get("candidatesMatchedQuantity", 0),
@@ -60,7 +102,7 @@ def company_list_search(query, update_local=False):
     }
 
 
-def company_list_request_v2(query):
+def company_list_request_v2(query, use_cache=True):
     """
     Request logic for company_list_search_v2()
     """
@@ -77,8 +119,8 @@ def company_list_request_v2(query):
     }
 
     try:
-        response = api_request(
-            "GET", DNB_COMPANY_SEARCH_ENDPOINT_V2, params=mapped_query
+        return _cached_api_request(
+            "GET", DNB_COMPANY_SEARCH_ENDPOINT_V2, use_cache, params=mapped_query
         )
     except HTTPError as ex:
         logger.exception("HTTP error occurred")
@@ -86,8 +128,6 @@ def company_list_request_v2(query):
             return {}
         else:
             raise
-    else:
-        return response.json()
 
 
 def company_by_duns(duns):
@@ -107,7 +147,97 @@ def company_by_duns(duns):
         return response.json()
 
 
-def company_list_search_v2(query, update_local=False):
+def get_fresh_local_companies(duns_numbers):
+    """
+    Returns the local companies, by duns number, whose D&B data can be used instead of calling DNB.
+
+    The company must be monitored, so that D&B changes reach it.  Its source must be the full cmpelk company data,
+    from the data/duns endpoint or a monitoring update rather than a search candidate, and must have been fetched
+    from D&B within `settings.DNB_LOCAL_COMPANY_MAX_AGE_SECONDS`.
+    """
+    max_age = settings.DNB_LOCAL_COMPANY_MAX_AGE_SECONDS
+
+    if not max_age:
+        return {}
+
+    companies = Company.objects.filter(
+        duns_number__in=duns_numbers,
+        monitoring_status=MonitoringStatusChoices.enabled.name,
+        source__has_key="organization",
+        source_fetched_timestamp__gte=timezone.now() - timedelta(seconds=max_age),
+    ).exclude(
+        source__has_key="displaySequence",
+    )
+
+    return {company.duns_number: company for company in companies}
+
+
+def get_fresh_local_company(duns_number):
+    """
+    Returns the local company with `duns_number` if its D&B data can be used instead of calling DNB, otherwise None.
+
+    See `get_fresh_local_companies`.
+    """
+    return get_fresh_local_companies([duns_number]).get(duns_number)
+
+
+def _company_bulk_error(ex):
+    if isinstance(ex, HTTPError):
+        return {"status_code": ex.response.status_code, "detail": str(ex)}
+
+    if isinstance(ex, DNBApiError):
+        return {"status_code": getattr(ex, "status_code", 502), "detail": str(ex)}
+
+    raise ex
+
+
+def company_bulk_search(duns_numbers, update_local=False, wait_for_update=False):
+    """
+    Returns the company for each of `duns_numbers`, in order, as `{"duns_number": ..., "company": {...}}`, or
+    `{"duns_number": ..., "error": {"status_code": ..., "detail": ...}}` if it could not be retrieved.
+
+    Companies are answered from local data when it is fresh enough, see `get_fresh_local_companies`; the rest are
+    requested from DNB concurrently, within the shared rate limit.  With `update_local=True` the companies
+    requested from DNB are saved locally, as for `company_list_search_v2`.
+    """
+    duns_numbers = list(dict.fromkeys(duns_numbers))
+
+    local_companies = get_fresh_local_companies(duns_numbers)
+    remote_duns_numbers = [duns_number for duns_number in duns_numbers if duns_number not in local_companies]
+
+    remote_companies = dict(zip(
+        remote_duns_numbers,
+        map_concurrently(company_by_duns, remote_duns_numbers, return_exceptions=True),
+    ))
+
+    results = []
+
+    for duns_number in duns_numbers:
+        if duns_number in local_companies:
+            results.append({
+                "duns_number": duns_number,
+                "company": extract_company_data(local_companies[duns_number].source),
+            })
+            continue
+
+        company = remote_companies[duns_number]
+
+        if isinstance(company, Exception):
+            results.append({"duns_number": duns_number, "error": _company_bulk_error(company)})
+        elif not company:
+            results.append({"duns_number": duns_number, "error": {"status_code": 404, "detail": "Not found"}})
+        else:
+            if update_local:
+                schedule_company_update(company, wait=wait_for_update)
+
+            results.append({"duns_number": duns_number, "company": extract_company_data(company)})
+
+    return {
+        "results": results,
+    }
+
+
+def company_list_search_v2(query, update_local=False, use_cache=True, wait_for_update=False):
     """
     Tries to return the best match for the search terms using the DNB Direct+ cleanseMatch endpoint
 
@@ -115,12 +245,16 @@ def company_list_search_v2(query, update_local=False):
 
     some query parameters are accepted but ignored as they are no longer applicable to v2, see `DEPRECATED_SEARCH_QUERY_PARAMS_V2` in constants.py
 
+    with `update_local=True` a single duns number match is answered from the local company when it is fresh enough,
+    see `get_fresh_local_company`; otherwise the company is requested from DNB and the local copy updated in the
+    background, or before returning with `wait_for_update=True`.
+
     only a subset of fields are extracted and mapped to a local format.
 
     Documentation for the DNB api call is available here:
     https://directplus.documentation.dnb.com/openAPI.html?apiID=IDRCleanseMatch
     """
-    response_data = company_list_request_v2(query)
+    response_data = company_list_request_v2(query, use_cache=use_cache)
     results = [
         extract_company_data(item) for item in response_data.get("matchCandidates", [])
     ]
@@ -128,8 +262,15 @@ def company_list_search_v2(query, update_local=False):
     # update the local company record with up to date information and enable monitoring
     if update_local and "duns_number" in query and len(results) == 1:
         duns_number = query["duns_number"]
+
+        local_company = get_fresh_local_company(duns_number)
+        if local_company:
+            return {
+                "results": [extract_company_data(local_company.source)],
+            }
+
         company = company_by_duns(duns_number)
-        update_company_and_enable_monitoring(company)
+        schedule_company_update(company, wait=wait_for_update)
         results = [extract_company_data(company)]
 
         return {
@@ -195,19 +336,107 @@ def company_hierarchy_api_request(url):
             raise
 
 
-def company_hierarchy_list_search(query):
+def _get_hierarchy_page_size(response_data):
+    """Return the page size of a family tree response"""
+
+    page_size = response_data.get("inquiryDetail", {}).get("page[size]")
+
+    if not page_size:
+        self_url = response_data.get("links", {}).get("self", "")
+        page_size = dict(parse_qsl(urlparse(self_url).query)).get("page[size]")
+
+    return int(page_size) if page_size else None
+
+
+def _get_hierarchy_page_count(response_data):
+    """Return the number of pages in a family tree from its first page: as many as the member count needs, but
+    no more than the number of the `last` page.  Returns None if it is not known."""
+
+    page_counts = []
+
+    page_size = _get_hierarchy_page_size(response_data)
+    members_count = response_data.get("globalUltimateFamilyTreeMembersCount")
+
+    if page_size and members_count:
+        page_counts.append(math.ceil(members_count / page_size))
+
+    last_url = response_data.get("links", {}).get("last", "")
+    last_page_number = dict(parse_qsl(urlparse(last_url).query)).get("page[number]")
+
+    if last_page_number:
+        page_counts.append(int(last_page_number))
+
+    return min(page_counts, default=None)
+
+
+def _get_hierarchy_page_urls(response_data):
     """
-    Returns the full hierarchy for a specific duns number.
+    Work out the urls of the remaining pages of a family tree from the first page, see
+    `_get_hierarchy_page_count`.
 
-    Documentation for the DNB api call is available here:
-    https://directplus.documentation.dnb.com/html/resources/JSONSample_FamTree.html
+    Returns None if the urls cannot be predicted.
     """
-    response_data = company_hierarchy_list_initial_request(query)
+    next_url = response_data.get("links", {}).get("next")
 
-    if not response_data:
-        return {"family_tree_members": []}
+    if not next_url:
+        return []
 
-    company_hierarchy = {
+    page_count = _get_hierarchy_page_count(response_data)
+
+    parsed_url = urlparse(next_url)
+    query = dict(parse_qsl(parsed_url.query))
+
+    if not page_count or "page[number]" not in query:
+        return None
+
+    return [
+        parsed_url._replace(query=urlencode({**query, "page[number]": page_number})).geturl()
+        for page_number in range(2, page_count + 1)
+    ]
+
+
+def iter_company_hierarchy_pages(response_data):
+    """
+    Yield each page of a family tree in order, starting with the first page `response_data`.
+
+    When the page urls can be predicted the pages are fetched concurrently, `settings.DNB_API_MAX_CONCURRENCY`
+    at a time; otherwise, or if there turn out to be more pages than predicted, the `next` links are followed.
+
+    :raises DNBApiUnavailableError: if a page that the previous page links to is not found
+    """
+    yield response_data
+
+    last_page = response_data
+    page_urls = _get_hierarchy_page_urls(response_data) or []
+    window = settings.DNB_API_MAX_CONCURRENCY
+
+    for start in range(0, len(page_urls), window):
+        window_urls = page_urls[start:start + window]
+
+        for url, page in zip(window_urls, map_concurrently(company_hierarchy_api_request, window_urls)):
+            # the member count can overestimate the number of pages, but a page that the previous page links
+            # to must be found
+            if not page and "next" in last_page.get("links", {}):
+                raise DNBApiUnavailableError(f"Family tree page {url} could not be retrieved")
+
+            if not page:
+                return
+
+            yield page
+            last_page = page
+
+    while "next" in last_page.get("links", {}):
+        url = last_page["links"]["next"]
+        last_page = company_hierarchy_api_request(url)
+
+        if not last_page:
+            raise DNBApiUnavailableError(f"Family tree page {url} could not be retrieved")
+
+        yield last_page
+
+
+def _company_hierarchy_summary(response_data):
+    return {
         "global_ultimate_duns": response_data["globalUltimateDuns"],
         "global_ultimate_family_tree_members_count": response_data[
             "globalUltimateFamilyTreeMembersCount"
@@ -215,24 +444,143 @@ def company_hierarchy_list_search(query):
         "branches_excluded_members_count": response_data[
             "branchesExcludedMembersCount"
         ],
-        "family_tree_members": response_data["familyTreeMembers"],
     }
 
-    is_next = "next" in response_data["links"]
 
-    while is_next:
-        response_data = company_hierarchy_api_request(response_data["links"]["next"])
-        for familyTreeMember in response_data["familyTreeMembers"]:
-            company_hierarchy["family_tree_members"].append(familyTreeMember)
-        is_next = "next" in response_data["links"]
+def get_local_family_tree(duns_number):
+    """
+    Returns the stored family tree that includes `duns_number`, or None if there isn't one recent enough to use.
+
+    Trees older than `settings.DNB_FAMILY_TREE_MAX_AGE_SECONDS` are still returned, but a refresh from DNB is
+    scheduled in the background; trees older than `settings.DNB_FAMILY_TREE_MAX_STALE_SECONDS` are not used.
+    """
+    # a company that has moved to another family tree can still be a member of an older stored tree
+    family_tree = FamilyTree.objects.filter(
+        member_duns_numbers__contains=[duns_number],
+    ).order_by("-last_refreshed").first()
+
+    if not family_tree:
+        return None
+
+    age = (timezone.now() - family_tree.last_refreshed).total_seconds()
+
+    if age > settings.DNB_FAMILY_TREE_MAX_STALE_SECONDS:
+        return None
+
+    if age > settings.DNB_FAMILY_TREE_MAX_AGE_SECONDS:
+        # only schedule one refresh of a tree at a time
+        refresh_key = FAMILY_TREE_REFRESH_KEY.format(family_tree.global_ultimate_duns)
+        if redis_client.set(refresh_key, 1, nx=True, ex=FAMILY_TREE_REFRESH_LOCK_SECONDS):
+            refresh_family_tree.delay(family_tree.global_ultimate_duns)
+
+    return family_tree
+
+
+def store_family_tree(company_hierarchy):
+    """
+    Store the family tree returned by `company_hierarchy_list_search` so later requests can be served locally.
+    """
+    members = company_hierarchy["family_tree_members"]
+    global_ultimate_duns = company_hierarchy["global_ultimate_duns"]
+
+    FamilyTree.objects.update_or_create(
+        global_ultimate_duns=global_ultimate_duns,
+        defaults={
+            "global_ultimate_family_tree_members_count": company_hierarchy[
+                "global_ultimate_family_tree_members_count"
+            ],
+            "branches_excluded_members_count": company_hierarchy["branches_excluded_members_count"],
+            "family_tree_members": members,
+            "member_duns_numbers": sorted({global_ultimate_duns, *(member["duns"] for member in members)}),
+            "last_refreshed": timezone.now(),
+        },
+    )
+
+
+def _local_company_hierarchy_summary(family_tree):
+    return {
+        "global_ultimate_duns": family_tree.global_ultimate_duns,
+        "global_ultimate_family_tree_members_count": family_tree.global_ultimate_family_tree_members_count,
+        "branches_excluded_members_count": family_tree.branches_excluded_members_count,
+    }
+
+
+def company_hierarchy_list_search(query, use_local=True):
+    """
+    Returns the full hierarchy for a specific duns number.
+
+    The hierarchy is returned from the local family tree store when it holds a recent enough copy, see
+    `get_local_family_tree`; otherwise it is requested from DNB and stored.  Pass `use_local=False` to
+    always request the hierarchy from DNB.
+
+    Documentation for the DNB api call is available here:
+    https://directplus.documentation.dnb.com/html/resources/JSONSample_FamTree.html
+    """
+    family_tree = get_local_family_tree(query["duns_number"]) if use_local else None
+
+    if family_tree:
+        return {
+            **_local_company_hierarchy_summary(family_tree),
+            "family_tree_members": family_tree.family_tree_members,
+        }
+
+    response_data = company_hierarchy_list_initial_request(query)
+
+    if not response_data:
+        return {"family_tree_members": []}
+
+    company_hierarchy = {
+        **_company_hierarchy_summary(response_data),
+        "family_tree_members": [],
+    }
+
+    for page in iter_company_hierarchy_pages(response_data):
+        company_hierarchy["family_tree_members"].extend(page["familyTreeMembers"])
+
+    store_family_tree(company_hierarchy)
 
     return company_hierarchy
 
 
-def company_hierarchy_count(query):
+def company_hierarchy_list_stream(query, use_local=True):
+    """
+    Returns the hierarchy for a specific duns number as a summary and an iterator of family tree members.
+
+    Only the first page is requested up front; the remaining pages are requested as the iterator is consumed,
+    so members can be sent on before the whole tree has been retrieved.  Streamed trees are not stored, but
+    a stored tree is used when there is one, as for `company_hierarchy_list_search`.
+
+    If DNB has no hierarchy for the duns number the summary is empty and there are no members, matching the
+    empty result of `company_hierarchy_list_search`.
+    """
+    family_tree = get_local_family_tree(query["duns_number"]) if use_local else None
+
+    if family_tree:
+        return _local_company_hierarchy_summary(family_tree), iter(family_tree.family_tree_members)
+
+    response_data = company_hierarchy_list_initial_request(query)
+
+    if not response_data:
+        return {}, iter([])
+
+    def _iter_members():
+        for page in iter_company_hierarchy_pages(response_data):
+            yield from page["familyTreeMembers"]
+
+    return _company_hierarchy_summary(response_data), _iter_members()
+
+
+def company_hierarchy_count(query, use_local=True):
     """
     Returns the count of companies for the duns number in the hierarchy
+
+    The count is taken from the local family tree store when it holds a recent enough copy.
     """
+    family_tree = get_local_family_tree(query["duns_number"]) if use_local else None
+
+    if family_tree:
+        return family_tree.global_ultimate_family_tree_members_count
+
     response_data = company_hierarchy_count_request(query)
 
     if not response_data:
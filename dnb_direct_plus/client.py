@@ -1,12 +1,25 @@
+import asyncio
+import contextvars
+import hashlib
+import json
 import logging
+import os
+import threading
 import time
-from urllib.parse import urljoin
+from collections import defaultdict, deque
+from concurrent.futures import as_completed, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from urllib.parse import urljoin, urlparse
 
 import backoff
 import redis
 import requests
 from django.conf import settings
-from prometheus_client import Counter
+from django.db import connections
+from prometheus_client import Counter, Gauge
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError
+from urllib3.util.retry import Retry
 
 DNB_API_BASE_URL = "https://plus.dnb.com"
 DNB_AUTH_ENDPOINT = "/v2/token"
@@ -17,6 +30,57 @@ ACCESS_TOKEN_LOCK_EXPIRY_SECONDS = 5
 RENEW_ACCESS_TOKEN_MAX_ATTEMPTS = 5
 RENEW_ACCESS_TOKEN_RETRY_DELAY_SECONDS = 1
 
+RATE_LIMIT_KEY = "_rate_limit:{}"
+
+CIRCUIT_FAILURES_KEY = "_circuit:{}:failures"
+CIRCUIT_OPEN_KEY = "_circuit:{}:open"
+CIRCUIT_TRIPPED_KEY = "_circuit:{}:tripped"
+CIRCUIT_PROBE_KEY = "_circuit:{}:probe"
+CIRCUIT_TRIPPED_EXPIRY_SECONDS = 24 * 60 * 60
+
+HEDGE_LATENCY_SAMPLES = 200
+
+RESPONSE_CACHE_KEY = "_response_cache:{}:{}"
+
+CIRCUIT_CLOSED = 0
+CIRCUIT_HALF_OPEN = 1
+CIRCUIT_OPEN = 2
+
+# endpoints that have their own rate limit budget; paths are matched by prefix, so
+# /v1/data/duns/123456789 is accounted against /v1/data/duns
+DNB_API_ENDPOINTS = [
+    DNB_AUTH_ENDPOINT,
+    "/v1/search/companyList",
+    "/v1/match/cleanseMatch",
+    "/v1/data/duns",
+    "/v1/familyTree",
+    "/v1/monitoring",
+]
+
+# Token bucket held in redis so that the budget is shared by every web and celery worker.
+# Returns [allowed, seconds to wait for the next token, tokens remaining]
+RATE_LIMIT_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(state[1]) or capacity
+local timestamp = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(wait), tostring(tokens)}
+"""
+
 logger = logging.getLogger(__name__)
 
 redis_client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
@@ -25,13 +89,196 @@ api_usage_counter = Counter(
     "api_counter", "Track DNB API calls", ["endpoint", "method", "status"]
 )
 
+api_cache_counter = Counter(
+    "api_cache_counter", "Track DNB API responses served from the cache", ["endpoint", "result"]
+)
+
+api_rate_limit_tokens_gauge = Gauge(
+    "api_rate_limit_tokens",
+    "Requests that can be made to a DNB API endpoint before the shared rate limit is reached",
+    ["endpoint"],
+)
+
+api_rate_limit_wait_counter = Counter(
+    "api_rate_limit_wait_counter",
+    "Track DNB API calls delayed or rejected by the shared rate limit",
+    ["endpoint", "outcome"],
+)
+
+api_circuit_state_gauge = Gauge(
+    "api_circuit_state",
+    "State of the circuit breaker for a DNB API endpoint (0 = closed, 1 = half open, 2 = open)",
+    ["endpoint"],
+)
+
+api_hedge_counter = Counter(
+    "api_hedge_counter",
+    "Track hedged DNB API calls and which request answered first",
+    ["endpoint", "winner"],
+)
+
+api_connection_pool_connections_gauge = Gauge(
+    "api_connection_pool_connections",
+    "Number of connections opened to the DNB API by this process's connection pool",
+)
+
+api_connection_pool_requests_gauge = Gauge(
+    "api_connection_pool_requests",
+    "Number of requests sent to the DNB API over this process's connection pool",
+)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+_hedge_executor = None
+_hedge_executor_pid = None
+
+# recent response times for each endpoint, used to decide when to send a hedged request
+_latencies = defaultdict(lambda: deque(maxlen=HEDGE_LATENCY_SAMPLES))
+
+# monotonic time by which DNB api calls made in the current context must complete, see `deadline`
+_deadline = contextvars.ContextVar("dnb_api_deadline", default=None)
+
+# process-local copy of the access token held in redis: (token, monotonic time after which redis is consulted again)
+_cached_token = (None, 0)
+
+
+rate_limit_script = redis_client.register_script(RATE_LIMIT_SCRIPT)
+
 
 class DNBApiError(Exception):
     pass
 
 
+class DNBApiUnavailableError(DNBApiError):
+    """The DNB api was not called because it is not able to serve the request in time."""
+
+    status_code = 503
+
+
+class DNBApiRateLimitError(DNBApiUnavailableError):
+    status_code = 429
+
+
+class DNBApiCircuitOpenError(DNBApiUnavailableError):
+    pass
+
+
+class DNBApiTimeoutError(DNBApiUnavailableError):
+    status_code = 504
+
+
+@contextmanager
+def deadline(seconds):
+    """Limit the total time that DNB api calls made within the block may take, including retries,
+    waiting for the rate limit and token renewal.  Nested deadlines can only shorten the budget."""
+
+    expires_at = time.monotonic() + seconds
+
+    current = _deadline.get()
+    if current is not None:
+        expires_at = min(expires_at, current)
+
+    token = _deadline.set(expires_at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def get_remaining_time():
+    """Return the seconds left before the current deadline, or None if there is no deadline"""
+
+    expires_at = _deadline.get()
+
+    if expires_at is None:
+        return None
+
+    return max(0, expires_at - time.monotonic())
+
+
+def _get_max_retry_time():
+    """Return the maximum time `_api_request` may spend retrying"""
+
+    remaining = get_remaining_time()
+
+    if remaining is None:
+        return settings.DNB_API_MAX_RETRY_SECONDS
+
+    return min(remaining, settings.DNB_API_MAX_RETRY_SECONDS)
+
+
+def get_timeout(endpoint):
+    """Return the (connect, read) timeout for an endpoint, see `settings.DNB_API_TIMEOUTS`"""
+
+    connect_timeout, read_timeout = settings.DNB_API_TIMEOUTS.get(
+        endpoint, (settings.DNB_API_CONNECT_TIMEOUT_SECONDS, settings.DNB_API_READ_TIMEOUT_SECONDS),
+    )
+
+    return connect_timeout, read_timeout
+
+
+def get_endpoint_name(path):
+    """Return the endpoint a request path or url belongs to, see `DNB_API_ENDPOINTS`"""
+
+    url_path = urlparse(urljoin(DNB_API_BASE_URL, path)).path
+
+    for endpoint in DNB_API_ENDPOINTS:
+        if url_path.startswith(endpoint):
+            return endpoint
+
+    return url_path
+
+
+def wait_for_rate_limit(endpoint, max_wait=None):
+    """Block until the endpoint's shared rate limit allows another request.
+
+    Limits are requests per second, see `settings.DNB_API_RATE_LIMITS` and
+    `settings.DNB_API_DEFAULT_RATE_LIMIT`; a limit of 0 disables rate limiting for the endpoint.
+
+    :raises DNBApiRateLimitError: if capacity is not available within `max_wait` seconds
+    """
+
+    rate = settings.DNB_API_RATE_LIMITS.get(endpoint, settings.DNB_API_DEFAULT_RATE_LIMIT)
+
+    if not rate:
+        return
+
+    if max_wait is None:
+        max_wait = settings.DNB_API_RATE_LIMIT_MAX_WAIT_SECONDS
+
+    give_up_at = time.monotonic() + max_wait
+
+    while True:
+        allowed, wait, tokens = rate_limit_script(
+            keys=[RATE_LIMIT_KEY.format(endpoint)], args=[rate, max(rate, 1)],
+        )
+
+        api_rate_limit_tokens_gauge.labels(endpoint=endpoint).set(float(tokens))
+
+        if allowed:
+            return
+
+        wait = float(wait)
+
+        if time.monotonic() + wait > give_up_at:
+            api_rate_limit_wait_counter.labels(endpoint=endpoint, outcome="rejected").inc()
+            raise DNBApiRateLimitError(f"Rate limit for {endpoint} exceeded")
+
+        api_rate_limit_wait_counter.labels(endpoint=endpoint, outcome="delayed").inc()
+        time.sleep(wait)
+
+
 def get_access_token():
-    """Return an access token"""
+    """Return an access token
+
+    The token is served from a process-local cache until it is close to expiring; only then (or after
+    the token has been discarded following a 401) is redis consulted."""
+
+    token = _get_cached_token()
+    if token:
+        return token
 
     for i in range(RENEW_ACCESS_TOKEN_MAX_ATTEMPTS):
         if is_token_valid():
@@ -44,7 +291,53 @@ def get_access_token():
     else:
         raise DNBApiError("Failed to retrieve an access token")
 
-    return redis_client.get(ACCESS_TOKEN_KEY)
+    pipeline = redis_client.pipeline()
+    pipeline.get(ACCESS_TOKEN_KEY)
+    pipeline.ttl(ACCESS_TOKEN_KEY)
+    token, ttl = pipeline.execute()
+
+    _cache_token(token, ttl)
+
+    return token
+
+
+def _get_cached_token():
+    """Return the process-local access token if it is not close to expiring"""
+
+    token, refresh_at = _cached_token
+
+    if token and time.monotonic() < refresh_at:
+        return token
+
+    return None
+
+
+def _cache_token(token, ttl):
+    """Store the access token locally until it is due for renewal, see
+    `settings.DNB_API_RENEW_ACCESS_TOKEN_SECONDS_REMAINING`"""
+
+    global _cached_token
+
+    local_ttl = (ttl or 0) - settings.DNB_API_RENEW_ACCESS_TOKEN_SECONDS_REMAINING
+
+    if token and local_ttl > 0:
+        _cached_token = (token, time.monotonic() + local_ttl)
+    else:
+        _cached_token = (None, 0)
+
+
+def discard_access_token(token):
+    """Forget a token that the DNB api has rejected.
+
+    The token is removed from the local cache, and from redis if no other worker has renewed it yet,
+    so that the next call to `get_access_token` renews it."""
+
+    global _cached_token
+
+    _cached_token = (None, 0)
+
+    if token and redis_client.get(ACCESS_TOKEN_KEY) == token:
+        redis_client.delete(ACCESS_TOKEN_KEY)
 
 
 def is_token_valid():
@@ -109,20 +402,438 @@ def _renew_token():
     return False
 
 
+def _get_circuit(endpoint):
+    """Return the state of the circuit breaker for an endpoint and its current failure count"""
+
+    is_open, is_tripped, failures = redis_client.mget(
+        CIRCUIT_OPEN_KEY.format(endpoint), CIRCUIT_TRIPPED_KEY.format(endpoint), CIRCUIT_FAILURES_KEY.format(endpoint),
+    )
+    failures = int(failures or 0)
+
+    if is_open:
+        return CIRCUIT_OPEN, failures
+
+    if is_tripped:
+        return CIRCUIT_HALF_OPEN, failures
+
+    return CIRCUIT_CLOSED, failures
+
+
+def get_circuit_state(endpoint):
+    """Return the state of the circuit breaker for an endpoint.
+
+    The circuit is open for `settings.DNB_API_CIRCUIT_RESET_SECONDS` after it trips, after which it is
+    half open until a request to the endpoint succeeds (closing it) or fails (opening it again)."""
+
+    state, _ = _get_circuit(endpoint)
+
+    return state
+
+
+def check_circuit(endpoint):
+    """Check that a request can be made to an endpoint.
+
+    While the circuit is half open a single probe request is let through at a time.
+
+    :returns: the circuit state
+    :raises DNBApiCircuitOpenError: if the request should not be made
+    """
+
+    state, _ = _check_circuit(endpoint)
+
+    return state
+
+
+def _check_circuit(endpoint):
+    """As `check_circuit`, also returning the failure count, so that `record_success` can skip resetting it
+    when there is nothing to reset"""
+
+    state, failures = _get_circuit(endpoint)
+
+    api_circuit_state_gauge.labels(endpoint=endpoint).set(state)
+
+    if state == CIRCUIT_OPEN:
+        raise DNBApiCircuitOpenError(f"{endpoint} is unavailable")
+
+    if state == CIRCUIT_HALF_OPEN:
+        is_probe = redis_client.set(
+            CIRCUIT_PROBE_KEY.format(endpoint), 1, nx=True, ex=settings.DNB_API_CIRCUIT_RESET_SECONDS,
+        )
+        if not is_probe:
+            raise DNBApiCircuitOpenError(f"{endpoint} is unavailable")
+
+    return state, failures
+
+
+def release_probe(endpoint):
+    """Let another request probe a half open circuit, for when the probe claimed by `check_circuit` did not
+    reach the api"""
+
+    redis_client.delete(CIRCUIT_PROBE_KEY.format(endpoint))
+
+
+def record_success(endpoint, state=CIRCUIT_CLOSED, failures=None):
+    """Reset the failure count for an endpoint, closing the circuit if it was half open.
+
+    `failures` is the failure count when the circuit was checked, if known; a closed circuit with no failures
+    is left as it is, to save a redis call on every successful request."""
+
+    if state == CIRCUIT_CLOSED and failures == 0:
+        return
+
+    pipeline = redis_client.pipeline()
+    pipeline.delete(CIRCUIT_FAILURES_KEY.format(endpoint))
+
+    if state != CIRCUIT_CLOSED:
+        logger.info(f"{endpoint} has recovered; closing circuit")
+
+        pipeline.delete(CIRCUIT_TRIPPED_KEY.format(endpoint), CIRCUIT_PROBE_KEY.format(endpoint))
+        api_circuit_state_gauge.labels(endpoint=endpoint).set(CIRCUIT_CLOSED)
+
+    pipeline.execute()
+
+
+def record_failure(endpoint, state=CIRCUIT_CLOSED):
+    """Count a failed request to an endpoint, opening the circuit once
+    `settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD` failures occur within
+    `settings.DNB_API_CIRCUIT_FAILURE_WINDOW_SECONDS`, or if a probe request fails."""
+
+    failures_key = CIRCUIT_FAILURES_KEY.format(endpoint)
+
+    pipeline = redis_client.pipeline()
+    pipeline.incr(failures_key)
+    pipeline.expire(failures_key, settings.DNB_API_CIRCUIT_FAILURE_WINDOW_SECONDS)
+    failures, _ = pipeline.execute()
+
+    if state == CIRCUIT_HALF_OPEN or failures >= settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD:
+        logger.warning(f"{endpoint} is failing; opening circuit")
+
+        pipeline = redis_client.pipeline()
+        pipeline.set(CIRCUIT_OPEN_KEY.format(endpoint), 1, ex=settings.DNB_API_CIRCUIT_RESET_SECONDS)
+        pipeline.set(CIRCUIT_TRIPPED_KEY.format(endpoint), 1, ex=CIRCUIT_TRIPPED_EXPIRY_SECONDS)
+        pipeline.delete(failures_key, CIRCUIT_PROBE_KEY.format(endpoint))
+        pipeline.execute()
+
+        api_circuit_state_gauge.labels(endpoint=endpoint).set(CIRCUIT_OPEN)
+
+
+class ConnectionResetRetry(Retry):
+    """Retry a request once if its connection was closed or reset by the server, as happens when a pooled
+    keep-alive connection has been idle for longer than the server keeps it open.
+
+    Any other error, such as a timeout or a failure to connect, is raised straight away as it would be with
+    `max_retries=0` and left to the retries in `_api_request`."""
+
+    def __init__(self, **kwargs):
+        # every DNB request can be replayed: searches are POSTs and monitoring registrations are idempotent
+        kwargs.setdefault("allowed_methods", None)
+        super().__init__(**kwargs)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if not isinstance(error, ProtocolError):
+            return Retry(0, read=False).increment(method, url, response, error, _pool, _stacktrace)
+
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def _create_session():
+    """Create a requests session with a keep-alive connection pool for the DNB api.
+
+    Retries are handled by `_api_request` (see the backoff decorator) so the adapter only retries a request
+    whose pooled connection turned out to be stale, see `ConnectionResetRetry`; such a request never reached
+    the api, so it is not counted as a failure of the endpoint."""
+
+    adapter = HTTPAdapter(
+        pool_connections=settings.DNB_API_POOL_CONNECTIONS,
+        pool_maxsize=settings.DNB_API_POOL_MAXSIZE,
+        pool_block=settings.DNB_API_POOL_BLOCK,
+        max_retries=ConnectionResetRetry(total=1, connect=0, read=1, status=0, redirect=0, other=0),
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+def get_session():
+    """Return the DNB api session for the current process.
+
+    The session (and so its connection pool) is created lazily and recreated after a fork, so that
+    gunicorn and celery worker processes never share sockets inherited from their parent."""
+
+    global _session, _session_pid
+
+    pid = os.getpid()
+
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = _create_session()
+                _session_pid = pid
+
+    return _session
+
+
+def _get_connection_pool_stat(attribute):
+    """Sum a urllib3 connection pool statistic across the pools held by the current session"""
+
+    if _session is None or _session_pid != os.getpid():
+        return 0
+
+    pool_manager = _session.adapters["https://"].poolmanager
+
+    return sum(
+        getattr(pool_manager.pools[key], attribute, 0)
+        for key in list(pool_manager.pools.keys())
+    )
+
+
+api_connection_pool_connections_gauge.set_function(lambda: _get_connection_pool_stat("num_connections"))
+api_connection_pool_requests_gauge.set_function(lambda: _get_connection_pool_stat("num_requests"))
+
+
+def _get_hedge_executor():
+    """Return the thread pool used to send hedged requests for the current process"""
+
+    global _hedge_executor, _hedge_executor_pid
+
+    pid = os.getpid()
+
+    if _hedge_executor is None or _hedge_executor_pid != pid:
+        with _session_lock:
+            if _hedge_executor is None or _hedge_executor_pid != pid:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=settings.DNB_API_HEDGE_MAX_WORKERS, thread_name_prefix="dnb-api-hedge",
+                )
+                _hedge_executor_pid = pid
+
+    return _hedge_executor
+
+
+def _record_latency(endpoint, seconds):
+    _latencies[endpoint].append(seconds)
+
+
+def get_hedge_delay(endpoint):
+    """Return how long to wait for a response before sending a hedged request.
+
+    This is the `settings.DNB_API_HEDGE_PERCENTILE` percentile of recent response times for the endpoint,
+    or `settings.DNB_API_HEDGE_DEFAULT_DELAY_SECONDS` until enough responses have been seen."""
+
+    samples = sorted(_latencies[endpoint])
+
+    if len(samples) < settings.DNB_API_HEDGE_MIN_SAMPLES:
+        return settings.DNB_API_HEDGE_DEFAULT_DELAY_SECONDS
+
+    index = min(len(samples) - 1, int(len(samples) * settings.DNB_API_HEDGE_PERCENTILE / 100))
+
+    return max(samples[index], settings.DNB_API_HEDGE_MIN_DELAY_SECONDS)
+
+
+def _is_hedged(method, url):
+    """Only idempotent requests to endpoints listed in `settings.DNB_API_HEDGED_ENDPOINTS` are hedged"""
+
+    return method.upper() == "GET" and get_endpoint_name(url) in settings.DNB_API_HEDGED_ENDPOINTS
+
+
+def _hedged_api_request(method, url, **kwargs):
+    """Send a request and, if it has not been answered within the hedge delay, send a second identical
+    request; the first successful response is returned.
+
+    Both requests go through `_api_request`, so a hedge is counted against the rate limit like any other
+    request.  The slower request is left to complete in the background and its response is discarded."""
+
+    endpoint = get_endpoint_name(url)
+    executor = _get_hedge_executor()
+
+    primary = executor.submit(
+        contextvars.copy_context().run, _authenticated_api_request, method, url, **kwargs,
+    )
+
+    done, _ = wait([primary], timeout=get_hedge_delay(endpoint))
+    if done:
+        return primary.result()
+
+    hedge = executor.submit(
+        contextvars.copy_context().run, _authenticated_api_request, method, url, **kwargs,
+    )
+
+    first_exception = None
+
+    for future in as_completed([primary, hedge]):
+        try:
+            response = future.result()
+        except Exception as ex:  # noqa: B902
+            first_exception = first_exception or ex
+            continue
+
+        api_hedge_counter.labels(
+            endpoint=endpoint, winner="primary" if future is primary else "hedge",
+        ).inc()
+
+        return response
+
+    api_hedge_counter.labels(endpoint=endpoint, winner="none").inc()
+
+    raise first_exception
+
+
 def api_request(method, url, **kwargs):
     """
     Make an authenticated request to the DNB api
+
+    If the api rejects the access token with a 401 the token is discarded and the request is retried
+    once with a fresh token.
+
+    Requests to the endpoints in `settings.DNB_API_HEDGED_ENDPOINTS` are hedged, see `_hedged_api_request`.
+
+    :raises DNBApiTimeoutError: if the api did not respond in time, or the current `deadline` has passed
+    :raises DNBApiUnavailableError: if the api could not be reached
     """
+    try:
+        if _is_hedged(method, url):
+            return _hedged_api_request(method, url, **kwargs)
+
+        return _authenticated_api_request(method, url, **kwargs)
+    except requests.exceptions.Timeout as ex:
+        raise DNBApiTimeoutError(f"{get_endpoint_name(url)} timed out") from ex
+    except requests.exceptions.ConnectionError as ex:
+        raise DNBApiUnavailableError(f"{get_endpoint_name(url)} could not be reached") from ex
+
+
+def _authenticated_api_request(method, url, **kwargs):
+    token = get_access_token()
+
+    try:
+        return _api_request(method, url, **kwargs, headers={"Authorization": f"Bearer {token}"})
+    except requests.exceptions.HTTPError as ex:
+        if ex.response is None or ex.response.status_code != 401:
+            raise
+
+    logger.info("access token was rejected; renewing")
+    discard_access_token(token)
+
     token = get_access_token()
 
-    headers = {"Authorization": f"Bearer {token}"}
-    return _api_request(method, url, **kwargs, headers=headers)
+    return _api_request(method, url, **kwargs, headers={"Authorization": f"Bearer {token}"})
+
+
+def get_response_cache_key(method, url, **kwargs):
+    """
+    Return the redis key used to cache the response to a request.
+
+    The key is a digest of the method, url and query (`json` or `params`), with dictionary keys sorted so
+    that equivalent queries share an entry.
+    """
+    request = json.dumps([method.upper(), url, kwargs], sort_keys=True, default=str)
+    digest = hashlib.sha256(request.encode()).hexdigest()
+
+    return RESPONSE_CACHE_KEY.format(get_endpoint_name(url), digest)
+
+
+def get_cached_response(method, url, **kwargs):
+    """
+    Return the cached JSON response to a request, or None if it is not cached.
+
+    Responses are only cached while `settings.DNB_API_SEARCH_CACHE_TTL_SECONDS` is set, see `cache_response`.
+    """
+    if not settings.DNB_API_SEARCH_CACHE_TTL_SECONDS:
+        return None
+
+    endpoint = get_endpoint_name(url)
+    cached = redis_client.get(get_response_cache_key(method, url, **kwargs))
+
+    if cached is None:
+        api_cache_counter.labels(endpoint=endpoint, result="miss").inc()
+        return None
+
+    api_cache_counter.labels(endpoint=endpoint, result="hit").inc()
+
+    return json.loads(cached)
+
+
+def cache_response(response_data, method, url, **kwargs):
+    """
+    Cache the JSON response to a request for `settings.DNB_API_SEARCH_CACHE_TTL_SECONDS`.
+
+    Responses larger than `settings.DNB_API_SEARCH_CACHE_MAX_BYTES` once encoded are not cached.
+    """
+    ttl = settings.DNB_API_SEARCH_CACHE_TTL_SECONDS
+
+    if not ttl:
+        return
+
+    encoded = json.dumps(response_data)
+
+    if len(encoded) > settings.DNB_API_SEARCH_CACHE_MAX_BYTES:
+        api_cache_counter.labels(endpoint=get_endpoint_name(url), result="too_large").inc()
+        return
+
+    redis_client.set(get_response_cache_key(method, url, **kwargs), encoded, ex=ttl)
+
+
+async def async_api_request(method, url, **kwargs):
+    """
+    Make an authenticated request to the DNB api from a coroutine.
+
+    The request is made by `api_request` in a worker thread, so token handling, rate limiting,
+    the circuit breaker, retries, deadlines and metrics are shared with the synchronous client.
+    """
+    return await asyncio.to_thread(api_request, method, url, **kwargs)
+
+
+def _call_in_thread(func, item):
+    try:
+        return func(item)
+    finally:
+        # worker threads get their own database connections; don't leave them open
+        connections.close_all()
+
+
+async def async_map(func, items, max_concurrency=None, return_exceptions=False):
+    """Call `func` for each item with at most `max_concurrency` calls in flight at once
+    (default `settings.DNB_API_MAX_CONCURRENCY`).
+
+    `func` is a synchronous function making DNB api calls, e.g. `company_by_duns`.  Results are returned
+    in the same order as `items`; if `return_exceptions` is True exceptions are returned in place of
+    results rather than raised."""
+
+    semaphore = asyncio.Semaphore(max_concurrency or settings.DNB_API_MAX_CONCURRENCY)
+
+    async def _call(item):
+        async with semaphore:
+            return await asyncio.to_thread(_call_in_thread, func, item)
+
+    return await asyncio.gather(
+        *(_call(item) for item in items), return_exceptions=return_exceptions,
+    )
+
+
+def map_concurrently(func, items, max_concurrency=None, return_exceptions=False):
+    """Synchronous wrapper for `async_map`, for use outside of an event loop"""
+
+    items = list(items)
+
+    if len(items) <= 1:
+        results = []
+        for item in items:
+            try:
+                results.append(func(item))
+            except Exception as ex:  # noqa: B902
+                if not return_exceptions:
+                    raise
+                results.append(ex)
+        return results
+
+    return asyncio.run(async_map(func, items, max_concurrency, return_exceptions))
 
 
 def _fatal_code(e):
     """Return True if an exception/status should not be retried."""
     retryable = (
-        not hasattr(e, "response")
+        getattr(e, "response", None) is None
         or e.response.status_code in [429]
         or 500 <= e.response.status_code <= 599
     )
@@ -130,6 +841,41 @@ def _fatal_code(e):
     return not retryable
 
 
+def _get_remaining_time_for(endpoint):
+    """Return what is left of the current deadline, or None if there isn't one; raises DNBApiTimeoutError if
+    it has been used up"""
+
+    remaining = get_remaining_time()
+
+    if remaining is not None and remaining <= 0:
+        raise DNBApiTimeoutError(f"Deadline for {endpoint} exceeded")
+
+    return remaining
+
+
+def _get_rate_limit_wait(endpoint):
+    """Return the longest rate limit wait for a request to an endpoint, within the current deadline"""
+
+    max_wait = settings.DNB_API_RATE_LIMIT_MAX_WAIT_SECONDS
+    remaining = _get_remaining_time_for(endpoint)
+
+    return max_wait if remaining is None else min(max_wait, remaining)
+
+
+def _get_request_timeout(endpoint):
+    """Return the (connect, read) timeouts for a request to an endpoint; together they must fit within whatever
+    is left of the current deadline, so this is called after any rate limit wait"""
+
+    connect_timeout, read_timeout = get_timeout(endpoint)
+    remaining = _get_remaining_time_for(endpoint)
+
+    if remaining is not None and connect_timeout + read_timeout > remaining:
+        connect_timeout = min(connect_timeout, remaining / 2)
+        read_timeout = remaining - connect_timeout
+
+    return connect_timeout, read_timeout
+
+
 @backoff.on_exception(
     backoff.expo,
     (
@@ -138,6 +884,7 @@ def _fatal_code(e):
         requests.exceptions.HTTPError
     ),
     giveup=_fatal_code,
+    max_time=_get_max_retry_time,
     logger=logger,
 )
 def _api_request(method, path, **kwargs):
@@ -155,7 +902,43 @@ def _api_request(method, path, **kwargs):
         headers["content-type"] = "application/json"
 
     headers.update(kwargs.pop("headers", {}))
-    response = requests.request(method, url, headers=headers, **kwargs)
+
+    endpoint = get_endpoint_name(path)
+
+    max_wait = _get_rate_limit_wait(endpoint)
+
+    circuit_state, circuit_failures = _check_circuit(endpoint)
+
+    try:
+        wait_for_rate_limit(endpoint, max_wait=max_wait)
+        # the wait uses up some of the deadline, so the timeouts are worked out after it
+        timeout = _get_request_timeout(endpoint)
+    except (DNBApiRateLimitError, DNBApiTimeoutError):
+        if circuit_state == CIRCUIT_HALF_OPEN:
+            release_probe(endpoint)
+        raise
+
+    kwargs.setdefault("timeout", timeout)
+
+    started = time.monotonic()
+
+    try:
+        response = get_session().request(method, url, headers=headers, **kwargs)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as ex:
+        if get_remaining_time() == 0:
+            # the request was cut short by the caller's deadline, not by the api being unhealthy
+            if circuit_state == CIRCUIT_HALF_OPEN:
+                release_probe(endpoint)
+            raise DNBApiTimeoutError(f"Deadline for {endpoint} exceeded") from ex
+
+        record_failure(endpoint, circuit_state)
+        raise
+
+    if response.status_code >= 500:
+        record_failure(endpoint, circuit_state)
+    else:
+        record_success(endpoint, circuit_state, circuit_failures)
+        _record_latency(endpoint, time.monotonic() - started)
 
     api_usage_counter.labels(
         endpoint=path, method=method, status=response.status_code
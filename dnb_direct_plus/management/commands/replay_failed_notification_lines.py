@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from dnb_direct_plus.monitoring import replay_failed_notification_lines
+
+
+class Command(BaseCommand):
+    help = 'Apply the lines of DNB monitoring notification files that failed with an exception again'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file-name', type=str, help='Only replay the failed lines of this file.')
+
+    def handle(self, *args, **options):
+        total, total_failed = replay_failed_notification_lines(options['file_name'])
+
+        self.stdout.write(self.style.SUCCESS(f'Replayed: {total}; failed again: {total_failed}'))
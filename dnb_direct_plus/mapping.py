@@ -1,3 +1,6 @@
+import hashlib
+import json
+
 from company.constants import LegalStatusChoices
 from .constants import (
     INFORMATION_SCOPE_CONSOLIDATED,
@@ -221,3 +224,11 @@ def extract_company_data(company_data):
 
     return company
 
+
+def get_company_data_hash(company_data):
+    """A stable hash of company data extracted by `extract_company_data`, used to detect updates that
+    don't change a company"""
+
+    encoded = json.dumps(company_data, sort_keys=True, default=str)
+
+    return hashlib.sha256(encoded.encode()).hexdigest()
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-17 11:52
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dnb_direct_plus', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FamilyTree',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('global_ultimate_duns', models.CharField(max_length=9, unique=True)),
+                ('global_ultimate_family_tree_members_count', models.PositiveIntegerField()),
+                ('branches_excluded_members_count', models.PositiveIntegerField()),
+                ('family_tree_members', models.JSONField()),
+                ('member_duns_numbers', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=9), size=None)),
+                ('last_refreshed', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['member_duns_numbers'], name='dnb_direct__member__8b8c2e_gin')],
+            },
+        ),
+    ]
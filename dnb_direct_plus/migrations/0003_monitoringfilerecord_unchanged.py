@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dnb_direct_plus', '0002_familytree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monitoringfilerecord',
+            name='unchanged',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dnb_direct_plus', '0003_monitoringfilerecord_unchanged'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonitoringFileProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=255)),
+                ('shard', models.PositiveIntegerField(default=0)),
+                ('shards', models.PositiveIntegerField(default=1)),
+                ('last_line_number', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('success', models.PositiveIntegerField(default=0)),
+                ('unchanged', models.PositiveIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('file_name', 'shard', 'shards'), name='unique_monitoring_file_progress')],
+            },
+        ),
+    ]
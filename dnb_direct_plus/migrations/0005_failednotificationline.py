@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dnb_direct_plus', '0004_monitoringfileprogress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FailedNotificationLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('file_name', models.CharField(max_length=255)),
+                ('line_number', models.PositiveIntegerField()),
+                ('reason', models.TextField()),
+                ('update_data', models.JSONField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('file_name', 'line_number'), name='unique_failed_notification_line')],
+            },
+        ),
+    ]
@@ -1,3 +1,5 @@
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 
 
@@ -8,6 +10,68 @@ class MonitoringFileRecord(models.Model):
     file_name = models.CharField(max_length=255, unique=True)
     total = models.PositiveIntegerField()
     failed = models.PositiveIntegerField()
+    # updates that were applied but did not change the company
+    unchanged = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.file_name
+
+
+class MonitoringFileProgress(models.Model):
+    """This model records how far through a monitoring notification file, or one shard of it,
+    processing has got.  It is saved with each batch of lines, so that processing can resume
+    from there if it is interrupted, and removed once the file has been recorded as processed."""
+    file_name = models.CharField(max_length=255)
+    shard = models.PositiveIntegerField(default=0)
+    shards = models.PositiveIntegerField(default=1)
+    last_line_number = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    success = models.PositiveIntegerField(default=0)
+    unchanged = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file_name', 'shard', 'shards'], name='unique_monitoring_file_progress'),
+        ]
+
+    def __str__(self):
+        return f'{self.file_name} {self.shard + 1}/{self.shards}'
+
+
+class FailedNotificationLine(models.Model):
+    """This model stores the lines of monitoring notification files that raised an exception
+    when they were applied, so that they can be replayed once the cause has been fixed,
+    see `replay_failed_notification_lines`."""
+    timestamp = models.DateTimeField(auto_now_add=True)
+    file_name = models.CharField(max_length=255)
+    line_number = models.PositiveIntegerField()
+    reason = models.TextField()
+    update_data = models.JSONField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file_name', 'line_number'], name='unique_failed_notification_line'),
+        ]
+
+    def __str__(self):
+        return f'{self.file_name}/{self.line_number}'
+
+
+class FamilyTree(models.Model):
+    """A local copy of a D&B family tree, used to answer hierarchy requests without
+    traversing the D&B api each time."""
+    global_ultimate_duns = models.CharField(max_length=9, unique=True)
+    global_ultimate_family_tree_members_count = models.PositiveIntegerField()
+    branches_excluded_members_count = models.PositiveIntegerField()
+    family_tree_members = models.JSONField()
+    member_duns_numbers = ArrayField(models.CharField(max_length=9))
+    last_refreshed = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['member_duns_numbers']),
+        ]
+
+    def __str__(self):
+        return self.global_ultimate_duns
@@ -1,3 +1,4 @@
+from collections import defaultdict
 from contextlib import contextmanager
 import copy
 import csv
@@ -7,6 +8,7 @@ import json
 import logging
 import os
 import zipfile
+import zlib
 
 import pytz
 from smart_open import open as smart_open
@@ -14,12 +16,15 @@ from smart_open import open as smart_open
 from django.conf import settings
 from django.core.exceptions import FieldDoesNotExist
 from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone
 
 from .client import api_request, DNBApiError
 from company.constants import MonitoringStatusChoices
-from company.models import Company, Country, IndustryCode, PrimaryIndustryCode, RegistrationNumber
-from .mapping import extract_company_data
+from company.countries import get_country
+from company.models import Company, IndustryCode, PrimaryIndustryCode, RegistrationNumber
+from .mapping import extract_company_data, get_company_data_hash
+from .models import FailedNotificationLine, MonitoringFileProgress, MonitoringFileRecord
 
 
 logger = logging.getLogger(__name__)
@@ -28,6 +33,12 @@ logger = logging.getLogger(__name__)
 DNB_MONITORING_ADD_ENDPOINT = \
     '/v1/monitoring/registrations/{}/duns/add'.format(settings.DNB_MONITORING_REGISTRATION_REFERENCE)
 
+COMPANY_RELATED_MODELS = {
+    'registration_numbers': RegistrationNumber,
+    'primary_industry_codes': PrimaryIndustryCode,
+    'industry_codes': IndustryCode,
+}
+
 
 @contextmanager
 def open_zip_file(file_path, s3_client):
@@ -67,42 +78,73 @@ def _parse_timestamp_from_file(file_name):
     return timestamp.replace(tzinfo=tz)
 
 
-def _update_dict_key(source_data, elements, value):
-    """Modify a nested key in a dict"""
-    if len(elements) > 0:
-        key = elements.pop(0)
-        if key not in source_data:
-            source_data[key] = {}
-        source_data[key] = _update_dict_key(source_data[key], elements, value)
-        return source_data
-    else:
-        return value
+def _patch_source(source_data, elements):
+    """Apply the changed elements of a monitoring UPDATE to source data without modifying it.
 
+    Only the dicts on the path to each changed key are copied, each at most once; the rest of the returned
+    document is shared with `source_data`.  Missing keys on the path are created."""
 
-@transaction.atomic
-def update_company_from_source(company, updated_source, updated_timestamp=None, enable_monitoring=False):
-    """Rebuild a company entry, including related models with new api source data; NOTE: updated_source can be
-    in the DNB direct plus CMPELK or companies list search api data type"""
+    # keyed by id, holding a reference so that the id can't be reused while patching
+    copied = {}
 
-    related_fields = {
-        'registration_numbers': RegistrationNumber,
-        'primary_industry_codes': PrimaryIndustryCode,
-        'industry_codes': IndustryCode,
-    }
+    def _copy(node):
+        if id(node) not in copied:
+            node = copy.copy(node)
+            copied[id(node)] = node
+        return node
+
+    patched = _copy(source_data)
+
+    for element in elements:
+        *path, last_key = element['element'].split('.')
+        node = patched
+        for key in path:
+            node[key] = _copy(node[key]) if key in node else _copy({})
+            node = node[key]
+        node[last_key] = element['current']
+
+    return patched
+
+
+def _get_source_hash(company):
+    """The hash of a company's mapped source data; companies saved before hashes were stored have it calculated"""
+
+    if company.source_hash:
+        return company.source_hash
+
+    return get_company_data_hash(extract_company_data(company.source)) if company.source else ''
+
+
+def _apply_source_to_company(
+    company, updated_source, updated_timestamp=None, enable_monitoring=False, is_update=None,
+):
+    """Set the fields of a company instance from new api source data without saving it.
+
+    `is_update` is whether the source data came from an UPDATE, which marks the company as updated if it changes
+    it; by default this is taken from the type of the source data.
+
+    Returns the extracted company data, which includes the data for the related models, or None if the mapped
+    data is the same as the company's current data, in which case only the source, timestamp and monitoring status
+    are set."""
+
+    if is_update is None:
+        is_update = updated_source.get('type', 'SEED') == 'UPDATE'
 
     new_company_data = extract_company_data(updated_source)
+    new_source_hash = get_company_data_hash(new_company_data)
+    changed = new_source_hash != _get_source_hash(company)
 
-    if updated_source.get('type', 'SEED') == 'UPDATE':
-        if not company.source or new_company_data != extract_company_data(company.source):
+    if changed:
+        if is_update:
             company.last_updated = timezone.now()
 
-    # store fields in updated_source in the company instance
-    for field, value in new_company_data.items():
-        if field in ['address_country', 'registered_address_country']:
-            country = Country.objects.get(iso_alpha2__iexact=value) if value else None
-            setattr(company, field, country)
-        elif field not in related_fields:
-            _update_field(company, field, value)
+        # store fields in updated_source in the company instance
+        for field, value in new_company_data.items():
+            if field in ['address_country', 'registered_address_country']:
+                country = get_country(value) if value else None
+                setattr(company, field, country)
+            elif field not in COMPANY_RELATED_MODELS:
+                _update_field(company, field, value)
 
     # "enable" monitoring if enable_monitoring=True.  NOTE: we only change the status if the current status is
     # not_enabled.  If it's already enabled, pending, or failed we do nothing.  Also, we don't actually
@@ -112,18 +154,118 @@ def update_company_from_source(company, updated_source, updated_timestamp=None,
         company.monitoring_status = MonitoringStatusChoices.pending.name
 
     company.source = updated_source
+    company.source_hash = new_source_hash
     company.last_updated_source_timestamp = updated_timestamp
-    company.save()
+    company.source_fetched_timestamp = timezone.now()
+
+    return new_company_data if changed else None
+
+
+def _build_related_instances(model_class, company, elements):
+    """Build (unsaved) related model instances for a company from extracted company data"""
+
+    for element in elements:
+        instance = model_class()
+        for field, value in element.items():
+            _update_field(instance, field, value)
+        instance.company = company
+        yield instance
+
+
+def _get_related_value_fields(model_class):
+    """The fields that hold the data of a related model, i.e. all but the primary key and the company"""
+
+    return [
+        field for field in model_class._meta.concrete_fields
+        if not field.primary_key and field.name != 'company'
+    ]
+
+
+def _diff_related_instances(fields, existing_instances, new_instances):
+    """Match the existing related model instances of a company against the new ones.
+
+    Instances with the same values are left alone; where values have changed, existing instances are updated
+    with new values rather than deleted and inserted again.  Returns a tuple of the instances to update, create
+    and delete."""
+
+    def _values(instance):
+        return tuple(field.to_python(getattr(instance, field.attname)) for field in fields)
+
+    unmatched = defaultdict(list)
+    for instance in existing_instances:
+        unmatched[_values(instance)].append(instance)
+
+    to_create = []
+    for instance in new_instances:
+        matches = unmatched[_values(instance)]
+        if matches:
+            matches.pop()
+        else:
+            to_create.append(instance)
+
+    to_delete = [instance for instances in unmatched.values() for instance in instances]
+
+    to_update = []
+    for existing_instance, new_instance in zip(to_delete, to_create):
+        for field in fields:
+            setattr(existing_instance, field.attname, getattr(new_instance, field.attname))
+        to_update.append(existing_instance)
+
+    return to_update, to_create[len(to_update):], to_delete[len(to_update):]
+
+
+def _rebuild_related_models(companies, company_data):
+    """Bring the related models of saved `companies` in line with their extracted `company_data`, using bulk
+    queries and writing only the rows that have changed"""
+
+    for field_name, model_class in COMPANY_RELATED_MODELS.items():
+        fields = _get_related_value_fields(model_class)
+
+        existing_instances = defaultdict(list)
+        for instance in model_class.objects.filter(company__in=companies):
+            existing_instances[instance.company_id].append(instance)
+
+        to_update, to_create, to_delete = [], [], []
+
+        for company, new_company_data in zip(companies, company_data):
+            update, create, delete = _diff_related_instances(
+                fields,
+                existing_instances[company.pk],
+                _build_related_instances(model_class, company, new_company_data[field_name]),
+            )
+            to_update.extend(update)
+            to_create.extend(create)
+            to_delete.extend(delete)
+
+        if to_delete:
+            model_class.objects.filter(pk__in=[instance.pk for instance in to_delete]).delete()
+        if to_update:
+            model_class.objects.bulk_update(to_update, [field.name for field in fields])
+        if to_create:
+            model_class.objects.bulk_create(to_create)
+
+
+@transaction.atomic
+def update_company_from_source(company, updated_source, updated_timestamp=None, enable_monitoring=False):
+    """Rebuild a company entry, including related models with new api source data; NOTE: updated_source can be
+    in the DNB direct plus CMPELK or companies list search api data type
+
+    Returns False if the mapped data was unchanged, in which case only the source, timestamp and monitoring status
+    are saved.  Only the fields that have changed are written for an existing company."""
+
+    new_company_data = _apply_source_to_company(company, updated_source, updated_timestamp, enable_monitoring)
+
+    if company.pk is None:
+        company.save()
+    else:
+        company.save(update_fields=company.changed_fields)
+
+    if new_company_data is None:
+        return False
 
-    # delete and recreate related models
-    for field_name, model_class in related_fields.items():
-        model_class.objects.filter(company=company).delete()
-        for element in new_company_data[field_name]:
-            instance = model_class()
-            for field, value in element.items():
-                _update_field(instance, field, value)
-            instance.company = company
-            instance.save()
+    _rebuild_related_models([company], [new_company_data])
+
+    return True
 
 
 def add_companies_to_monitoring_registration():
@@ -162,53 +304,390 @@ def add_companies_to_monitoring_registration():
     return total
 
 
-def apply_update_to_company(update_data, timestamp):
-    """Apply an individual update supplied from the DNB monitoring service to a company entry"""
+def _get_updated_source(company, update_data, timestamp, company_exists, source=None):
+    """Work out the new source data for a company from an update supplied by the DNB monitoring service.
+    An UPDATE is applied to `source` if it is given, otherwise to the company's source.
+
+    Returns a tuple of the updated source, or None if the update can't be applied, and the reason it can't."""
+
+    if source is None:
+        source = company.source
+
+    duns_number = update_data['organization']['duns']
+    update_type = update_data.get('type', 'SEED')
+
+    if company.last_updated_source_timestamp and company.last_updated_source_timestamp > timestamp:
+        return None, f'{duns_number}; update is older than last updated timestamp'
+
+    # if type == "SEED" then update_data contains full copmany data, which overwrites company.source
+    # if type == "UPDATE" then update_data contains a list of keys and changes, which we apply to the existing
+    # company.source
+    updated_source = update_data
+
+    if update_type == 'UPDATE':
+        # type == UPDATE - a list of changed keys is supplied, which we apply to the original source
+        # data, then rebuild the company models.  We can't proceed if there's a missing company.source
+        if not company_exists:
+            return None, f'{duns_number}: update for company not in DB'
+        if not source:
+            return None, f'{duns_number}: No source data - cannot apply update'
+
+        updated_source = _patch_source(source, update_data['elements'])
+        updated_source['type'] = 'UPDATE'
+
+    return updated_source, ''
+
+
+@transaction.atomic
+def _apply_update(update_data, timestamp):
+    """Apply an individual update to a company; returns whether it was applied, the reason if not, and whether
+    it changed the company.  The company is locked until the update is saved so that concurrent updates from
+    other files are applied one after the other."""
 
     # all entries in NOTIFICATION files will have type = SEED or UPDATE.  SEEDFILE don't specify a type
     # but are always type = SEED
     update_type = update_data.get('type', 'SEED')
 
     if update_type not in ['SEED', 'UPDATE']:
-        return False, f'skipping update type: {update_type}'
+        return False, f'skipping update type: {update_type}', False
 
     duns_number = update_data['organization']['duns']
 
     try:
-        company = Company.objects.get(duns_number=duns_number)
+        company = Company.objects.select_for_update().get(duns_number=duns_number)
     except Company.DoesNotExist:
         # if type == SEED, we'll create a new company.  This has some use when initially populating the database
         # however, typically company entries will already exist as they are pre-created from API data
         company = Company(monitoring_status=MonitoringStatusChoices.enabled.name)
 
-    if company.last_updated_source_timestamp and company.last_updated_source_timestamp > timestamp:
-        return False, f'{duns_number}; update is older than last updated timestamp'
+    updated_source, reason = _get_updated_source(company, update_data, timestamp, company_exists=bool(company.id))
 
-    # if type == "SEED" then update_data contains full copmany data, which overwrites company.source
-    # if type == "UPDATE" then update_data contains a list of keys and changes, which we apply to the existing
-    # company.source
-    updated_source = copy.deepcopy(company.source) if update_type == 'UPDATE' else update_data
+    if updated_source is None:
+        return False, reason, False
 
-    if update_type == 'UPDATE':
-        # type == UPDATE - a list of changed keys is supplied, which we apply to the original source
-        # data, then rebuild the company models.  We can't proceed if there's a missing company.source
-        if not company.id:
-            return False, f'{duns_number}: update for company not in DB'
-        if not company.source:
-            return False, f'{duns_number}: No source data - cannot apply update'
+    changed = update_company_from_source(company, updated_source, timestamp)
 
-        for update in update_data['elements']:
-            _update_dict_key(updated_source, update['element'].split('.'), update['current'])
+    return True, '', changed
 
-        updated_source['type'] = 'UPDATE'
 
-    update_company_from_source(company, updated_source, timestamp)
+def apply_update_to_company(update_data, timestamp):
+    """Apply an individual update supplied from the DNB monitoring service to a company entry"""
+
+    success, reason, _ = _apply_update(update_data, timestamp)
+
+    return success, reason
+
+
+def _apply_update_to_company_in_memory(update_data, timestamp, companies):
+    """Apply an individual update to a company in `companies`, a dict of company instances by duns number,
+    without saving it; the same checks are made as `apply_update_to_company`.
+
+    On success the company in `companies` is replaced by the updated instance, and the extracted company data
+    is returned along with the result, so that the related models can be rebuilt when the batch is written.
+    The company data is None if the update did not change the company."""
+
+    update_type = update_data.get('type', 'SEED')
+
+    if update_type not in ['SEED', 'UPDATE']:
+        return False, f'skipping update type: {update_type}', None
+
+    duns_number = update_data['organization']['duns']
+
+    company_exists = duns_number in companies
+    if company_exists:
+        # work on a copy so that an update which fails part way through leaves no trace on the company
+        company = copy.copy(companies[duns_number])
+    else:
+        company = Company(monitoring_status=MonitoringStatusChoices.enabled.name)
+
+    updated_source, reason = _get_updated_source(company, update_data, timestamp, company_exists)
+
+    if updated_source is None:
+        return False, reason, None
+
+    new_company_data = _apply_source_to_company(company, updated_source, timestamp)
+    companies[duns_number] = company
+
+    return True, '', new_company_data
+
+
+def _fold_update(update_data, timestamp, companies, folded_sources):
+    """Work out the source data for a company after an individual update, on top of the updates to it earlier in
+    the same batch, without mapping it; the same checks are made as `apply_update_to_company`.
+
+    `companies` is a dict of the company instances by duns number, and `folded_sources` a dict of the source data
+    by duns number after the updates so far, which is updated on success.  Returns whether the update can be
+    applied and the reason if not."""
+
+    update_type = update_data.get('type', 'SEED')
+
+    if update_type not in ['SEED', 'UPDATE']:
+        return False, f'skipping update type: {update_type}'
+
+    duns_number = update_data['organization']['duns']
+
+    company = companies.get(duns_number) or Company()
+    company_exists = duns_number in companies or duns_number in folded_sources
+
+    updated_source, reason = _get_updated_source(
+        company, update_data, timestamp, company_exists, source=folded_sources.get(duns_number),
+    )
+
+    if updated_source is None:
+        return False, reason
+
+    folded_sources[duns_number] = updated_source
 
     return True, ''
 
 
+def _fold_batch(lines, timestamp, companies):
+    """Fold the (line_number, update_data) lines of a batch into source data for each company, see `_fold_update`.
+
+    Returns a list of (line_number, update_data, success, changed, reason) for the lines, where the reason is the
+    exception if a line raised one and changed is not yet known; the indexes of the lines folded for each company,
+    by duns number; the folded source data by duns number; and the duns numbers of the companies with an UPDATE
+    among their folded lines."""
+
+    results = []
+    line_indexes_by_duns_number = defaultdict(list)
+    folded_sources = {}
+    updated_duns_numbers = set()
+
+    for line_number, update_data in lines:
+        try:
+            success, reason = _fold_update(update_data, timestamp, companies, folded_sources)
+        except Exception as exc:  # noqa: B902
+            results.append((line_number, update_data, False, False, exc))
+            continue
+
+        if success:
+            duns_number = update_data['organization']['duns']
+            line_indexes_by_duns_number[duns_number].append(len(results))
+            if update_data.get('type', 'SEED') == 'UPDATE':
+                updated_duns_numbers.add(duns_number)
+
+        results.append((line_number, update_data, success, False, reason))
+
+    return results, line_indexes_by_duns_number, folded_sources, updated_duns_numbers
+
+
+def _apply_lines_in_memory(lines, timestamp, companies):
+    """Apply (line_number, update_data) lines one at a time with `_apply_update_to_company_in_memory`; yields
+    a (line_number, update_data, success, changed, reason) result and the extracted company data for each line"""
+
+    for line_number, update_data in lines:
+        try:
+            success, reason, new_company_data = _apply_update_to_company_in_memory(update_data, timestamp, companies)
+        except Exception as exc:  # noqa: B902
+            yield (line_number, update_data, False, False, exc), None
+            continue
+
+        yield (line_number, update_data, success, new_company_data is not None, reason), new_company_data
+
+
+def _apply_batch_in_memory(lines, timestamp, companies):
+    """Apply a batch of (line_number, update_data) lines to the companies in `companies`, a dict of company
+    instances by duns number, without saving them.
+
+    The lines for each company are folded into one set of source data first, so that the company is mapped once
+    for the whole batch rather than once per line.  If mapping the folded source data fails, the company's lines
+    are applied again one at a time to find the line at fault.  A line counts as changing its company if the
+    batch as a whole changes the company, and the company is marked as updated if any of its lines is an UPDATE.
+
+    Returns a list of (line_number, update_data, success, changed, reason) for the lines, where the reason is
+    the exception if a line raised one; a dict of the extracted company data of the changed companies, by duns
+    number; and the duns numbers of the companies that were updated without being changed."""
+
+    results, line_indexes_by_duns_number, folded_sources, updated_duns_numbers = _fold_batch(
+        lines, timestamp, companies,
+    )
+
+    updated_company_data = {}
+    unchanged_duns_numbers = set()
+
+    for duns_number, line_indexes in line_indexes_by_duns_number.items():
+        # work on a copy so that a failure part way through leaves no trace on the company
+        company = copy.copy(companies.get(duns_number)) or Company(
+            monitoring_status=MonitoringStatusChoices.enabled.name,
+        )
+
+        try:
+            company_data = [_apply_source_to_company(
+                company, folded_sources[duns_number], timestamp, is_update=duns_number in updated_duns_numbers,
+            )]
+        except Exception:  # noqa: B902
+            # any error is retried line by line, where `_apply_lines_in_memory` records it against the line at fault
+            line_results = _apply_lines_in_memory([results[index][:2] for index in line_indexes], timestamp, companies)
+            company_data = []
+            for index, (result, new_company_data) in zip(line_indexes, line_results):
+                results[index] = result
+                if result[2]:
+                    company_data.append(new_company_data)
+        else:
+            companies[duns_number] = company
+            for index in line_indexes:
+                results[index] = (*results[index][:3], company_data[0] is not None, '')
+
+        for new_company_data in company_data:
+            if new_company_data is None:
+                unchanged_duns_numbers.add(duns_number)
+            else:
+                updated_company_data[duns_number] = new_company_data
+
+    return results, updated_company_data, unchanged_duns_numbers
+
+
+def _get_duns_number(update_data):
+    try:
+        return update_data['organization']['duns']
+    except (KeyError, TypeError):
+        return None
+
+
+@transaction.atomic
+def _save_companies(companies, company_data, unchanged_companies):
+    """Write the companies updated by a batch, and rebuild their related models, using bulk queries.
+
+    `unchanged_companies` are the companies whose mapped data was not changed by the batch; they have no related
+    models to rebuild.  Existing companies are written grouped by the fields that have changed, so only those
+    columns are written."""
+
+    new_companies = [company for company in companies if company.pk is None]
+
+    existing_companies_by_fields = defaultdict(list)
+    for company in companies + unchanged_companies:
+        if company.pk is not None:
+            existing_companies_by_fields[tuple(company.changed_fields)].append(company)
+
+    Company.objects.bulk_create(new_companies)
+
+    for fields, companies_to_update in existing_companies_by_fields.items():
+        if fields:
+            Company.objects.bulk_update(companies_to_update, fields)
+
+    _rebuild_related_models(companies, company_data)
+
+
+def _record_failed_lines(file_name, failed_lines):
+    """Store the (line_number, update_data, exception) lines of a notification file that raised an exception,
+    replacing any stored for the same lines before"""
+
+    for line_number, _, exc in failed_lines:
+        logger.error(f'{file_name}/{line_number} exception: {exc}; stored as a failed line')
+
+    FailedNotificationLine.objects.bulk_create(
+        [
+            FailedNotificationLine(
+                file_name=file_name,
+                line_number=line_number,
+                reason=f'{exc.__class__.__name__}: {exc}',
+                update_data=update_data,
+            )
+            for line_number, update_data, exc in failed_lines
+        ],
+        update_conflicts=True,
+        unique_fields=['file_name', 'line_number'],
+        update_fields=['timestamp', 'reason', 'update_data'],
+    )
+
+
+def _process_notification_line(file_name, line_number, update_data, timestamp):
+    """Apply a single line of a notification file; returns whether it was applied, whether it changed
+    the company and the exception it raised, if any"""
+
+    try:
+        success, reason, changed = _apply_update(update_data, timestamp)
+    except Exception as exc:  # noqa: B902
+        return False, False, exc
+
+    if success:
+        logger.info(f'{file_name}/{line_number}  Successfully processed')
+    else:
+        logger.warning(f'{file_name}/{line_number} failed reason: {reason}')
+
+    return success, changed, None
+
+
+def _log_batch_results(file_name, results):
+    for line_number, update_data, success, changed, reason in results:
+        if isinstance(reason, BaseException):
+            continue
+        elif success:
+            logger.info(f'{file_name}/{line_number}  Successfully processed')
+        else:
+            logger.warning(f'{file_name}/{line_number} failed reason: {reason}')
+
+
+def _process_notification_batch(file_name, lines, timestamp):
+    """Apply a batch of (line_number, update_data) lines of a notification file; returns the number applied and
+    the number of those that did not change the company.
+
+    The companies are loaded and locked with one query, updated in memory, then written back with bulk queries
+    in the same transaction, so that files processed at the same time can't overwrite each other's updates.
+    If the write fails, the lines are applied again one at a time so that one bad line can't fail the whole
+    batch.  Lines that raise an exception are stored as `FailedNotificationLine`."""
+
+    with transaction.atomic():
+        return _process_locked_notification_batch(file_name, lines, timestamp)
+
+
+def _process_locked_notification_batch(file_name, lines, timestamp):
+    """The body of `_process_notification_batch`, run in its transaction"""
+
+    duns_numbers = {_get_duns_number(update_data) for _, update_data in lines} - {None}
+    # locked in a consistent order so that concurrent batches can't deadlock
+    companies = {
+        company.duns_number: company
+        for company in Company.objects.select_for_update().filter(
+            duns_number__in=duns_numbers,
+        ).order_by('duns_number')
+    }
+
+    results, updated_company_data, unchanged_duns_numbers = _apply_batch_in_memory(lines, timestamp, companies)
+
+    try:
+        _save_companies(
+            [companies[duns_number] for duns_number in updated_company_data],
+            list(updated_company_data.values()),
+            [companies[duns_number] for duns_number in unchanged_duns_numbers - updated_company_data.keys()],
+        )
+    except Exception as exc:  # noqa: B902
+        logger.warning(f'{file_name} failed to save batch, retrying one line at a time: {exc}')
+        line_results = [
+            (line_number, update_data, *_process_notification_line(file_name, line_number, update_data, timestamp))
+            for line_number, update_data in lines
+        ]
+        _record_failed_lines(
+            file_name,
+            [(line_number, update_data, exc) for line_number, update_data, _, _, exc in line_results if exc],
+        )
+        return (
+            sum(success for _, _, success, _, _ in line_results),
+            sum(success and not changed for _, _, success, changed, _ in line_results),
+        )
+
+    _log_batch_results(file_name, results)
+
+    _record_failed_lines(
+        file_name,
+        [
+            (line_number, update_data, reason)
+            for line_number, update_data, _, _, reason in results if isinstance(reason, BaseException)
+        ],
+    )
+
+    return (
+        sum(success for _, _, success, _, _ in results),
+        sum(success and not changed for _, _, success, changed, _ in results),
+    )
+
+
 def process_exception_file(file_path, s3_client):
-    """Process a DNB monitoring exceptions file and update Company.monitoring_status"""
+    """Process a DNB monitoring exceptions file and update Company.monitoring_status
+
+    Returns the number of lines and the number applied, and 0 unchanged for consistency with
+    `process_notification_file`."""
     required_header = ['DUNS', 'Code', 'Information']
 
     file_name = os.path.basename(file_path)
@@ -236,7 +715,7 @@ def process_exception_file(file_path, s3_client):
                     company = Company.objects.get(duns_number=duns_number)
                     company.monitoring_status = MonitoringStatusChoices.failed.name
                     company.monitoring_status_detail = f'{error_code} {description}'
-                    company.save()
+                    company.save(update_fields=company.changed_fields)
 
                     logger.info(f'{file_name } Set monitoring_status for {duns_number} to failed')
                 except Company.DoesNotExist:
@@ -244,39 +723,148 @@ def process_exception_file(file_path, s3_client):
                 else:
                     total_success += 1
 
-    return total, total_success
+    return total, total_success, 0
+
+
+def get_line_shard(update_data, shards):
+    """The shard, out of `shards`, that a line of a notification file is processed in.  Lines are split by duns
+    number so that the updates to a company are always applied in order, by the same shard; lines without one
+    are in the first shard."""
+
+    duns_number = _get_duns_number(update_data) if isinstance(update_data, dict) else None
+
+    if not duns_number:
+        return 0
+
+    return zlib.crc32(str(duns_number).encode()) % shards
+
+
+@transaction.atomic
+def _process_checkpointed_notification_batch(file_name, lines, timestamp, progress, last_line_number, total):
+    """Process a batch of lines of a notification file and save the progress through the file in the same
+    transaction, so that the saved progress always matches the lines that have been applied"""
+
+    success, unchanged = _process_notification_batch(file_name, lines, timestamp)
+
+    progress.last_line_number = last_line_number
+    progress.total = total
+    progress.success += success
+    progress.unchanged += unchanged
+    progress.save()
+
+    return success, unchanged
+
+
+def process_notification_file(file_path, s3_client, shard=0, shards=1):
+    """Process an update file, `settings.DNB_MONITORING_BATCH_SIZE` lines at a time.
 
+    With `shards` above 1 only the lines in `shard` are processed, see `get_line_shard`, so that a file can be
+    processed by several tasks at once; every shard reads the whole file.
 
-def process_notification_file(file_path, s3_client):
-    """Process an update file"""
+    The progress through the file is saved with each batch, see `MonitoringFileProgress`; if the file was only
+    partly processed before, processing resumes after the last saved batch.
+
+    Returns the number of lines, the number applied, and the number applied that did not change the company."""
 
     timestamp = _parse_timestamp_from_file(file_path)
 
     file_name = os.path.basename(file_path)
 
-    total, total_success = 0, 0
+    progress = MonitoringFileProgress.objects.filter(
+        file_name=file_name, shard=shard, shards=shards,
+    ).first() or MonitoringFileProgress(file_name=file_name, shard=shard, shards=shards)
+
+    if progress.last_line_number:
+        logger.info(f'{file_name} resuming after line {progress.last_line_number}')
+
+    total, total_success, total_unchanged = progress.total, progress.success, progress.unchanged
+
+    batch = []
+    line_number = progress.last_line_number
 
     with open_zip_file(file_path, s3_client) as file_data:
         for line_number, line in enumerate(file_data, 1):
+            if line_number <= progress.last_line_number:
+                continue
+
             update_data = json.loads(line)
 
+            if shards > 1 and get_line_shard(update_data, shards) != shard:
+                continue
+
             total += 1
 
             if not isinstance(update_data, dict):
                 logger.debug(f'{file_name}/{line_number} contains incomplete data: {update_data}')
                 continue
 
-            try:
-                success, reason = apply_update_to_company(update_data, timestamp)
-            except BaseException as exc:
-                logger.error(f'{file_name}/{line_number} exception: {exc}; input data: {update_data}')
-                continue
+            batch.append((line_number, update_data))
 
-            if success:
-                logger.info(f'{file_name}/{line_number}  Successfully processed')
+            if len(batch) >= settings.DNB_MONITORING_BATCH_SIZE:
+                success, unchanged = _process_checkpointed_notification_batch(
+                    file_name, batch, timestamp, progress, line_number, total,
+                )
+                total_success += success
+                total_unchanged += unchanged
+                batch = []
 
-                total_success += 1
-            else:
-                logger.warning(f'{file_name}/{line_number} failed reason: {reason}')
+    if batch:
+        success, unchanged = _process_checkpointed_notification_batch(
+            file_name, batch, timestamp, progress, line_number, total,
+        )
+        total_success += success
+        total_unchanged += unchanged
+
+    return total, total_success, total_unchanged
+
+
+def replay_failed_notification_lines(file_name=None):
+    """Apply the stored failed lines of notification files again, e.g. once the cause of the failures has been
+    fixed, in file timestamp and line order, `settings.DNB_MONITORING_BATCH_SIZE` lines at a time.  Only the lines
+    of `file_name` are replayed if it is given.
+
+    Replayed lines are removed, and stored again if they fail again; the counts of the file's
+    `MonitoringFileRecord` are corrected for the lines that now succeed.  Returns the number of lines replayed and
+    the number that failed again."""
+
+    failed_lines = FailedNotificationLine.objects.all()
+    if file_name:
+        failed_lines = failed_lines.filter(file_name=file_name)
+
+    file_names = sorted(
+        set(failed_lines.values_list('file_name', flat=True)),
+        key=lambda file_name: (_parse_timestamp_from_file(file_name), file_name),
+    )
+
+    total, total_failed = 0, 0
+
+    for file_name in file_names:
+        timestamp = _parse_timestamp_from_file(file_name)
+        last_line_number = 0
+
+        while True:
+            batch = list(
+                FailedNotificationLine.objects.filter(
+                    file_name=file_name, line_number__gt=last_line_number,
+                ).order_by('line_number')[:settings.DNB_MONITORING_BATCH_SIZE]
+            )
+
+            if not batch:
+                break
+
+            with transaction.atomic():
+                FailedNotificationLine.objects.filter(pk__in=[line.pk for line in batch]).delete()
+                success, unchanged = _process_notification_batch(
+                    file_name, [(line.line_number, line.update_data) for line in batch], timestamp,
+                )
+                # the record is keyed by the file's path in the bucket, the failed lines by its name
+                MonitoringFileRecord.objects.filter(
+                    Q(file_name=file_name) | Q(file_name__endswith=f'/{file_name}'),
+                ).update(failed=F('failed') - success, unchanged=F('unchanged') + unchanged)
+
+            total += len(batch)
+            last_line_number = batch[-1].line_number
+
+        total_failed += FailedNotificationLine.objects.filter(file_name=file_name).count()
 
-    return total, total_success
+    return total, total_failed
@@ -1,22 +1,36 @@
 import logging
 import os
+from collections import defaultdict
+from datetime import timedelta
 
-from celery import shared_task
+from celery import chain, chord, group, shared_task
 
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 
 from company.models import Company
-from dnb_direct_plus.models import MonitoringFileRecord
-from dnb_direct_plus.monitoring import process_exception_file, process_notification_file
+from dnb_direct_plus.client import redis_client
+from dnb_direct_plus.models import FamilyTree, MonitoringFileProgress, MonitoringFileRecord
 from dnb_direct_plus.monitoring import (
+    _parse_timestamp_from_file,
     add_companies_to_monitoring_registration,
+    process_exception_file,
+    process_notification_file,
     update_company_from_source,
 )
 from dnb_direct_plus.s3_client import S3Client
 
 logger = logging.getLogger(__name__)
 
+COMPANY_UPDATE_PENDING_KEY = "_company_update_pending:{}"
+COMPANY_UPDATE_PENDING_EXPIRY_SECONDS = 10 * 60
+MONITORING_FILE_LOCK_KEY = "_monitoring_file_lock:{}"
+
+
+class MonitoringFileLockedError(Exception):
+    pass
+
 
 @shared_task
 def update_company_and_enable_monitoring(api_data):
@@ -27,11 +41,69 @@ def update_company_and_enable_monitoring(api_data):
     logger.debug(f'Updating {duns_number}')
 
     try:
-        company = Company.objects.get(duns_number=duns_number)
-    except Company.DoesNotExist:
-        company = Company()
+        try:
+            company = Company.objects.get(duns_number=duns_number)
+        except Company.DoesNotExist:
+            company = Company()
+
+        update_company_from_source(company, api_data, timezone.now(), enable_monitoring=True)
+    finally:
+        redis_client.delete(COMPANY_UPDATE_PENDING_KEY.format(duns_number))
+
+
+def schedule_company_update(api_data, wait=False):
+    """
+    Update the local company from `api_data` and enable monitoring in the background.
+
+    Only one update is queued for a duns number at a time; while one is pending, later requests to update the
+    same company are dropped, as the pending update will already hold recent D&B data.  With `wait=True` the
+    company is updated before returning.
+    """
+    if wait:
+        update_company_and_enable_monitoring(api_data)
+        return
+
+    pending_key = COMPANY_UPDATE_PENDING_KEY.format(api_data["organization"]["duns"])
+
+    if redis_client.set(pending_key, 1, nx=True, ex=COMPANY_UPDATE_PENDING_EXPIRY_SECONDS):
+        try:
+            update_company_and_enable_monitoring.delay(api_data)
+        except Exception:  # noqa: B902
+            # the update was not queued, so don't stop the next request from queuing one
+            redis_client.delete(pending_key)
+            raise
+
+
+@shared_task
+def refresh_family_tree(global_ultimate_duns):
+    """Replace the locally stored family tree with the current tree from D&B"""
+
+    from dnb_direct_plus.api import company_hierarchy_list_search
 
-    update_company_from_source(company, api_data, timezone.now(), enable_monitoring=True)
+    logger.debug(f'Refreshing family tree {global_ultimate_duns}')
+
+    company_hierarchy_list_search({"duns_number": global_ultimate_duns}, use_local=False)
+
+
+@shared_task
+def refresh_stale_family_trees():
+    """Schedule a refresh of the family trees that have not been refreshed for `DNB_FAMILY_TREE_MAX_AGE_SECONDS`,
+    oldest first"""
+
+    cutoff = timezone.now() - timedelta(seconds=settings.DNB_FAMILY_TREE_MAX_AGE_SECONDS)
+
+    stale_duns_numbers = FamilyTree.objects.filter(
+        last_refreshed__lt=cutoff,
+    ).order_by(
+        'last_refreshed',
+    ).values_list(
+        'global_ultimate_duns', flat=True,
+    )[:settings.DNB_FAMILY_TREE_REFRESH_BATCH_SIZE]
+
+    for global_ultimate_duns in stale_duns_numbers:
+        refresh_family_tree.delay(global_ultimate_duns)
+
+    logger.info(f"{len(stale_duns_numbers)} family trees scheduled for refresh")
 
 
 @shared_task
@@ -49,70 +121,188 @@ def register_companies_for_dnb_api_monitoring():
     logger.info(f"{total} companies added to monitoring registration")
 
 
-@shared_task
-def process_updates_from_dnb_api_monitoring_data():
-    """
-    Processes any updates for companies that are registered with the external
-    D&B API.
+def _get_monitoring_file_handler(file_name):
+    """The function that processes a monitoring file, or None if the file isn't one that is processed"""
 
-    AND
+    if not file_name.startswith(settings.DNB_MONITORING_REGISTRATION_REFERENCE):
+        # file does not relate to the monitoring registration
+        return None
 
-    Processes exception files for any companies which failed to be registered
-    to the external D&B API.
-    """
-    logger.info("Checking for company updates or exceptions received from D&B.")
+    if "HEADER" in file_name:
+        return None
 
-    s3_client = S3Client()
-    files = s3_client.list_files(settings.DNB_MONITORING_S3_BUCKET)
+    if file_name.startswith(settings.DNB_ARCHIVE_PATH):
+        return None
 
-    summary = []
+    if "Exceptions" in file_name:
+        return process_exception_file
+    elif "NOTIFICATION" in file_name or "SEEDFILE" in file_name:
+        return process_notification_file
 
-    for file_name in files:
+    return None
 
-        if not file_name.startswith(settings.DNB_MONITORING_REGISTRATION_REFERENCE):
-            # file does not relate to the monitoring registration
-            continue
 
-        if "HEADER" in file_name:
-            continue
+def _get_monitoring_file_bucket_path(file_name):
+    return os.path.join(
+        "s3://", settings.DNB_MONITORING_S3_BUCKET, file_name
+    )
 
-        if file_name.startswith(settings.DNB_ARCHIVE_PATH):
-            continue
 
+def _record_monitoring_file(file_name, total, total_success, total_unchanged):
+    with transaction.atomic():
+        MonitoringFileRecord.objects.create(
+            file_name=file_name, total=total, failed=total - total_success, unchanged=total_unchanged
+        )
+        # the progress is only needed to resume a file that has not been recorded
+        MonitoringFileProgress.objects.filter(file_name=os.path.basename(file_name)).delete()
+
+    if settings.DNB_ARCHIVE_PROCESSED_FILES:
+        S3Client().archive_file(file_name)
+
+
+@shared_task(bind=True)
+def process_monitoring_file(self, file_name):
+    """
+    Process a single monitoring file and record it as processed.
+
+    The file is locked while it is processed and the record checked once the lock is held, so that a file is
+    only ever processed once even if it is dispatched again while still being processed.
+
+    With `settings.DNB_MONITORING_SHARDS` above 1, a notification file is processed by that many
+    `process_monitoring_file_shard` tasks in parallel, and this task is replaced by them.  The lock is then
+    released by `record_sharded_monitoring_file` once all the shards have been processed; if a shard fails the
+    lock is left to expire.
+    """
+    lock_key = MONITORING_FILE_LOCK_KEY.format(file_name)
+
+    if not redis_client.set(lock_key, 1, nx=True, ex=settings.DNB_MONITORING_FILE_LOCK_SECONDS):
+        # stop the chain rather than process later files before this one has been processed
+        raise MonitoringFileLockedError(f"{file_name} is already being processed")
+
+    sharded = False
+
+    try:
         if MonitoringFileRecord.objects.filter(file_name=file_name).exists():
             logger.info(f"{file_name} already processed; skipping")
-            continue
+            return
 
-        if "Exceptions" in file_name:
-            handler = process_exception_file
-        elif "NOTIFICATION" in file_name or "SEEDFILE" in file_name:
-            handler = process_notification_file
-        else:
-            continue
-
-        bucket_path = os.path.join(
-            "s3://", settings.DNB_MONITORING_S3_BUCKET, file_name
-        )
+        handler = _get_monitoring_file_handler(file_name)
 
         logger.info(f"Processing: {file_name}")
 
-        total, total_success = handler(bucket_path, s3_client)
+        shards = settings.DNB_MONITORING_SHARDS
 
-        summary.append(dict(file=file_name, total=total, failed=total - total_success))
-        MonitoringFileRecord.objects.create(
-            file_name=file_name, total=total, failed=total - total_success
-        )
+        if handler is process_notification_file and shards > 1:
+            sharded = True
+            return self.replace(
+                chord(
+                    (
+                        process_monitoring_file_shard.si(file_name, shard, shards).set(
+                            queue=settings.DNB_MONITORING_QUEUE,
+                        )
+                        for shard in range(shards)
+                    ),
+                    record_sharded_monitoring_file.s(file_name).set(queue=settings.DNB_MONITORING_QUEUE),
+                )
+            )
+
+        total, total_success, total_unchanged = handler(_get_monitoring_file_bucket_path(file_name), S3Client())
+
+        _record_monitoring_file(file_name, total, total_success, total_unchanged)
+    finally:
+        if not sharded:
+            redis_client.delete(lock_key)
+
+
+@shared_task
+def process_monitoring_file_shard(file_name, shard, shards):
+    """Process the lines of a notification file in one of its `shards`; returns the shard's totals"""
+
+    logger.info(f"Processing: {file_name} shard {shard + 1} of {shards}")
 
-        if settings.DNB_ARCHIVE_PROCESSED_FILES:
-            s3_client.archive_file(file_name)
+    return process_notification_file(
+        _get_monitoring_file_bucket_path(file_name), S3Client(), shard=shard, shards=shards,
+    )
+
+
+@shared_task
+def record_sharded_monitoring_file(shard_totals, file_name):
+    """Record a notification file processed in shards as processed, with the totals of all its shards"""
+
+    try:
+        total, total_success, total_unchanged = (sum(totals) for totals in zip(*shard_totals))
+
+        _record_monitoring_file(file_name, total, total_success, total_unchanged)
+    finally:
+        redis_client.delete(MONITORING_FILE_LOCK_KEY.format(file_name))
+
+
+@shared_task
+def summarise_monitoring_files(file_names):
+    """Log the totals of the monitoring files processed by a run of
+    `process_updates_from_dnb_api_monitoring_data`"""
+
+    records = MonitoringFileRecord.objects.in_bulk(file_names, field_name="file_name")
+    summary = [records[file_name] for file_name in file_names if file_name in records]
 
     summary_text = "\n".join(
-        "{file}\t\tTotal: {total}\tFailed: {failed}".format(**line) for line in summary
+        f"{record.file_name}\t\tTotal: {record.total}\tFailed: {record.failed}\tUnchanged: {record.unchanged}"
+        for record in summary
     )
 
     # The sum of all the companies successfully updated.
-    total_successful_updates = sum(line["total"] - line["failed"] for line in summary)
+    total_successful_updates = sum(record.total - record.failed for record in summary)
     logger.info(f"A total of {total_successful_updates} companies were updated.")
 
     if summary_text:
         logger.info(summary_text)
+
+
+@shared_task
+def process_updates_from_dnb_api_monitoring_data():
+    """
+    Processes any updates for companies that are registered with the external
+    D&B API.
+
+    AND
+
+    Processes exception files for any companies which failed to be registered
+    to the external D&B API.
+
+    Each file is processed by its own task on `settings.DNB_MONITORING_QUEUE`.  Files with the same timestamp
+    are processed in parallel, and files with a later timestamp only once all earlier files have been processed,
+    so that the updates to a company are applied in order.  If a file fails, the files after it are left for the
+    next run.
+    """
+    logger.info("Checking for company updates or exceptions received from D&B.")
+
+    s3_client = S3Client()
+    files = s3_client.list_files(settings.DNB_MONITORING_S3_BUCKET)
+
+    files_by_timestamp = defaultdict(list)
+
+    for file_name in files:
+
+        if _get_monitoring_file_handler(file_name) is None:
+            continue
+
+        if MonitoringFileRecord.objects.filter(file_name=file_name).exists():
+            logger.info(f"{file_name} already processed; skipping")
+            continue
+
+        files_by_timestamp[_parse_timestamp_from_file(file_name)].append(file_name)
+
+    file_groups = [files_by_timestamp[timestamp] for timestamp in sorted(files_by_timestamp)]
+
+    chain(
+        *[
+            group(
+                process_monitoring_file.si(file_name).set(queue=settings.DNB_MONITORING_QUEUE)
+                for file_name in file_group
+            )
+            for file_group in file_groups
+        ],
+        summarise_monitoring_files.si(
+            [file_name for file_group in file_groups for file_name in file_group],
+        ).set(queue=settings.DNB_MONITORING_QUEUE),
+    ).apply_async()
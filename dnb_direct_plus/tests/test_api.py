@@ -1,6 +1,8 @@
 import json
+from datetime import timedelta
 
 import pytest
+from django.utils import timezone
 
 from requests.exceptions import HTTPError
 
@@ -8,13 +10,19 @@ from company.constants import MonitoringStatusChoices
 from company.models import Company
 
 from dnb_direct_plus.api import (
+    company_bulk_search,
     company_hierarchy_api_request,
     company_hierarchy_count,
     company_hierarchy_list_search,
+    company_hierarchy_list_stream,
     company_list_search,
     company_list_search_v2,
+    get_fresh_local_companies,
 )
+from dnb_direct_plus.models import FamilyTree
+from ..client import DNBApiCircuitOpenError, DNBApiUnavailableError, redis_client
 from ..mapping import extract_company_data
+from ..monitoring import update_company_from_source
 
 
 @pytest.mark.django_db
@@ -44,6 +52,28 @@ def test_company_list_search(mocker, company_list_api_response_json):
         assert extract_company_data(input_data) == expected
 
 
+@pytest.mark.django_db
+def test_company_list_search_responses_are_cached(mocker, settings, company_list_api_response_json):
+    settings.DNB_API_SEARCH_CACHE_TTL_SECONDS = 60
+
+    mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+    mock_api_request.return_value.json.return_value = json.loads(company_list_api_response_json)
+
+    try:
+        output = company_list_search({"search_term": "hello world"})
+
+        assert company_list_search({"search_term": "hello world"}) == output
+        assert mock_api_request.call_count == 1
+
+        assert company_list_search({"search_term": "hello world"}, use_cache=False) == output
+        assert mock_api_request.call_count == 2
+
+        company_list_search({"search_term": "another search"})
+        assert mock_api_request.call_count == 3
+    finally:
+        redis_client.flushall()
+
+
 @pytest.mark.django_db
 def test_company_list_search_v2(
     mocker, company_list_v2_api_response_json, company_list_v2_expected_data_json
@@ -163,6 +193,121 @@ def test_company_list_search_v2_detail_query_company_data_is_saved(
     assert company.monitoring_status == MonitoringStatusChoices.pending.name
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "monitoring_status,age,expect_dnb_request",
+    [
+        (MonitoringStatusChoices.enabled.name, timedelta(days=1), False),
+        (MonitoringStatusChoices.enabled.name, timedelta(days=8), True),
+        (MonitoringStatusChoices.pending.name, timedelta(days=1), True),
+    ],
+)
+def test_company_list_search_v2_detail_query_uses_fresh_local_company(
+    mocker,
+    company_list_v2_api_response_json,
+    data_duns_api_response_json,
+    monitoring_status,
+    age,
+    expect_dnb_request,
+):
+    company_input_data = json.loads(company_list_v2_api_response_json)
+    up_to_date_company_data = json.loads(data_duns_api_response_json)
+
+    company = Company()
+    update_company_from_source(company, up_to_date_company_data, timezone.now() - age)
+    company.monitoring_status = monitoring_status
+    company.source_fetched_timestamp = timezone.now() - age
+    company.save()
+
+    mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+    mock_api_request.return_value.json.side_effect = [company_input_data, up_to_date_company_data]
+
+    output = company_list_search_v2({"duns_number": "141592653"}, update_local=True)
+
+    assert output == {"results": [extract_company_data(up_to_date_company_data)]}
+
+    requested_paths = [call[0][1] for call in mock_api_request.call_args_list]
+    assert ("/v1/data/duns/141592653" in requested_paths) == expect_dnb_request
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "source_type,data_age,fetched_age,expect_local",
+    [
+        ("cmpelk", timedelta(days=30), timedelta(days=1), True),
+        ("cmpelk", timedelta(days=1), timedelta(days=8), False),
+        ("cmpelk", timedelta(days=1), None, False),
+        ("searchCandidate", timedelta(days=1), timedelta(days=1), False),
+        ("worldbase", None, None, False),
+    ],
+)
+def test_get_fresh_local_companies(
+    data_duns_api_response_json,
+    company_list_api_response_json,
+    source_type,
+    data_age,
+    fetched_age,
+    expect_local,
+):
+    if source_type == "searchCandidate":
+        source = json.loads(company_list_api_response_json)["searchCandidates"][0]
+    else:
+        source = json.loads(data_duns_api_response_json)
+
+    company = Company()
+    update_company_from_source(company, source, timezone.now() - data_age if data_age else None)
+    company.monitoring_status = MonitoringStatusChoices.enabled.name
+    company.source_fetched_timestamp = timezone.now() - fetched_age if fetched_age else None
+    if source_type == "worldbase":
+        company.source = None
+    company.save()
+
+    assert (company.duns_number in get_fresh_local_companies([company.duns_number])) == expect_local
+
+
+@pytest.mark.django_db
+def test_company_bulk_search(mocker, data_duns_api_response_json):
+    up_to_date_company_data = json.loads(data_duns_api_response_json)
+
+    local_company = Company()
+    update_company_from_source(local_company, up_to_date_company_data, timezone.now())
+    local_company.monitoring_status = MonitoringStatusChoices.enabled.name
+    local_company.save()
+
+    remote_company_data = json.loads(data_duns_api_response_json)
+    remote_company_data["organization"]["duns"] = "222222222"
+
+    def _api_request(method, url, **kwargs):
+        if url == "/v1/data/duns/222222222":
+            return ApiHierarchyRequestJsonFake(remote_company_data)
+        if url == "/v1/data/duns/333333333":
+            raise HTTPError(response=MockHTTPErrorResponse(404, {"error": {}}))
+        if url == "/v1/data/duns/444444444":
+            raise DNBApiCircuitOpenError("/v1/data/duns is unavailable")
+        raise AssertionError(f"Unexpected API request {url}")
+
+    mocker.patch("dnb_direct_plus.api.api_request", side_effect=_api_request)
+    mock_schedule_update = mocker.patch("dnb_direct_plus.api.schedule_company_update")
+
+    output = company_bulk_search(
+        ["141592653", "222222222", "333333333", "444444444", "222222222"],
+        update_local=True,
+    )
+
+    assert output == {
+        "results": [
+            {"duns_number": "141592653", "company": extract_company_data(up_to_date_company_data)},
+            {"duns_number": "222222222", "company": extract_company_data(remote_company_data)},
+            {"duns_number": "333333333", "error": {"status_code": 404, "detail": "Not found"}},
+            {
+                "duns_number": "444444444",
+                "error": {"status_code": 503, "detail": "/v1/data/duns is unavailable"},
+            },
+        ],
+    }
+    mock_schedule_update.assert_called_once_with(remote_company_data, wait=False)
+
+
 class ApiHierarchyRequestJsonFake:
     def __init__(self, json_data):
         self.json_data = json_data
@@ -218,6 +363,255 @@ def test_company_hierarchy_paginated_list_search(
     assert output["family_tree_members"][1]["duns"] == "555555555"
 
 
+@pytest.mark.django_db
+class TestFamilyTreeStore:
+    @pytest.fixture(autouse=True)
+    def flush_redis(self):
+        yield
+        redis_client.flushall()
+
+    def _create_family_tree(self, age, global_ultimate_duns="111111111"):
+        return FamilyTree.objects.create(
+            global_ultimate_duns=global_ultimate_duns,
+            global_ultimate_family_tree_members_count=2,
+            branches_excluded_members_count=0,
+            family_tree_members=[{"duns": global_ultimate_duns}, {"duns": "222222222"}],
+            member_duns_numbers=sorted([global_ultimate_duns, "222222222"]),
+            last_refreshed=timezone.now() - age,
+        )
+
+    def test_search_results_are_stored(self, mocker, company_hierarchy_api_response_json):
+        mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+        mock_api_request.return_value.json.return_value = json.loads(company_hierarchy_api_response_json)
+
+        output = company_hierarchy_list_search({"duns_number": "111111111"})
+
+        family_tree = FamilyTree.objects.get(global_ultimate_duns="111111111")
+        assert family_tree.family_tree_members == output["family_tree_members"]
+        assert family_tree.member_duns_numbers == ["111111111", "222222222", "333333333"]
+
+        assert company_hierarchy_list_search({"duns_number": "222222222"}) == output
+        assert company_hierarchy_count({"duns_number": "333333333"}) == 3
+        assert mock_api_request.call_count == 1
+
+    def test_fresh_tree_is_served_locally(self, mocker):
+        self._create_family_tree(age=timedelta(hours=1))
+        mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+        mock_refresh = mocker.patch("dnb_direct_plus.api.refresh_family_tree")
+
+        output = company_hierarchy_list_search({"duns_number": "222222222"})
+
+        assert output == {
+            "global_ultimate_duns": "111111111",
+            "global_ultimate_family_tree_members_count": 2,
+            "branches_excluded_members_count": 0,
+            "family_tree_members": [{"duns": "111111111"}, {"duns": "222222222"}],
+        }
+        assert not mock_api_request.called
+        assert not mock_refresh.delay.called
+
+    def test_most_recent_tree_is_served(self, mocker):
+        self._create_family_tree(age=timedelta(hours=2), global_ultimate_duns="111111111")
+        self._create_family_tree(age=timedelta(hours=1), global_ultimate_duns="333333333")
+        self._create_family_tree(age=timedelta(hours=3), global_ultimate_duns="444444444")
+        mocker.patch("dnb_direct_plus.api.api_request")
+
+        output = company_hierarchy_list_search({"duns_number": "222222222"})
+
+        assert output["global_ultimate_duns"] == "333333333"
+
+    def test_stale_tree_is_served_and_refreshed_once(self, mocker):
+        self._create_family_tree(age=timedelta(days=2))
+        mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+        mock_refresh = mocker.patch("dnb_direct_plus.api.refresh_family_tree")
+
+        company_hierarchy_list_search({"duns_number": "111111111"})
+        company_hierarchy_count({"duns_number": "111111111"})
+
+        assert not mock_api_request.called
+        mock_refresh.delay.assert_called_once_with("111111111")
+
+    @pytest.mark.parametrize("age,use_local", [
+        (timedelta(days=8), True),
+        (timedelta(hours=1), False),
+    ])
+    def test_tree_is_requested_from_dnb(self, mocker, age, use_local):
+        self._create_family_tree(age=age)
+        mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+        mock_api_request.return_value.json.return_value = _hierarchy_page(1, ["111111111", "333333333"])
+
+        output = company_hierarchy_list_search({"duns_number": "111111111"}, use_local=use_local)
+
+        assert [member["duns"] for member in output["family_tree_members"]] == ["111111111", "333333333"]
+        assert mock_api_request.call_count == 1
+
+        family_tree = FamilyTree.objects.get(global_ultimate_duns="111111111")
+        assert family_tree.member_duns_numbers == ["111111111", "333333333"]
+        assert timezone.now() - family_tree.last_refreshed < timedelta(minutes=1)
+
+
+def _hierarchy_page(page_number, members, next_url=None, page_size=2, members_count=5, last_url=None):
+    links = {
+        "self": f"https://plus.dnb.com/v1/familyTree/111111111?page%5Bnumber%5D={page_number}"
+                f"&page%5Bsize%5D={page_size}",
+    }
+    if next_url:
+        links["next"] = next_url
+    if last_url:
+        links["last"] = last_url
+
+    return {
+        "inquiryDetail": {"duns": "111111111", "page[size]": page_size},
+        "globalUltimateDuns": "111111111",
+        "globalUltimateFamilyTreeMembersCount": members_count,
+        "branchesExcludedMembersCount": 0,
+        "familyTreeMembers": [{"duns": duns} for duns in members],
+        "links": links,
+    }
+
+
+def _page_url(page_number, page_size=2):
+    return f"https://plus.dnb.com/v1/familyTree/111111111?page%5Bnumber%5D={page_number}&page%5Bsize%5D={page_size}"
+
+
+@pytest.mark.django_db
+def test_company_hierarchy_pages_are_fetched_concurrently_in_order(mocker, settings):
+    settings.DNB_API_MAX_CONCURRENCY = 5
+
+    pages = {
+        "v1/familyTree/111111111": _hierarchy_page(1, ["1", "2"], next_url=_page_url(2)),
+        _page_url(2): _hierarchy_page(2, ["3", "4"], next_url=_page_url(3)),
+        _page_url(3): _hierarchy_page(3, ["5"]),
+    }
+
+    mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+    mock_api_request.side_effect = lambda method, url: ApiHierarchyRequestJsonFake(pages[url])
+    mock_map_concurrently = mocker.patch(
+        "dnb_direct_plus.api.map_concurrently",
+        side_effect=lambda func, items: list(reversed([func(item) for item in reversed(items)])),
+    )
+
+    output = company_hierarchy_list_search({"duns_number": "111111111"})
+
+    assert [member["duns"] for member in output["family_tree_members"]] == ["1", "2", "3", "4", "5"]
+    mock_map_concurrently.assert_called_once_with(mocker.ANY, [_page_url(2), _page_url(3)])
+    assert mock_api_request.call_count == 3
+
+
+@pytest.mark.django_db
+def test_company_hierarchy_pages_fall_back_to_next_links(mocker):
+    next_url = "https://plus.dnb.com/v1/familyTree/111111111?cursor=abc"
+    pages = {
+        "v1/familyTree/111111111": _hierarchy_page(1, ["1", "2"], next_url=next_url),
+        next_url: _hierarchy_page(2, ["3"]),
+    }
+
+    mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+    mock_api_request.side_effect = lambda method, url: ApiHierarchyRequestJsonFake(pages[url])
+    mock_map_concurrently = mocker.patch("dnb_direct_plus.api.map_concurrently")
+
+    output = company_hierarchy_list_search({"duns_number": "111111111"})
+
+    assert [member["duns"] for member in output["family_tree_members"]] == ["1", "2", "3"]
+    assert not mock_map_concurrently.called
+
+
+@pytest.mark.django_db
+def test_company_hierarchy_pages_beyond_prediction_are_followed(mocker):
+    pages = {
+        "v1/familyTree/111111111": _hierarchy_page(1, ["1", "2"], next_url=_page_url(2), members_count=4),
+        _page_url(2): _hierarchy_page(2, ["3", "4"], next_url=_page_url(3), members_count=4),
+        _page_url(3): _hierarchy_page(3, ["5"], members_count=4),
+    }
+
+    mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+    mock_api_request.side_effect = lambda method, url: ApiHierarchyRequestJsonFake(pages[url])
+
+    output = company_hierarchy_list_search({"duns_number": "111111111"})
+
+    assert [member["duns"] for member in output["family_tree_members"]] == ["1", "2", "3", "4", "5"]
+
+
+@pytest.mark.django_db
+def test_company_hierarchy_page_count_is_bounded_by_the_last_link(mocker):
+    pages = {
+        "v1/familyTree/111111111": _hierarchy_page(
+            1, ["1", "2"], next_url=_page_url(2), members_count=10, last_url=_page_url(2),
+        ),
+        _page_url(2): _hierarchy_page(2, ["3"], members_count=10),
+    }
+
+    mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+    mock_api_request.side_effect = lambda method, url: ApiHierarchyRequestJsonFake(pages[url])
+
+    output = company_hierarchy_list_search({"duns_number": "111111111"})
+
+    assert [member["duns"] for member in output["family_tree_members"]] == ["1", "2", "3"]
+    assert mock_api_request.call_count == 2
+
+
+@pytest.mark.django_db
+def test_company_hierarchy_pages_predicted_past_the_end_are_ignored(mocker):
+    pages = {
+        "v1/familyTree/111111111": _hierarchy_page(1, ["1", "2"], next_url=_page_url(2), members_count=6),
+        _page_url(2): _hierarchy_page(2, ["3", "4"], members_count=6),
+        _page_url(3): {},
+    }
+
+    mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+    mock_api_request.side_effect = lambda method, url: ApiHierarchyRequestJsonFake(pages[url])
+
+    output = company_hierarchy_list_search({"duns_number": "111111111"})
+
+    assert [member["duns"] for member in output["family_tree_members"]] == ["1", "2", "3", "4"]
+
+
+@pytest.mark.parametrize("next_url", [
+    _page_url(2),
+    "https://plus.dnb.com/v1/familyTree/111111111?cursor=abc",
+])
+@pytest.mark.django_db
+def test_missing_company_hierarchy_page_raises(mocker, next_url):
+    pages = {
+        "v1/familyTree/111111111": _hierarchy_page(1, ["1", "2"], next_url=next_url),
+        next_url: {},
+        _page_url(3): _hierarchy_page(3, ["5"]),
+    }
+
+    mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+    mock_api_request.side_effect = lambda method, url: ApiHierarchyRequestJsonFake(pages[url])
+
+    with pytest.raises(DNBApiUnavailableError):
+        company_hierarchy_list_search({"duns_number": "111111111"})
+
+    assert not FamilyTree.objects.exists()
+
+
+@pytest.mark.django_db
+def test_company_hierarchy_list_stream_requests_later_pages_lazily(mocker):
+    next_url = "https://plus.dnb.com/v1/familyTree/111111111?cursor=abc"
+    pages = {
+        "v1/familyTree/111111111": _hierarchy_page(1, ["1", "2"], next_url=next_url),
+        next_url: _hierarchy_page(2, ["3"]),
+    }
+
+    mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
+    mock_api_request.side_effect = lambda method, url: ApiHierarchyRequestJsonFake(pages[url])
+
+    summary, members = company_hierarchy_list_stream({"duns_number": "111111111"})
+
+    assert summary == {
+        "global_ultimate_duns": "111111111",
+        "global_ultimate_family_tree_members_count": 5,
+        "branches_excluded_members_count": 0,
+    }
+    assert mock_api_request.call_count == 1
+
+    assert [member["duns"] for member in members] == ["1", "2", "3"]
+    assert mock_api_request.call_count == 2
+
+
+@pytest.mark.django_db
 def test_company_hierarchy_count_returns_value(mocker):
     mock_api_request = mocker.patch("dnb_direct_plus.api.api_request")
     mock_api_request.side_effect = (
@@ -1,19 +1,53 @@
+import asyncio
+import threading
+import time
+
 import pytest
 
 from freezegun import freeze_time
+from requests.exceptions import ConnectionError, ConnectTimeout, HTTPError, ReadTimeout
 from requests_mock import ANY
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError, ReadTimeoutError
 
+from .. import client
 from ..client import (
     _authenticate,
     _renew_token,
     ACCESS_TOKEN_KEY,
     ACCESS_TOKEN_LOCK_KEY,
+    api_request,
+    async_api_request,
+    cache_response,
+    check_circuit,
+    CIRCUIT_CLOSED,
+    CIRCUIT_FAILURES_KEY,
+    CIRCUIT_HALF_OPEN,
+    CIRCUIT_OPEN,
+    CIRCUIT_OPEN_KEY,
+    ConnectionResetRetry,
+    deadline,
+    DNBApiCircuitOpenError,
     DNBApiError,
+    DNBApiRateLimitError,
+    DNBApiTimeoutError,
+    DNBApiUnavailableError,
     get_access_token,
+    get_cached_response,
+    get_circuit_state,
+    get_endpoint_name,
+    get_hedge_delay,
+    get_remaining_time,
+    get_response_cache_key,
+    get_session,
     is_token_valid,
+    map_concurrently,
+    record_failure,
+    record_success,
     redis_client as _redis_client,
+    release_probe,
     RENEW_ACCESS_TOKEN_MAX_ATTEMPTS,
     renew_token_if_close_to_expiring,
+    wait_for_rate_limit,
 )
 
 
@@ -25,6 +59,11 @@ def redis_client():
         _redis_client.flushall()
 
 
+@pytest.fixture(autouse=True)
+def clear_cached_token(mocker):
+    mocker.patch('dnb_direct_plus.client._cached_token', (None, 0))
+
+
 class TestGetAccessToken:
     def test_eventually_throws_exception(self, mocker):
         mock_is_token_valid = mocker.patch('dnb_direct_plus.client.is_token_valid', return_value=False)
@@ -48,6 +87,54 @@ class TestGetAccessToken:
 
         assert get_access_token() == token_data[ACCESS_TOKEN_KEY]
 
+    @freeze_time('2019-05-01 12:00:00')
+    def test_token_is_cached_locally(self, redis_client, mocker):
+        redis_client.set(ACCESS_TOKEN_KEY, 'an-access-token', ex=1000)
+
+        assert get_access_token() == 'an-access-token'
+
+        mock_is_token_valid = mocker.patch('dnb_direct_plus.client.is_token_valid')
+
+        assert get_access_token() == 'an-access-token'
+        assert not mock_is_token_valid.called
+
+    @freeze_time('2019-05-01 12:00:00')
+    def test_token_close_to_expiring_is_not_cached_locally(self, settings, redis_client, mocker):
+        settings.DNB_API_RENEW_ACCESS_TOKEN_SECONDS_REMAINING = 300
+        redis_client.set(ACCESS_TOKEN_KEY, 'an-access-token', ex=200)
+
+        assert get_access_token() == 'an-access-token'
+
+        mock_is_token_valid = mocker.patch('dnb_direct_plus.client.is_token_valid', return_value=True)
+
+        assert get_access_token() == 'an-access-token'
+        assert mock_is_token_valid.called
+
+
+@freeze_time('2019-05-01 12:00:00')
+class TestApiRequest:
+    def test_rejected_token_is_renewed(self, redis_client, requests_mock, mocker):
+        redis_client.set(ACCESS_TOKEN_KEY, 'a-revoked-token', ex=1000)
+
+        mocker.patch(
+            'dnb_direct_plus.client._authenticate',
+            return_value={'access_token': 'a-new-token', 'expiresIn': 1000},
+        )
+        requests_mock.get(
+            'https://plus.dnb.com/v1/data/duns/123456789',
+            [
+                {'status_code': 401, 'json': {'error': {}}},
+                {'status_code': 200, 'json': {'organization': {}}},
+            ],
+        )
+
+        response = api_request('GET', '/v1/data/duns/123456789')
+
+        assert response.json() == {'organization': {}}
+        assert requests_mock.request_history[0].headers['Authorization'] == 'Bearer a-revoked-token'
+        assert requests_mock.request_history[1].headers['Authorization'] == 'Bearer a-new-token'
+        assert redis_client.get(ACCESS_TOKEN_KEY) == 'a-new-token'
+
 
 @freeze_time('2019-05-01 12:00:00')
 class TestRenewToken:
@@ -142,3 +229,527 @@ class TestGetDnbAccessToken:
 
         with pytest.raises(Exception):
             _authenticate()
+
+
+class TestGetSession:
+    def test_session_is_reused(self):
+        assert get_session() is get_session()
+
+    def test_session_is_recreated_after_fork(self, mocker):
+        session = get_session()
+
+        mocker.patch('dnb_direct_plus.client.os.getpid', return_value=client._session_pid + 1)
+
+        assert get_session() is not session
+
+    def test_adapter_uses_pool_settings(self, settings, mocker):
+        settings.DNB_API_POOL_MAXSIZE = 25
+        mocker.patch('dnb_direct_plus.client._session', None)
+
+        adapter = get_session().get_adapter('https://plus.dnb.com')
+
+        assert adapter._pool_maxsize == 25
+        assert isinstance(adapter.max_retries, ConnectionResetRetry)
+
+    def test_adapter_retries_a_reset_connection_once(self):
+        retry = get_session().get_adapter('https://plus.dnb.com').max_retries
+        error = ProtocolError('Connection aborted.', ConnectionResetError(104, 'Connection reset by peer'))
+
+        retry = retry.increment('POST', '/v1/search/companyList', error=error)
+
+        with pytest.raises(MaxRetryError):
+            retry.increment('POST', '/v1/search/companyList', error=error)
+
+    @pytest.mark.parametrize('error, expected_exception', [
+        (ReadTimeoutError(None, '/v1/search/companyList', 'Read timed out.'), ReadTimeoutError),
+        (NewConnectionError(None, 'Connection refused'), MaxRetryError),
+    ])
+    def test_adapter_does_not_retry_other_errors(self, error, expected_exception):
+        retry = get_session().get_adapter('https://plus.dnb.com').max_retries
+
+        with pytest.raises(expected_exception):
+            retry.increment('GET', '/v1/data/duns/123456789', error=error)
+
+    def test_requests_share_session(self, requests_mock, mocker):
+        requests_mock.post(ANY, status_code=200, json={'access_token': 'a-token', 'expiresIn': 100})
+        spy = mocker.spy(get_session(), 'request')
+
+        _authenticate()
+        _authenticate()
+
+        assert spy.call_count == 2
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('/v1/match/cleanseMatch', '/v1/match/cleanseMatch'),
+    ('/v1/data/duns/123456789', '/v1/data/duns'),
+    ('v1/familyTree/123456789', '/v1/familyTree'),
+    ('https://plus.dnb.com/v1/familyTree/123456789?page%5Bnumber%5D=2', '/v1/familyTree'),
+    ('/v1/something/else', '/v1/something/else'),
+])
+def test_get_endpoint_name(path, expected):
+    assert get_endpoint_name(path) == expected
+
+
+class TestWaitForRateLimit:
+    def test_requests_within_limit_are_not_delayed(self, settings, redis_client, mocker):
+        settings.DNB_API_RATE_LIMITS = {'/v1/data/duns': 3}
+        mock_sleep = mocker.patch('dnb_direct_plus.client.time.sleep')
+
+        for _ in range(3):
+            wait_for_rate_limit('/v1/data/duns')
+
+        assert not mock_sleep.called
+
+    def test_requests_over_limit_wait_for_capacity(self, settings, redis_client, mocker):
+        settings.DNB_API_RATE_LIMITS = {'/v1/data/duns': 1}
+        mock_sleep = mocker.patch('dnb_direct_plus.client.time.sleep')
+        mock_script = mocker.patch('dnb_direct_plus.client.rate_limit_script', side_effect=[
+            [0, '0.5', '0.5'],
+            [1, '0', '0'],
+        ])
+
+        wait_for_rate_limit('/v1/data/duns', max_wait=1)
+
+        mock_sleep.assert_called_once_with(0.5)
+        assert mock_script.call_count == 2
+
+    def test_raises_exception_if_capacity_is_not_available_in_time(self, settings, redis_client, mocker):
+        settings.DNB_API_RATE_LIMITS = {'/v1/data/duns': 1}
+        mock_sleep = mocker.patch('dnb_direct_plus.client.time.sleep')
+
+        wait_for_rate_limit('/v1/data/duns', max_wait=0)
+
+        with pytest.raises(DNBApiRateLimitError):
+            wait_for_rate_limit('/v1/data/duns', max_wait=0)
+
+        assert not mock_sleep.called
+
+    def test_endpoints_have_separate_budgets(self, settings, redis_client):
+        settings.DNB_API_RATE_LIMITS = {'/v1/data/duns': 1, '/v1/familyTree': 1}
+
+        wait_for_rate_limit('/v1/data/duns', max_wait=0)
+        wait_for_rate_limit('/v1/familyTree', max_wait=0)
+
+    def test_zero_limit_disables_rate_limiting(self, settings, mocker):
+        settings.DNB_API_RATE_LIMITS = {'/v1/data/duns': 0}
+        mock_script = mocker.patch('dnb_direct_plus.client.rate_limit_script')
+
+        wait_for_rate_limit('/v1/data/duns', max_wait=0)
+
+        assert not mock_script.called
+
+
+class TestCircuitBreaker:
+    endpoint = '/v1/match/cleanseMatch'
+
+    def test_circuit_opens_after_repeated_failures(self, settings, redis_client):
+        settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD = 3
+
+        for _ in range(2):
+            record_failure(self.endpoint)
+
+        assert get_circuit_state(self.endpoint) == CIRCUIT_CLOSED
+
+        record_failure(self.endpoint)
+
+        assert get_circuit_state(self.endpoint) == CIRCUIT_OPEN
+        with pytest.raises(DNBApiCircuitOpenError):
+            check_circuit(self.endpoint)
+
+    def test_success_resets_failure_count(self, settings, redis_client):
+        settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD = 2
+
+        record_failure(self.endpoint)
+        record_success(self.endpoint)
+        record_failure(self.endpoint)
+
+        assert get_circuit_state(self.endpoint) == CIRCUIT_CLOSED
+
+    def test_success_without_failures_does_not_call_redis(self, redis_client, mocker):
+        mock_pipeline = mocker.patch.object(redis_client, 'pipeline')
+
+        record_success(self.endpoint, CIRCUIT_CLOSED, failures=0)
+
+        assert not mock_pipeline.called
+
+    @freeze_time('2019-05-01 12:00:00')
+    def test_successful_request_resets_failure_count(self, settings, redis_client, requests_mock):
+        settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD = 2
+        redis_client.set(ACCESS_TOKEN_KEY, 'an-access-token', ex=1000)
+        requests_mock.get('https://plus.dnb.com/v1/match/cleanseMatch', status_code=200, json={})
+
+        record_failure(self.endpoint)
+        api_request('GET', self.endpoint)
+
+        assert not redis_client.exists(CIRCUIT_FAILURES_KEY.format(self.endpoint))
+
+    def test_half_open_circuit_allows_a_single_probe(self, settings, redis_client):
+        settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD = 1
+
+        record_failure(self.endpoint)
+        redis_client.delete(CIRCUIT_OPEN_KEY.format(self.endpoint))
+
+        assert check_circuit(self.endpoint) == CIRCUIT_HALF_OPEN
+        with pytest.raises(DNBApiCircuitOpenError):
+            check_circuit(self.endpoint)
+
+    def test_successful_probe_closes_circuit(self, settings, redis_client):
+        settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD = 1
+
+        record_failure(self.endpoint)
+        redis_client.delete(CIRCUIT_OPEN_KEY.format(self.endpoint))
+
+        record_success(self.endpoint, check_circuit(self.endpoint))
+
+        assert get_circuit_state(self.endpoint) == CIRCUIT_CLOSED
+        assert check_circuit(self.endpoint) == CIRCUIT_CLOSED
+
+    def test_failed_probe_opens_circuit(self, settings, redis_client):
+        settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD = 1
+
+        record_failure(self.endpoint)
+        redis_client.delete(CIRCUIT_OPEN_KEY.format(self.endpoint))
+
+        record_failure(self.endpoint, check_circuit(self.endpoint))
+
+        assert get_circuit_state(self.endpoint) == CIRCUIT_OPEN
+
+    def test_released_probe_can_be_claimed_again(self, settings, redis_client):
+        settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD = 1
+
+        record_failure(self.endpoint)
+        redis_client.delete(CIRCUIT_OPEN_KEY.format(self.endpoint))
+
+        check_circuit(self.endpoint)
+        release_probe(self.endpoint)
+
+        assert check_circuit(self.endpoint) == CIRCUIT_HALF_OPEN
+
+    @freeze_time('2019-05-01 12:00:00')
+    def test_rate_limited_probe_is_released(self, settings, redis_client, requests_mock, mocker):
+        settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD = 1
+        redis_client.set(ACCESS_TOKEN_KEY, 'an-access-token', ex=1000)
+        mocker.patch('dnb_direct_plus.client.time.sleep')
+        mocker.patch(
+            'dnb_direct_plus.client.wait_for_rate_limit',
+            side_effect=[DNBApiRateLimitError('Rate limit for /v1/match/cleanseMatch exceeded'), None],
+        )
+        requests_mock.get('https://plus.dnb.com/v1/match/cleanseMatch', status_code=200, json={})
+
+        record_failure(self.endpoint)
+        redis_client.delete(CIRCUIT_OPEN_KEY.format(self.endpoint))
+
+        with pytest.raises(DNBApiRateLimitError):
+            api_request('GET', self.endpoint)
+
+        api_request('GET', self.endpoint)
+
+        assert requests_mock.call_count == 1
+        assert get_circuit_state(self.endpoint) == CIRCUIT_CLOSED
+
+    @freeze_time('2019-05-01 12:00:00')
+    def test_server_errors_open_circuit_and_fail_fast(self, settings, redis_client, requests_mock, mocker):
+        settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD = 2
+        redis_client.set(ACCESS_TOKEN_KEY, 'an-access-token', ex=1000)
+        mocker.patch('dnb_direct_plus.client.time.sleep')
+
+        requests_mock.get('https://plus.dnb.com/v1/match/cleanseMatch', status_code=503)
+
+        with pytest.raises(DNBApiCircuitOpenError):
+            api_request('GET', self.endpoint)
+
+        assert requests_mock.call_count == 2
+
+    @freeze_time('2019-05-01 12:00:00')
+    def test_client_errors_do_not_count_as_failures(self, settings, redis_client, requests_mock):
+        settings.DNB_API_CIRCUIT_FAILURE_THRESHOLD = 1
+        redis_client.set(ACCESS_TOKEN_KEY, 'an-access-token', ex=1000)
+
+        requests_mock.get('https://plus.dnb.com/v1/match/cleanseMatch', status_code=404)
+
+        with pytest.raises(HTTPError):
+            api_request('GET', self.endpoint)
+
+        assert get_circuit_state(self.endpoint) == CIRCUIT_CLOSED
+
+
+class TestDeadline:
+    def test_no_deadline(self):
+        assert get_remaining_time() is None
+
+    def test_nested_deadline_cannot_extend_budget(self):
+        with deadline(5):
+            with deadline(10):
+                assert get_remaining_time() <= 5
+
+            with deadline(1):
+                assert get_remaining_time() <= 1
+
+        assert get_remaining_time() is None
+
+
+@freeze_time('2019-05-01 12:00:00')
+class TestApiRequestTimeouts:
+    @pytest.fixture(autouse=True)
+    def access_token(self, redis_client):
+        redis_client.set(ACCESS_TOKEN_KEY, 'an-access-token', ex=1000)
+
+    def test_endpoint_timeouts_are_used(self, settings, requests_mock):
+        settings.DNB_API_TIMEOUTS = {'/v1/familyTree': (1, 60)}
+
+        requests_mock.get(ANY, json={})
+
+        api_request('GET', 'v1/familyTree/123456789')
+        api_request('GET', '/v1/data/duns/123456789')
+
+        assert requests_mock.request_history[0].timeout == (1, 60)
+        assert requests_mock.request_history[1].timeout == (
+            settings.DNB_API_CONNECT_TIMEOUT_SECONDS, settings.DNB_API_READ_TIMEOUT_SECONDS,
+        )
+
+    def test_timeouts_are_limited_by_deadline(self, requests_mock):
+        requests_mock.get(ANY, json={})
+
+        with deadline(2):
+            api_request('GET', '/v1/data/duns/123456789')
+
+        connect_timeout, read_timeout = requests_mock.request_history[0].timeout
+        assert connect_timeout + read_timeout <= 2
+
+    @pytest.mark.parametrize('wait_seconds, expected_timeout', [(0, (2.5, 2.5)), (4, (0.5, 0.5))])
+    def test_timeouts_are_limited_by_deadline_left_after_rate_limit_wait(
+        self, requests_mock, mocker, wait_seconds, expected_timeout,
+    ):
+        now = [0]
+        mocker.patch('dnb_direct_plus.client.time.monotonic', side_effect=lambda: now[0])
+        mocker.patch(
+            'dnb_direct_plus.client.wait_for_rate_limit',
+            side_effect=lambda *args, **kwargs: now.__setitem__(0, now[0] + wait_seconds),
+        )
+        requests_mock.get(ANY, json={})
+
+        with deadline(5):
+            api_request('GET', '/v1/data/duns/123456789')
+
+        assert requests_mock.request_history[0].timeout == pytest.approx(expected_timeout)
+
+    def test_request_is_not_sent_when_rate_limit_wait_uses_up_deadline(self, requests_mock, mocker):
+        now = [0]
+        mocker.patch('dnb_direct_plus.client.time.monotonic', side_effect=lambda: now[0])
+        mocker.patch(
+            'dnb_direct_plus.client.wait_for_rate_limit',
+            side_effect=lambda *args, **kwargs: now.__setitem__(0, 5),
+        )
+        requests_mock.get(ANY, json={})
+
+        with deadline(5):
+            with pytest.raises(DNBApiTimeoutError):
+                api_request('GET', '/v1/data/duns/123456789')
+
+        assert requests_mock.call_count == 0
+
+    def test_request_is_not_sent_after_deadline(self, requests_mock):
+        requests_mock.get(ANY, json={})
+
+        with deadline(0):
+            with pytest.raises(DNBApiTimeoutError):
+                api_request('GET', '/v1/data/duns/123456789')
+
+        assert requests_mock.call_count == 0
+
+    def test_retries_stop_at_deadline(self, requests_mock, mocker):
+        now = [0]
+        mocker.patch('dnb_direct_plus.client.time.monotonic', side_effect=lambda: now[0])
+        # the backoff before the retry takes the request past the deadline
+        mocker.patch('time.sleep', side_effect=lambda seconds: now.__setitem__(0, now[0] + 11))
+        requests_mock.get(ANY, exc=ReadTimeout)
+
+        with deadline(10):
+            with pytest.raises(DNBApiTimeoutError):
+                api_request('GET', '/v1/data/duns/123456789')
+
+        assert requests_mock.call_count == 1
+
+    @pytest.mark.parametrize('exception, expected_exception', [
+        (ReadTimeout, DNBApiTimeoutError),
+        (ConnectTimeout, DNBApiTimeoutError),
+        (ConnectionError, DNBApiUnavailableError),
+    ])
+    def test_network_errors_are_raised_as_dnb_api_errors(
+        self, settings, requests_mock, mocker, exception, expected_exception,
+    ):
+        settings.DNB_API_MAX_RETRY_SECONDS = 0
+        requests_mock.get(ANY, exc=exception)
+
+        with pytest.raises(expected_exception):
+            api_request('GET', '/v1/data/duns/123456789')
+
+
+class TestHedgedRequests:
+    @pytest.fixture(autouse=True)
+    def hedging_settings(self, settings, mocker):
+        settings.DNB_API_HEDGED_ENDPOINTS = ['/v1/data/duns']
+        settings.DNB_API_HEDGE_DEFAULT_DELAY_SECONDS = 0.01
+        mocker.patch('dnb_direct_plus.client._latencies', client.defaultdict(list))
+
+    def test_fast_response_is_not_hedged(self, mocker):
+        mock_request = mocker.patch('dnb_direct_plus.client._authenticated_api_request', return_value='response')
+
+        assert api_request('GET', '/v1/data/duns/123456789') == 'response'
+        assert mock_request.call_count == 1
+
+    @pytest.mark.parametrize('method, path', [
+        ('POST', '/v1/data/duns/123456789'),
+        ('GET', '/v1/search/companyList'),
+    ])
+    def test_only_get_requests_to_hedged_endpoints_are_hedged(self, mocker, method, path):
+        mock_hedged_request = mocker.patch('dnb_direct_plus.client._hedged_api_request')
+        mocker.patch('dnb_direct_plus.client._authenticated_api_request', return_value='response')
+
+        assert api_request(method, path) == 'response'
+        assert not mock_hedged_request.called
+
+    def test_slow_response_is_hedged(self, mocker):
+        release_primary = threading.Event()
+        calls = []
+
+        def _request(method, url, **kwargs):
+            calls.append(url)
+            if len(calls) == 1:
+                release_primary.wait(5)
+                return 'primary-response'
+            return 'hedge-response'
+
+        mocker.patch('dnb_direct_plus.client._authenticated_api_request', side_effect=_request)
+
+        try:
+            assert api_request('GET', '/v1/data/duns/123456789') == 'hedge-response'
+        finally:
+            release_primary.set()
+
+        assert calls == ['/v1/data/duns/123456789', '/v1/data/duns/123456789']
+
+    def test_failed_hedge_falls_back_to_primary(self, mocker):
+        release_primary = threading.Event()
+        calls = []
+
+        def _request(method, url, **kwargs):
+            calls.append(url)
+            if len(calls) == 1:
+                release_primary.wait(5)
+                return 'primary-response'
+            release_primary.set()
+            raise HTTPError('hedge failed')
+
+        mocker.patch('dnb_direct_plus.client._authenticated_api_request', side_effect=_request)
+
+        assert api_request('GET', '/v1/data/duns/123456789') == 'primary-response'
+
+    def test_hedge_delay_uses_percentile_of_recent_latencies(self, settings):
+        settings.DNB_API_HEDGE_MIN_SAMPLES = 10
+        settings.DNB_API_HEDGE_PERCENTILE = 90
+        settings.DNB_API_HEDGE_MIN_DELAY_SECONDS = 0.1
+
+        assert get_hedge_delay('/v1/data/duns') == 0.01
+
+        client._latencies['/v1/data/duns'].extend(n / 10 for n in range(1, 11))
+
+        assert get_hedge_delay('/v1/data/duns') == 1.0
+
+
+class TestConcurrentRequests:
+    def test_async_api_request(self, mocker):
+        mock_api_request = mocker.patch('dnb_direct_plus.client.api_request', return_value='response')
+
+        response = asyncio.run(async_api_request('GET', '/v1/data/duns/123456789', params={'a': 'b'}))
+
+        assert response == 'response'
+        mock_api_request.assert_called_once_with('GET', '/v1/data/duns/123456789', params={'a': 'b'})
+
+    def test_results_are_returned_in_order(self):
+        def _slow_echo(item):
+            time.sleep(0.01 * (5 - item))
+            return item
+
+        assert map_concurrently(_slow_echo, range(5)) == [0, 1, 2, 3, 4]
+
+    def test_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        in_flight = []
+        max_in_flight = []
+
+        def _call(item):
+            with lock:
+                in_flight.append(item)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.02)
+            with lock:
+                in_flight.remove(item)
+
+        map_concurrently(_call, range(10), max_concurrency=3)
+
+        assert max(max_in_flight) <= 3
+
+    def test_exceptions(self):
+        def _call(item):
+            if item == 1:
+                raise DNBApiError('failed')
+            return item
+
+        with pytest.raises(DNBApiError):
+            map_concurrently(_call, range(3))
+
+        results = map_concurrently(_call, range(3), return_exceptions=True)
+
+        assert results[0] == 0
+        assert isinstance(results[1], DNBApiError)
+        assert results[2] == 2
+
+    def test_deadline_is_shared_with_concurrent_calls(self):
+        with deadline(10):
+            remaining = map_concurrently(lambda _: get_remaining_time(), range(2))
+
+        assert all(0 < seconds <= 10 for seconds in remaining)
+
+
+class TestResponseCache:
+    @pytest.fixture(autouse=True)
+    def enable_cache(self, settings, redis_client):
+        settings.DNB_API_SEARCH_CACHE_TTL_SECONDS = 60
+        settings.DNB_API_SEARCH_CACHE_MAX_BYTES = 100
+
+    def test_cached_response_is_returned(self):
+        assert get_cached_response('POST', '/v1/search/companyList', json={'searchTerm': 'a'}) is None
+
+        cache_response({'total': 1}, 'POST', '/v1/search/companyList', json={'searchTerm': 'a'})
+
+        assert get_cached_response('POST', '/v1/search/companyList', json={'searchTerm': 'a'}) == {'total': 1}
+        assert get_cached_response('POST', '/v1/search/companyList', json={'searchTerm': 'b'}) is None
+
+    def test_cache_expires(self):
+        cache_response({'total': 1}, 'GET', '/v1/match/cleanseMatch', params={'name': 'a'})
+
+        ttl = _redis_client.ttl(get_response_cache_key('GET', '/v1/match/cleanseMatch', params={'name': 'a'}))
+
+        assert 0 < ttl <= 60
+
+    def test_key_does_not_depend_on_query_order(self):
+        assert get_response_cache_key(
+            'GET', '/v1/match/cleanseMatch', params={'name': 'a', 'countryISOAlpha2Code': 'GB'},
+        ) == get_response_cache_key(
+            'GET', '/v1/match/cleanseMatch', params={'countryISOAlpha2Code': 'GB', 'name': 'a'},
+        )
+
+    def test_large_responses_are_not_cached(self):
+        cache_response({'name': 'a' * 100}, 'POST', '/v1/search/companyList', json={})
+
+        assert get_cached_response('POST', '/v1/search/companyList', json={}) is None
+
+    def test_cache_disabled(self, settings):
+        settings.DNB_API_SEARCH_CACHE_TTL_SECONDS = 0
+
+        cache_response({'total': 1}, 'POST', '/v1/search/companyList', json={})
+
+        assert get_cached_response('POST', '/v1/search/companyList', json={}) is None
+        assert not _redis_client.keys()
@@ -1,13 +1,25 @@
+import io
 import json
+from datetime import timedelta
 
 import pytest
 from django.conf import settings
+from django.core.management import call_command
+from django.utils import timezone
 
+from company.models import Company
+from dnb_direct_plus.client import redis_client
 from dnb_direct_plus.tasks import (
+    COMPANY_UPDATE_PENDING_KEY,
+    MONITORING_FILE_LOCK_KEY,
+    MonitoringFileLockedError,
+    process_monitoring_file,
     process_updates_from_dnb_api_monitoring_data,
+    refresh_stale_family_trees,
+    schedule_company_update,
 )
 from company.tests.factories import CompanyFactory
-from ..models import MonitoringFileRecord
+from ..models import FailedNotificationLine, FamilyTree, MonitoringFileProgress, MonitoringFileRecord
 
 
 pytestmark = [pytest.mark.django_db]
@@ -58,7 +70,9 @@ class TestProcessMonitoringData:
         mocked_handler.return_value = (
             100,
             10,
+            4,
         )
+        MonitoringFileProgress.objects.create(file_name=file_name, last_line_number=50, total=50)
 
         process_updates_from_dnb_api_monitoring_data.apply()
 
@@ -67,9 +81,11 @@ class TestProcessMonitoringData:
         assert record.file_name == file_name
         assert record.total == 100
         assert record.failed == 90
+        assert record.unchanged == 4
+        assert not MonitoringFileProgress.objects.exists()
 
         assert f'Processing: {file_name}' in caplog.text
-        assert f'{file_name}\t\tTotal: 100\tFailed: 90' in caplog.text
+        assert f'{file_name}\t\tTotal: 100\tFailed: 90\tUnchanged: 4' in caplog.text
 
     def test_exceptions_kill_the_ingest_pipeline(self, mocker, caplog):
         assert MonitoringFileRecord.objects.count() == 0
@@ -102,6 +118,7 @@ class TestProcessMonitoringData:
         mocked_handler.return_value = (
             100,
             10,
+            4,
         )
 
         mocked_archive_file = mocker.patch(
@@ -161,3 +178,154 @@ class TestProcessMonitoringData:
         assert record.total == 2
         assert record.failed == 1
         assert 'A total of 1 companies were updated.' in caplog.text
+
+
+class TestProcessMonitoringFile:
+    @pytest.fixture(autouse=True)
+    def flush_redis(self):
+        yield
+        redis_client.flushall()
+
+    def test_files_are_processed_in_timestamp_order(self, mocker):
+        file_names = [
+            f'{settings.DNB_MONITORING_REGISTRATION_REFERENCE}_20191026205213_NOTIFICATION_1.zip',
+            f'{settings.DNB_MONITORING_REGISTRATION_REFERENCE}_20191025205213_NOTIFICATION_2.zip',
+            f'{settings.DNB_MONITORING_REGISTRATION_REFERENCE}_20191025205213_NOTIFICATION_1.zip',
+        ]
+
+        mocked = mocker.patch('dnb_direct_plus.s3_client.S3Client.list_files')
+        mocked.return_value = file_names
+        mocked_handler = mocker.patch('dnb_direct_plus.tasks.process_notification_file')
+        mocked_handler.return_value = (1, 1, 0)
+
+        process_updates_from_dnb_api_monitoring_data.apply()
+
+        processed = [mocker_call.args[0].rsplit('/', 1)[-1] for mocker_call in mocked_handler.call_args_list]
+        assert processed[-1] == file_names[0]
+        assert set(processed[:2]) == set(file_names[1:])
+        assert MonitoringFileRecord.objects.count() == 3
+
+    def test_notification_files_are_processed_in_shards(self, mocker, settings):
+        settings.DNB_MONITORING_SHARDS = 3
+        file_name = f'{settings.DNB_MONITORING_REGISTRATION_REFERENCE}_20191025205213_NOTIFICATION_1.zip'
+        mocked_handler = mocker.patch('dnb_direct_plus.tasks.process_notification_file')
+        mocked_handler.return_value = (2, 1, 1)
+
+        process_monitoring_file.apply(args=[file_name])
+
+        assert [mocker_call.kwargs for mocker_call in mocked_handler.call_args_list] == [
+            {'shard': shard, 'shards': 3} for shard in range(3)
+        ]
+        record = MonitoringFileRecord.objects.get(file_name=file_name)
+        assert (record.total, record.failed, record.unchanged) == (6, 3, 3)
+        assert not redis_client.exists(MONITORING_FILE_LOCK_KEY.format(file_name))
+
+    def test_locked_files_are_not_processed(self, mocker):
+        file_name = f'{settings.DNB_MONITORING_REGISTRATION_REFERENCE}_20191025205213_NOTIFICATION_1.zip'
+        redis_client.set(MONITORING_FILE_LOCK_KEY.format(file_name), 1)
+        mocked_handler = mocker.patch('dnb_direct_plus.tasks.process_notification_file')
+
+        with pytest.raises(MonitoringFileLockedError):
+            process_monitoring_file(file_name)
+
+        assert not mocked_handler.called
+        assert MonitoringFileRecord.objects.count() == 0
+
+    def test_lock_is_released_when_processing_fails(self, mocker):
+        file_name = f'{settings.DNB_MONITORING_REGISTRATION_REFERENCE}_20191025205213_NOTIFICATION_1.zip'
+        mocked_handler = mocker.patch('dnb_direct_plus.tasks.process_notification_file')
+        mocked_handler.side_effect = Exception('Something has gone wrong.')
+
+        with pytest.raises(Exception):
+            process_monitoring_file(file_name)
+
+        assert not redis_client.exists(MONITORING_FILE_LOCK_KEY.format(file_name))
+        assert MonitoringFileRecord.objects.count() == 0
+
+
+class TestReplayFailedNotificationLinesCommand:
+    def test_command(self):
+        FailedNotificationLine.objects.create(
+            file_name=f'{settings.DNB_MONITORING_REGISTRATION_REFERENCE}_20191025205213_NOTIFICATION_1.zip',
+            line_number=1,
+            reason='KeyError',
+            update_data={'organization': {'duns': '111111111'}},
+        )
+        out = io.StringIO()
+
+        call_command('replay_failed_notification_lines', stdout=out)
+
+        assert 'Replayed: 1; failed again: 1' in out.getvalue()
+
+
+class TestRefreshStaleFamilyTrees:
+    def test_oldest_stale_trees_are_refreshed(self, mocker, settings):
+        settings.DNB_FAMILY_TREE_REFRESH_BATCH_SIZE = 2
+
+        for duns_number, age in [('111111111', 2), ('222222222', 0), ('333333333', 4), ('444444444', 3)]:
+            FamilyTree.objects.create(
+                global_ultimate_duns=duns_number,
+                global_ultimate_family_tree_members_count=1,
+                branches_excluded_members_count=0,
+                family_tree_members=[{'duns': duns_number}],
+                member_duns_numbers=[duns_number],
+                last_refreshed=timezone.now() - timedelta(days=age),
+            )
+
+        mocked_search = mocker.patch('dnb_direct_plus.api.company_hierarchy_list_search')
+
+        refresh_stale_family_trees.apply()
+
+        assert mocked_search.call_args_list == [
+            mocker.call({'duns_number': '333333333'}, use_local=False),
+            mocker.call({'duns_number': '444444444'}, use_local=False),
+        ]
+
+
+class TestScheduleCompanyUpdate:
+    @pytest.fixture(autouse=True)
+    def flush_redis(self):
+        yield
+        redis_client.flushall()
+
+    def test_updates_are_queued_once_per_duns_number(self, mocker, cmpelk_api_response_json):
+        api_data = json.loads(cmpelk_api_response_json)
+        mocked_task = mocker.patch('dnb_direct_plus.tasks.update_company_and_enable_monitoring')
+
+        schedule_company_update(api_data)
+        schedule_company_update(api_data)
+
+        mocked_task.delay.assert_called_once_with(api_data)
+
+    def test_pending_update_is_cleared_when_run(self, cmpelk_api_response_json):
+        api_data = json.loads(cmpelk_api_response_json)
+        duns_number = api_data['organization']['duns']
+
+        schedule_company_update(api_data)
+
+        assert Company.objects.filter(duns_number=duns_number).exists()
+        assert not redis_client.exists(COMPANY_UPDATE_PENDING_KEY.format(duns_number))
+
+    def test_wait_updates_before_returning(self, mocker, cmpelk_api_response_json):
+        api_data = json.loads(cmpelk_api_response_json)
+        redis_client.set(COMPANY_UPDATE_PENDING_KEY.format(api_data['organization']['duns']), 1)
+        mocked_delay = mocker.patch('dnb_direct_plus.tasks.update_company_and_enable_monitoring.delay')
+
+        schedule_company_update(api_data, wait=True)
+
+        assert Company.objects.filter(duns_number=api_data['organization']['duns']).exists()
+        assert not mocked_delay.called
+
+    def test_pending_update_is_cleared_when_queuing_fails(self, mocker, cmpelk_api_response_json):
+        api_data = json.loads(cmpelk_api_response_json)
+        mocked_task = mocker.patch('dnb_direct_plus.tasks.update_company_and_enable_monitoring')
+        mocked_task.delay.side_effect = [ConnectionError, None]
+
+        with pytest.raises(ConnectionError):
+            schedule_company_update(api_data)
+
+        assert not redis_client.exists(COMPANY_UPDATE_PENDING_KEY.format(api_data['organization']['duns']))
+
+        schedule_company_update(api_data)
+
+        assert mocked_task.delay.call_count == 2
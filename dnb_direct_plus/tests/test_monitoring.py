@@ -6,10 +6,12 @@ import json
 
 from freezegun import freeze_time
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from company.constants import MonitoringStatusChoices
-from company.models import Company
+from company.models import Company, IndustryCode
 from company.serialisers import CompanySerialiser
 from company.tests.factories import (
     CompanyFactory,
@@ -17,15 +19,18 @@ from company.tests.factories import (
     IndustryCodeFactory,
     RegistrationNumberFactory,
 )
+from dnb_direct_plus.mapping import extract_company_data
+from dnb_direct_plus.models import FailedNotificationLine, MonitoringFileProgress, MonitoringFileRecord
 from dnb_direct_plus.monitoring import (
     apply_update_to_company,
     add_companies_to_monitoring_registration,
     DNBApiError,
     process_exception_file,
     process_notification_file,
+    replay_failed_notification_lines,
     update_company_from_source,
     _parse_timestamp_from_file,
-    _update_dict_key,
+    _patch_source,
 )
 
 pytestmark = [
@@ -180,6 +185,101 @@ class TestUpdateCompanyFromSource:
             ]
         }
 
+    def test_unchanged_related_models_are_not_written(self, cmpelk_api_response_json):
+        source_data = json.loads(cmpelk_api_response_json)
+        source_data['organization']['industryCodes'].append(
+            copy.deepcopy(source_data['organization']['industryCodes'][0])
+        )
+
+        company = Company()
+        update_company_from_source(company, source_data, None)
+        industry_code_ids = set(company.industry_codes.values_list('id', flat=True))
+
+        with CaptureQueriesContext(connection) as queries:
+            update_company_from_source(company, source_data, None)
+
+        related_tables = ['company_registrationnumber', 'company_primaryindustrycode', 'company_industrycode']
+        assert not [
+            query['sql'] for query in queries
+            if any(table in query['sql'] for table in related_tables) and not query['sql'].startswith('SELECT')
+        ]
+        assert set(company.industry_codes.values_list('id', flat=True)) == industry_code_ids
+
+    def test_unchanged_company_data_only_saves_timestamp(self, cmpelk_api_response_json):
+        source_data = json.loads(cmpelk_api_response_json)
+
+        company = Company()
+        assert update_company_from_source(company, source_data, None)
+        assert company.source_hash
+
+        timestamp = timezone.now()
+
+        with CaptureQueriesContext(connection) as queries:
+            assert not update_company_from_source(company, source_data, timestamp)
+
+        writes = [query['sql'] for query in queries if not query['sql'].startswith(('SELECT', 'SAVEPOINT', 'RELEASE'))]
+        assert len(writes) == 1
+        assert writes[0].startswith('UPDATE "company_company" SET "last_updated_source_timestamp"')
+
+        company.refresh_from_db()
+        assert company.last_updated_source_timestamp == timestamp
+
+    def test_changed_company_data_only_saves_changed_fields(self, cmpelk_api_response_json):
+        source_data = json.loads(cmpelk_api_response_json)
+
+        company = Company()
+        update_company_from_source(company, source_data, None)
+        company = Company.objects.get(pk=company.pk)
+
+        source_data['organization']['primaryName'] = 'New name'
+
+        with CaptureQueriesContext(connection) as queries:
+            assert update_company_from_source(company, source_data, None)
+
+        company_writes = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "company_company"')]
+        assert len(company_writes) == 1
+        assert '"primary_name"' in company_writes[0]
+        assert '"worldbase_source"' not in company_writes[0]
+        assert '"address_country_id"' not in company_writes[0]
+
+        company.refresh_from_db()
+        assert company.primary_name == 'New name'
+
+    def test_source_hash_is_calculated_for_companies_without_one(self, cmpelk_api_response_json):
+        source_data = json.loads(cmpelk_api_response_json)
+
+        company = Company()
+        update_company_from_source(company, source_data, None)
+        Company.objects.filter(pk=company.pk).update(source_hash='')
+        company.refresh_from_db()
+
+        assert not update_company_from_source(company, source_data, None, enable_monitoring=True)
+
+        company.refresh_from_db()
+        assert company.source_hash
+        assert company.monitoring_status == MonitoringStatusChoices.pending.name
+
+    def test_changed_related_models_are_updated_in_place(self, cmpelk_api_response_json):
+        source_data = json.loads(cmpelk_api_response_json)
+
+        company = Company()
+        update_company_from_source(company, source_data, None)
+        industry_code = company.industry_codes.get()
+
+        source_data['organization']['industryCodes'][0]['description'] = 'Printing'
+        source_data['organization']['registrationNumbers'] = [
+            {'registrationNumber': '12345678', 'typeDnBCode': 2541},
+        ]
+        update_company_from_source(company, source_data, None)
+
+        assert list(company.industry_codes.values_list('id', 'description')) == [(industry_code.id, 'Printing')]
+        assert company.registration_numbers.count() == 1
+
+        source_data['organization']['industryCodes'] = []
+        update_company_from_source(company, source_data, None)
+
+        assert not IndustryCode.objects.filter(company=company).exists()
+
     def test_last_updated_field_not_modified_if_data_unchanged(self, cmpelk_api_response_json):
         """If there are no changes to the model, then the last_updated field should not be changed"""
 
@@ -552,7 +652,7 @@ class TestProcessNotificationFile:
 
         mocked_logger = mocker.patch('dnb_direct_plus.monitoring.logger')
 
-        total, total_success = process_notification_file(
+        total, total_success, total_unchanged = process_notification_file(
             'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
         )
 
@@ -599,7 +699,7 @@ class TestProcessNotificationFile:
         mocked.return_value.__enter__.return_value = data
         mocked.return_value.__exit__.return_value = False
 
-        total, total_success = process_notification_file(
+        total, total_success, total_unchanged = process_notification_file(
             'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
         )
 
@@ -623,7 +723,7 @@ class TestProcessNotificationFile:
 
         assert Company.objects.count() == 0
 
-        total, total_success = process_notification_file(file_name, 'DummyS3Client')
+        total, total_success, total_unchanged = process_notification_file(file_name, 'DummyS3Client')
 
         assert Company.objects.count() == 1
         company = Company.objects.first()
@@ -634,8 +734,350 @@ class TestProcessNotificationFile:
         assert total == 1
         assert total_success == 1
 
+    def _seed(self, company_data, duns_number):
+        seed = copy.deepcopy(company_data)
+        seed['organization']['duns'] = duns_number
+        return seed
+
+    def _rename(self, duns_number, name):
+        return {
+            'type': 'UPDATE',
+            'organization': {'duns': duns_number},
+            'elements': [
+                {
+                    'element': 'organization.primaryName',
+                    'previous': '',
+                    'current': name,
+                    'timestamp': '2019-06-25T01:00:17Z"'
+                },
+            ],
+        }
+
+    def _mock_file(self, mocker, lines):
+        data = io.BytesIO('\n'.join(json.dumps(line) for line in lines).encode('utf-8'))
+        mocked = mocker.patch('dnb_direct_plus.monitoring.open_zip_file')
+        mocked.return_value.__enter__.return_value = data
+        mocked.return_value.__exit__.return_value = False
+
+    @pytest.mark.parametrize('batch_size', [1, 2, 500])
+    def test_batches(self, mocker, settings, batch_size, cmpelk_api_response_json):
+        settings.DNB_MONITORING_BATCH_SIZE = batch_size
+        company_data = json.loads(cmpelk_api_response_json)
+
+        existing_company = Company()
+        update_company_from_source(existing_company, self._seed(company_data, '111111111'), None)
+
+        self._mock_file(mocker, [
+            self._rename('111111111', 'Acme Corp'),
+            self._seed(company_data, '222222222'),
+            self._rename('222222222', 'Widgets Ltd'),
+            self._rename('333333333', 'Missing Corp'),
+            {'type': 'UPDATE', 'organization': {'duns': '111111111'}},
+            'INVALID-LINE',
+        ])
+
+        total, total_success, total_unchanged = process_notification_file(
+            'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
+        )
+
+        assert total == 6
+        assert total_success == 3
+
+        assert Company.objects.count() == 2
+        assert Company.objects.get(duns_number='111111111').primary_name == 'Acme Corp'
+
+        new_company = Company.objects.get(duns_number='222222222')
+        assert new_company.primary_name == 'Widgets Ltd'
+        assert new_company.monitoring_status == MonitoringStatusChoices.enabled.name
+
+        for company in Company.objects.all():
+            assert company.registration_numbers.count() == len(company_data['organization']['registrationNumbers'])
+            assert company.industry_codes.count() == len(company_data['organization']['industryCodes'])
+
+    @pytest.mark.parametrize('batch_size', [1, 500])
+    def test_unchanged_updates_are_counted(self, mocker, settings, batch_size, cmpelk_api_response_json):
+        settings.DNB_MONITORING_BATCH_SIZE = batch_size
+        company_data = json.loads(cmpelk_api_response_json)
+
+        company = Company()
+        update_company_from_source(company, self._seed(company_data, '111111111'), None)
+        update_company_from_source(Company(), self._seed(company_data, '222222222'), None)
+
+        self._mock_file(mocker, [
+            self._rename('111111111', 'Test Company, Inc.'),
+            self._rename('222222222', 'Acme Corp'),
+            self._rename('111111111', 'Test Company, Inc.'),
+        ])
+
+        total, total_success, total_unchanged = process_notification_file(
+            'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
+        )
+
+        assert (total, total_success, total_unchanged) == (3, 3, 2)
+
+        company.refresh_from_db()
+        assert company.last_updated is None
+        assert company.last_updated_source_timestamp == _parse_timestamp_from_file(
+            'DITCompanyService_20191113000016_NOTIFICATION_1.zip'
+        )
+        assert company.source['type'] == 'UPDATE'
+        assert Company.objects.get(duns_number='222222222').primary_name == 'Acme Corp'
+
+    @pytest.mark.parametrize('batch_size', [1, 500])
+    @freeze_time('2019-11-25 12:00:01 UTC')
+    def test_update_followed_by_seed_marks_company_updated(
+        self, mocker, settings, batch_size, cmpelk_api_response_json,
+    ):
+        settings.DNB_MONITORING_BATCH_SIZE = batch_size
+        company_data = json.loads(cmpelk_api_response_json)
+
+        company = Company()
+        update_company_from_source(company, self._seed(company_data, '111111111'), None)
+        seed = self._seed(company_data, '111111111')
+        seed['organization']['primaryName'] = 'Acme Corp'
+
+        self._mock_file(mocker, [self._rename('111111111', 'Acme Corp'), seed])
+
+        total, total_success, total_unchanged = process_notification_file(
+            'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
+        )
 
-class TestUpdateDictKey:
+        assert (total, total_success) == (2, 2)
+
+        company.refresh_from_db()
+        assert company.primary_name == 'Acme Corp'
+        assert company.last_updated == timezone.now()
+
+    def test_shards(self, mocker, cmpelk_api_response_json):
+        company_data = json.loads(cmpelk_api_response_json)
+        duns_numbers = ['111111111', '222222222', '333333333']
+
+        for duns_number in duns_numbers:
+            update_company_from_source(Company(), self._seed(company_data, duns_number), None)
+
+        lines = [self._rename(duns_number, f'{duns_number} {n}') for n in range(2) for duns_number in duns_numbers]
+        data = '\n'.join(json.dumps(line) for line in lines + ['INVALID-LINE']).encode('utf-8')
+        mocked = mocker.patch('dnb_direct_plus.monitoring.open_zip_file')
+        mocked.return_value.__enter__.side_effect = lambda *args: io.BytesIO(data)
+        mocked.return_value.__exit__.return_value = False
+
+        shard_totals = [
+            process_notification_file(
+                'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client', shard=shard, shards=2,
+            )
+            for shard in range(2)
+        ]
+
+        assert [sum(totals) for totals in zip(*shard_totals)] == [7, 6, 0]
+        for duns_number in duns_numbers:
+            assert Company.objects.get(duns_number=duns_number).primary_name == f'{duns_number} 1'
+
+    def test_progress_is_saved_with_each_batch(self, mocker, settings, cmpelk_api_response_json):
+        settings.DNB_MONITORING_BATCH_SIZE = 1
+        company_data = json.loads(cmpelk_api_response_json)
+
+        mocker.patch(
+            'dnb_direct_plus.monitoring._process_notification_batch',
+            side_effect=[(1, 0), Exception('worker lost')],
+        )
+        self._mock_file(mocker, [
+            self._seed(company_data, '111111111'),
+            self._seed(company_data, '222222222'),
+        ])
+
+        with pytest.raises(Exception):
+            process_notification_file('DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client')
+
+        progress = MonitoringFileProgress.objects.get(file_name='DITCompanyService_20191113000016_NOTIFICATION_1.zip')
+        assert (progress.last_line_number, progress.total, progress.success, progress.unchanged) == (1, 1, 1, 0)
+
+    def test_processing_resumes_after_saved_progress(self, mocker, cmpelk_api_response_json):
+        company_data = json.loads(cmpelk_api_response_json)
+
+        MonitoringFileProgress.objects.create(
+            file_name='DITCompanyService_20191113000016_NOTIFICATION_1.zip',
+            last_line_number=2,
+            total=2,
+            success=1,
+            unchanged=1,
+        )
+        self._mock_file(mocker, [
+            self._seed(company_data, '111111111'),
+            'INVALID-LINE',
+            self._seed(company_data, '222222222'),
+        ])
+
+        total, total_success, total_unchanged = process_notification_file(
+            'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
+        )
+
+        assert (total, total_success, total_unchanged) == (3, 2, 1)
+        assert list(Company.objects.values_list('duns_number', flat=True)) == ['222222222']
+
+    @pytest.mark.parametrize('fail_batch', [False, True])
+    def test_exceptions_are_stored(self, mocker, caplog, fail_batch, cmpelk_api_response_json):
+        company_data = json.loads(cmpelk_api_response_json)
+
+        if fail_batch:
+            mocker.patch('dnb_direct_plus.monitoring._save_companies', side_effect=Exception('deadlock detected'))
+        self._mock_file(mocker, [
+            {'organization': {'duns': '111111111'}},
+            self._seed(company_data, '222222222'),
+        ])
+
+        total, total_success, total_unchanged = process_notification_file(
+            'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
+        )
+
+        assert total_success == 1
+        failed_line = FailedNotificationLine.objects.get()
+        assert failed_line.file_name == 'DITCompanyService_20191113000016_NOTIFICATION_1.zip'
+        assert failed_line.line_number == 1
+        assert failed_line.reason == "KeyError: 'corporateLinkage'"
+        assert failed_line.update_data == {'organization': {'duns': '111111111'}}
+        assert 'NOTIFICATION_1.zip/1 exception: ' in caplog.text
+        assert 'stored as a failed line' in caplog.text
+
+    def test_updates_to_a_company_are_mapped_once_per_batch(self, mocker, cmpelk_api_response_json):
+        company_data = json.loads(cmpelk_api_response_json)
+
+        self._mock_file(mocker, [
+            self._seed(company_data, '111111111'),
+            self._rename('111111111', 'Acme Corp'),
+            self._rename('111111111', 'Acme Corp Ltd'),
+            self._rename('222222222', 'Missing Corp'),
+        ])
+        mocked_extract = mocker.patch(
+            'dnb_direct_plus.monitoring.extract_company_data',
+            wraps=extract_company_data,
+        )
+
+        total, total_success, total_unchanged = process_notification_file(
+            'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
+        )
+
+        assert (total, total_success, total_unchanged) == (4, 3, 0)
+        assert mocked_extract.call_count == 1
+        company = Company.objects.get(duns_number='111111111')
+        assert company.primary_name == 'Acme Corp Ltd'
+        assert company.source['type'] == 'UPDATE'
+
+    def test_failed_fold_is_applied_one_line_at_a_time(self, mocker, cmpelk_api_response_json):
+        company_data = json.loads(cmpelk_api_response_json)
+
+        update_company_from_source(Company(), self._seed(company_data, '111111111'), None)
+        self._mock_file(mocker, [
+            self._rename('111111111', 'Acme Corp'),
+            {
+                'type': 'UPDATE',
+                'organization': {'duns': '111111111'},
+                'elements': [{'element': 'organization.corporateLinkage', 'current': None}],
+            },
+        ])
+
+        total, total_success, total_unchanged = process_notification_file(
+            'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
+        )
+
+        assert (total, total_success, total_unchanged) == (2, 1, 0)
+        assert Company.objects.get(duns_number='111111111').primary_name == 'Acme Corp'
+        assert FailedNotificationLine.objects.get().line_number == 2
+
+    def test_queries_do_not_grow_with_batch_size(
+        self, mocker, django_assert_max_num_queries, cmpelk_api_response_json,
+    ):
+        company_data = json.loads(cmpelk_api_response_json)
+
+        for n in range(10):
+            update_company_from_source(Company(), self._seed(company_data, str(n).zfill(9)), None)
+
+        self._mock_file(mocker, [self._rename(str(n).zfill(9), f'Company {n}') for n in range(10)])
+
+        with django_assert_max_num_queries(13):
+            total, total_success, total_unchanged = process_notification_file(
+                'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
+            )
+
+        assert total_success == 10
+        assert Company.objects.get(duns_number='000000009').primary_name == 'Company 9'
+
+    def test_failed_batch_is_retried_one_line_at_a_time(self, mocker, caplog, cmpelk_api_response_json):
+        company_data = json.loads(cmpelk_api_response_json)
+
+        mocker.patch('dnb_direct_plus.monitoring._save_companies', side_effect=Exception('deadlock detected'))
+        self._mock_file(mocker, [
+            self._seed(company_data, '111111111'),
+            self._rename('333333333', 'Missing Corp'),
+        ])
+
+        total, total_success, total_unchanged = process_notification_file(
+            'DITCompanyService_20191113000016_NOTIFICATION_1.zip', 'DummyS3Client'
+        )
+
+        assert total == 2
+        assert total_success == 1
+        assert Company.objects.filter(duns_number='111111111').exists()
+        assert 'failed to save batch, retrying one line at a time: deadlock detected' in caplog.text
+
+
+class TestReplayFailedNotificationLines:
+    def test_replay(self, settings, cmpelk_api_response_json):
+        settings.DNB_MONITORING_BATCH_SIZE = 1
+        company_data = json.loads(cmpelk_api_response_json)
+        seed = copy.deepcopy(company_data)
+        seed['organization']['duns'] = '111111111'
+        rename = {
+            'type': 'UPDATE',
+            'organization': {'duns': '111111111'},
+            'elements': [{'element': 'organization.primaryName', 'current': 'Acme Corp'}],
+        }
+
+        for file_name, line_number, update_data in [
+            ('DITCompanyService_20191114000016_NOTIFICATION_1.zip', 3, rename),
+            ('DITCompanyService_20191114000016_NOTIFICATION_1.zip', 5, {'organization': {'duns': '222222222'}}),
+            ('DITCompanyService_20191113000016_NOTIFICATION_1.zip', 7, seed),
+            ('DITCompanyService_20191113000016_NOTIFICATION_2.zip', 1, seed),
+        ]:
+            FailedNotificationLine.objects.create(
+                file_name=file_name, line_number=line_number, reason='Exception: fixed', update_data=update_data,
+            )
+
+        for file_name, failed, unchanged in [
+            ('DITCompanyService_20191114000016_NOTIFICATION_1.zip', 2, 0),
+            ('monitoring/DITCompanyService_20191113000016_NOTIFICATION_1.zip', 1, 3),
+            ('DITCompanyService_20191113000016_NOTIFICATION_2.zip', 1, 0),
+        ]:
+            MonitoringFileRecord.objects.create(file_name=file_name, total=10, failed=failed, unchanged=unchanged)
+
+        assert replay_failed_notification_lines() == (4, 1)
+
+        assert Company.objects.get(duns_number='111111111').primary_name == 'Acme Corp'
+        failed_line = FailedNotificationLine.objects.get()
+        assert (failed_line.line_number, failed_line.reason) == (5, "KeyError: 'corporateLinkage'")
+
+        assert {
+            record.file_name: (record.total, record.failed, record.unchanged)
+            for record in MonitoringFileRecord.objects.all()
+        } == {
+            'DITCompanyService_20191114000016_NOTIFICATION_1.zip': (10, 1, 0),
+            'monitoring/DITCompanyService_20191113000016_NOTIFICATION_1.zip': (10, 0, 3),
+            'DITCompanyService_20191113000016_NOTIFICATION_2.zip': (10, 0, 1),
+        }
+
+    def test_replay_file(self):
+        for file_name in [
+            'DITCompanyService_20191113000016_NOTIFICATION_1.zip',
+            'DITCompanyService_20191113000016_NOTIFICATION_2.zip',
+        ]:
+            FailedNotificationLine.objects.create(
+                file_name=file_name, line_number=1, reason='Exception: fixed', update_data={'type': 'OTHER'},
+            )
+
+        assert replay_failed_notification_lines('DITCompanyService_20191113000016_NOTIFICATION_2.zip') == (1, 0)
+        assert FailedNotificationLine.objects.get().file_name == 'DITCompanyService_20191113000016_NOTIFICATION_1.zip'
+
+
+class TestPatchSource:
     def test_success(self):
 
         source = {
@@ -654,7 +1096,7 @@ class TestUpdateDictKey:
 
         expected['a']['b']['c']['d']['e'] = 'modified'
 
-        assert _update_dict_key(source, 'a.b.c.d.e'.split('.'), 'modified') == expected
+        assert _patch_source(source, [{'element': 'a.b.c.d.e', 'current': 'modified'}]) == expected
 
     def test_new_element_is_appended(self):
         source = {
@@ -672,5 +1114,34 @@ class TestUpdateDictKey:
         expected = copy.deepcopy(source)
 
         expected['a']['b']['c']['d']['e_sibling'] = 'added'
+        expected['a']['f'] = {'g': 'created'}
 
-        assert _update_dict_key(source, 'a.b.c.d.e_sibling'.split('.'), 'added') == expected
+        assert _patch_source(
+            source,
+            [
+                {'element': 'a.b.c.d.e_sibling', 'current': 'added'},
+                {'element': 'a.f.g', 'current': 'created'},
+            ],
+        ) == expected
+
+    def test_only_changed_paths_are_copied(self):
+        source = {
+            'a': {'b': {'c': 'test'}, 'd': 'test'},
+            'untouched': {'e': ['test']},
+        }
+        original = copy.deepcopy(source)
+
+        patched = _patch_source(
+            source,
+            [
+                {'element': 'a.b.c', 'current': 'modified'},
+                {'element': 'a.d', 'current': 'modified'},
+            ],
+        )
+
+        assert source == original
+        assert patched == {
+            'a': {'b': {'c': 'modified'}, 'd': 'modified'},
+            'untouched': {'e': ['test']},
+        }
+        assert patched['untouched'] is source['untouched']
@@ -4,7 +4,8 @@ import logging
 from django.db import transaction
 from django.utils import timezone
 
-from company.models import Company, Country, PrimaryIndustryCode, RegistrationNumber
+from company.countries import get_country
+from company.models import Company, PrimaryIndustryCode, RegistrationNumber
 
 from .constants import WB_HEADER_FIELDS
 from .mapping import extract_company_data
@@ -37,19 +38,18 @@ def update_company(wb_data):
     if overwrite_fields:
         for field, value in company_data.items():
             if field.endswith('country'):
-                setattr(company, field, Country.objects.get(iso_alpha2=value))
+                setattr(company, field, get_country(value))
             elif field not in foreign_key_fields:
                 setattr(company, field, value)
 
-    company.save()
+    # only write the fields that have changed, rather than every column and both sources
+    company.save(update_fields=None if created else company.changed_fields)
 
     if overwrite_fields:
         # Can't delete records before company is saved.
         company.registration_numbers.all().delete()
         company.primary_industry_codes.all().delete()
 
-    company.save()
-
     if overwrite_fields:
         for registration_number in company_data['registration_numbers']:
             RegistrationNumber.objects.create(
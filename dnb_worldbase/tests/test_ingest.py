@@ -3,6 +3,8 @@ import io
 from collections import OrderedDict
 
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from freezegun import freeze_time
 
@@ -242,6 +244,27 @@ class TestUpdateCompany:
 
         assert serialiser.data == original_company_data.data
 
+    def test_update_company_with_api_data_only_saves_worldbase_fields(self, test_input_data):
+        Company.objects.create(
+            duns_number='123456789',
+            primary_name='test company',
+            address_country=Country.objects.get(iso_alpha2='US'),
+            year_started=2000,
+            legal_status=LegalStatusChoices.partnership.name,
+            is_out_of_business=True,
+            source={'some_data': 'do not amend'},
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            update_company(test_input_data)
+
+        company_writes = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "company_company"')]
+        assert len(company_writes) == 1
+        assert company_writes[0].startswith(
+            'UPDATE "company_company" SET "worldbase_source" = '
+        )
+        assert '"source" =' not in company_writes[0]
+
     @pytest.mark.parametrize(
         'test_input,exception,message',
         [